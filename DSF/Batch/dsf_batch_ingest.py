@@ -0,0 +1,245 @@
+"""
+Convert many raw DSF runs (nanoDSF .xlsx and Rotor-Gene Q .xls) into one
+tidy, partitioned Parquet dataset.
+
+Layout of OUTPUT_FOLDER:
+    run=<run>/part-0.parquet   one file per run, one row group per sample
+    _index.parquet             run, sample, well -> file and row group
+
+Every partition has the columns run, well, sample, temperature, signal and
+derivative. The derivative is the Savitzky-Golay first derivative of the
+signal (SMOOTH_WINDOW °C) for both instruments, so runs compare directly;
+the derivative exported by the nanoDSF software is not used. `read_dataset()` uses the index to open only the files and row
+groups needed for the requested runs/samples.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import argparse
+import glob
+import logging
+import sys
+
+import numpy as np
+import pandas as pd
+import yaml
+
+DSF_DIR = Path(__file__).resolve().parents[1]
+sys.path.extend([str(DSF_DIR), str(DSF_DIR / 'nanoDSF'), str(DSF_DIR / 'Qiagen_RotorGeneQ')])
+from labscripthub.instrument import stage
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+INDEX_NAME = '_index.parquet'
+COLUMNS = ['run', 'well', 'sample', 'temperature', 'signal', 'derivative']
+
+
+def load_nanodsf(filename, window):
+    """All capillaries of a nanoDSF export as (well, sample, temps, ratio, derivative)."""
+    from nanodsf_plotting import read_data, filter_data
+    from dsf_common import smoothed_derivative
+
+    df_ov, df_r, df_fd = read_data(filename)
+    capillaries = [str(c).strip() for c in df_r.columns
+                   if str(c).strip() != 'Capillary' and not str(c).startswith('Unnamed')]
+    data = filter_data(df_r, df_fd, capillaries)
+    sample_ids = dict(zip(df_ov['Capillary'].astype(str), df_ov['Sample ID'].astype(str)))
+    curves = []
+    for cap in capillaries:
+        temps, ratio, _ = data[cap]
+        keep = np.isfinite(temps) & np.isfinite(ratio)
+        temps, ratio = temps[keep], ratio[keep]
+        deriv = smoothed_derivative(temps, ratio, window)[0]
+        curves.append((cap, sample_ids.get(cap, f"Cap{cap}"), temps, ratio, deriv))
+    return curves
+
+
+def load_rotorgene(filename, window):
+    """All samples of a Rotor-Gene Q export as (well, sample, temps, fluorescence, derivative)."""
+    from preprocess_dsf_data import read_data, reorganize
+    from dsf_common import smoothed_derivative
+
+    result_df = reorganize(read_data(filename))
+    result_df = result_df[np.isfinite(result_df['Temperature'].to_numpy(dtype=float))]
+    temps = result_df['Temperature'].to_numpy(dtype=float)
+    names = [c for c in result_df.columns if c != 'Temperature']
+    signals = result_df[names].to_numpy(dtype=float).T
+    derivs = smoothed_derivative(temps, signals, window)
+    # reorganize() numbers repeated sample names (Foo_1, Foo_2); the position is the well
+    return [(str(pos), name.rsplit('_', 1)[0], temps, signal, deriv)
+            for pos, (name, signal, deriv) in enumerate(zip(names, signals, derivs), start=1)]
+
+
+LOADERS = {
+    'nanodsf': load_nanodsf,
+    'rotorgene': load_rotorgene,
+}
+
+
+def ingest_run(filename, kind, run, output_folder, window=3.0):
+    """
+    Convert one raw file into its run partition.
+
+    Runs in a worker process; only the small index rows travel back.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    curves = LOADERS[kind](filename, window)
+    part_dir = Path(output_folder) / f"run={run}"
+    part_dir.mkdir(parents=True, exist_ok=True)
+    part_file = part_dir / 'part-0.parquet'
+
+    schema = pa.schema([
+        ('run', pa.dictionary(pa.int32(), pa.string())),
+        ('well', pa.dictionary(pa.int32(), pa.string())),
+        ('sample', pa.dictionary(pa.int32(), pa.string())),
+        ('temperature', pa.float64()),
+        ('signal', pa.float64()),
+        ('derivative', pa.float64()),
+    ])
+
+    # Sorted by sample so that every sample is one contiguous row group
+    curves = sorted(curves, key=lambda c: (c[1], c[0]))
+    index_rows = []
+    with pq.ParquetWriter(part_file, schema) as writer:
+        for row_group, (well, sample, temps, signal, deriv) in enumerate(curves):
+            n = len(temps)
+            table = pa.table({
+                'run': pa.array([run] * n).dictionary_encode(),
+                'well': pa.array([well] * n).dictionary_encode(),
+                'sample': pa.array([sample] * n).dictionary_encode(),
+                'temperature': np.asarray(temps, dtype=float),
+                'signal': np.asarray(signal, dtype=float),
+                'derivative': np.asarray(deriv, dtype=float),
+            }, schema=schema)
+            writer.write_table(table, row_group_size=max(n, 1))
+            index_rows.append({
+                'run': run,
+                'sample': sample,
+                'well': well,
+                'kind': kind,
+                'source': str(filename),
+                'file': str(part_file.relative_to(output_folder)),
+                'row_group': row_group,
+                'n_points': n,
+            })
+    return index_rows
+
+
+def read_dataset(dataset_folder, runs=None, samples=None, columns=None):
+    """
+    Load part of an ingested dataset as one long DataFrame.
+
+    Only the partitions (runs) and row groups (samples) that match are read.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    dataset_folder = Path(dataset_folder)
+    index = pd.read_parquet(dataset_folder / INDEX_NAME)
+    if runs is not None:
+        index = index[index['run'].isin([str(r) for r in runs])]
+    if samples is not None:
+        index = index[index['sample'].isin([str(s) for s in samples])]
+    if index.empty:
+        return pd.DataFrame(columns=columns or COLUMNS)
+
+    tables = []
+    for part_file, rows in index.groupby('file', sort=False):
+        parquet = pq.ParquetFile(dataset_folder / part_file)
+        tables.append(parquet.read_row_groups(sorted(rows['row_group']), columns=columns))
+    return pa.concat_tables(tables, promote_options='permissive').to_pandas()
+
+
+def collect_runs(run_entries):
+    """Expand the RUNS globs into (file, kind, run name) triples."""
+    runs = []
+    seen = {}
+    for entry in run_entries:
+        kind = str(entry.get('TYPE', '')).lower()
+        if kind not in LOADERS:
+            raise ValueError(f"RUNS entry TYPE must be one of {list(LOADERS)}, not '{kind}'.")
+        pattern = entry['PATTERN']
+        files = sorted(glob.glob(str(pattern), recursive=True))
+        if not files:
+            logging.warning("No files match '%s'.", pattern)
+        for fn in files:
+            run = Path(fn).stem
+            if run in seen:
+                raise ValueError(f"Run name '{run}' is used by both {seen[run]} and {fn}. Rename one of the files.")
+            seen[run] = fn
+            runs.append((Path(fn), kind, run))
+    return runs
+
+
+def main(yaml_config):
+    # Load YAML config
+    with open(yaml_config, 'r') as f:
+        cfg = yaml.safe_load(f)
+
+    run_entries = cfg.get('RUNS', [])
+    if not run_entries:
+        raise ValueError("Config YAML must contain a 'RUNS' list with at least one entry.")
+
+    output_folder = Path(cfg.get('OUTPUT_FOLDER', 'dsf_dataset'))
+    output_folder.mkdir(parents=True, exist_ok=True)
+    window    = float(cfg.get('SMOOTH_WINDOW', 3.0))
+    workers   = cfg.get('WORKERS', None)
+    overwrite = cfg.get('OVERWRITE', False)
+
+    index_path = output_folder / INDEX_NAME
+    with stage('read'):
+        old_index = pd.read_parquet(index_path) if index_path.exists() else None
+
+    runs = collect_runs(run_entries)
+    if old_index is not None and not overwrite:
+        done = set(old_index['run'])
+        skipped = [run for _, _, run in runs if run in done]
+        if skipped:
+            logging.info("Skipping %d run(s) already in the dataset (set OVERWRITE: True to redo).", len(skipped))
+        runs = [r for r in runs if r[2] not in done]
+
+    index_rows = []
+    failed = []
+    # The runs are read, converted and written in the workers
+    with stage('ingest'), ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(ingest_run, fn, kind, run, output_folder, window): fn
+                   for fn, kind, run in runs}
+        for fut in as_completed(futures):
+            fn = futures[fut]
+            try:
+                rows = fut.result()
+            except Exception as exc:
+                logging.error("Failed on %s: %s", fn, exc)
+                failed.append(fn)
+                continue
+            index_rows.extend(rows)
+            logging.info("Ingested %s (%d samples)", fn, len(rows))
+
+    new_index = pd.DataFrame(index_rows)
+    if old_index is not None:
+        if not new_index.empty:
+            old_index = old_index[~old_index['run'].isin(new_index['run'])]
+        new_index = pd.concat([old_index, new_index], ignore_index=True)
+    if not new_index.empty:
+        new_index = new_index.sort_values(['run', 'sample', 'well']).reset_index(drop=True)
+        with stage('save'):
+            new_index.to_parquet(index_path, index=False)
+    logging.info("Dataset %s now holds %d run(s); %d failed.",
+                 output_folder, new_index['run'].nunique() if not new_index.empty else 0, len(failed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert many raw DSF files into one partitioned Parquet dataset.')
+    parser.add_argument(
+        "yaml_config",
+        nargs="?",
+        default=None,
+        help="Path to the YAML configuration file (default: ./input.yaml)"
+    )
+    args = parser.parse_args()
+    if args.yaml_config is None:
+        logging.info("No YAML config provided, using default: ./input.yaml")
+        args.yaml_config = './input.yaml'  # Default config file
+    main(args.yaml_config)
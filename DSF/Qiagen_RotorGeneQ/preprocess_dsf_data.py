@@ -1,11 +1,16 @@
+import numpy as np
 import pandas as pd
 from pathlib import Path
 import argparse
 import logging
+import sys
 import yaml
 
+from labscripthub.instrument import stage
+
 logging.basicConfig( level=logging.INFO, format='[%(levelname)s] %(message)s')
 
+@stage('read')
 def read_data(file_path: Path) -> pd.DataFrame:
     """
     Read an Excel file into a DataFrame.
@@ -13,36 +18,74 @@ def read_data(file_path: Path) -> pd.DataFrame:
     return pd.read_excel(file_path, engine="xlrd")
 
 
-def reorganize(data_df: pd.DataFrame) -> dict:
+@stage('compute')
+def reorganize(data_df: pd.DataFrame) -> pd.DataFrame:
     """
     Take the raw DataFrame and pull out Temperature (col “X”) plus
     each sample’s fluorescence column, renaming to ensure uniqueness.
+
+    Each sample block is 3 columns (name, temperature, fluorescence), so the
+    raw values are reshaped into an (n_temps x n_samples x 3) array and the
+    temperatures of all blocks are checked against “X” in a single comparison.
     """
-    data = {'Temperature': data_df['X']}
+    n_blocks, leftover = divmod(len(data_df.columns), 3)
+    if leftover:
+        logging.warning("Ignoring %d trailing column(s) that do not form a full sample block.", leftover)
+    blocks = data_df.iloc[:, :3 * n_blocks].to_numpy().reshape(len(data_df), n_blocks, 3)
+
+    # Sanity-check that all temperatures line up
+    temperature = data_df['X'].to_numpy(dtype=float)
+    block_temps = blocks[:, :, 1].astype(float)
+    matches = (block_temps == temperature[:, None]) | (np.isnan(block_temps) & np.isnan(temperature)[:, None])
+    mismatched = np.flatnonzero(~matches.all(axis=0))
+    if mismatched.size:
+        raise ValueError(f"Temperature mismatch in column {data_df.columns[3 * mismatched[0] + 1]!r}")
+
+    # Extract the “Sample:Foo” -> “Foo” and make unique
     sample_name_counter = {}
-    
-    # Each sample block is 3 columns: name, temp, fluorescence
-    for i in range(0, len(data_df.columns), 3):
-        name_col = data_df.columns[i]
-        temp_col = data_df.columns[i+1]
-        fluo_col = data_df.columns[i+2]
-
-        # Extract the “Sample:Foo” -> “Foo”
-        raw_name = data_df[name_col][0]
+    unique_names = []
+    for raw_name in blocks[0, :, 0]:
         sample_name = raw_name.split(':', 1)[1].strip()
-
-        # Make unique
         count = sample_name_counter.get(sample_name, 0) + 1
         sample_name_counter[sample_name] = count
-        unique_name = f"{sample_name}_{count}"
+        unique_names.append(f"{sample_name}_{count}")
+
+    fluorescence = blocks[:, :, 2].astype(float)
+    return pd.DataFrame(np.column_stack([temperature, fluorescence]),
+                        columns=['Temperature'] + unique_names,
+                        index=data_df.index)
 
-        # Sanity-check that all temperatures line up
-        if not (data_df[temp_col] == data['Temperature']).all():
-            raise ValueError(f"Temperature mismatch in column {temp_col!r}")
 
-        data[unique_name] = data_df[fluo_col]
+OUTPUT_FORMATS = {'.xlsx': 'xlsx', '.csv': 'csv', '.parquet': 'parquet'}
 
-    return data
+@stage('save')
+def write_output(result_df: pd.DataFrame, out_path: Path, fmt: str):
+    """
+    Write the reorganized table as CSV, Parquet or xlsx.
+
+    xlsx goes through XlsxWriter row by row in constant-memory mode when it is
+    installed, which is much faster than pandas' cell-by-cell `to_excel`.
+    """
+    if fmt == 'csv':
+        result_df.to_csv(out_path, index=False)
+    elif fmt == 'parquet':
+        result_df.to_parquet(out_path, index=False)
+    elif fmt == 'xlsx':
+        try:
+            import xlsxwriter
+        except ImportError:
+            logging.info("XlsxWriter not installed, falling back to pandas' to_excel.")
+            result_df.to_excel(out_path, index=False)
+            return
+        with xlsxwriter.Workbook(str(out_path), {'constant_memory': True}) as workbook:
+            worksheet = workbook.add_worksheet()
+            worksheet.write_row(0, 0, [str(c) for c in result_df.columns])
+            values = result_df.to_numpy(dtype=float)
+            for row_idx, row in enumerate(values, start=1):
+                # NaN cannot be stored as a number in xlsx; leave those cells empty
+                worksheet.write_row(row_idx, 0, [None if v != v else v for v in row.tolist()])
+    else:
+        raise ValueError(f"Unknown OUTPUT_FORMAT '{fmt}'. Use one of: {', '.join(OUTPUT_FORMATS.values())}")
 
 def main(yaml_config: Path):
     # 1) Load YAML
@@ -54,20 +97,62 @@ def main(yaml_config: Path):
 
     # 2) Read & reshape
     df = read_data(in_file)
-    data = reorganize(df)
-    result_df = pd.DataFrame(data)
+    result_df = reorganize(df)
 
-    # 3) Determine output name
+    # 3) Determine output name and format (format from OUTPUT_FORMAT or the name's extension)
     out_name = cfg.get('OUTPUT_NAME', f"preprocessed_{in_file.stem}")
-    # Check if out_name has .xlsx extension
-    if not out_name.endswith('.xlsx'):
-        out_name += '.xlsx'
+    out_format = cfg.get('OUTPUT_FORMAT', None)
+    if out_format is None:
+        out_format = OUTPUT_FORMATS.get(Path(out_name).suffix.lower(), 'xlsx')
+    out_format = str(out_format).lower().lstrip('.')
+    if Path(out_name).suffix.lower() != f".{out_format}":
+        out_name += f".{out_format}"
     out_path = out_folder / out_name
 
     # 4) Write
-    result_df.to_excel(out_path, index=False)
+    write_output(result_df, out_path, out_format)
     logging.info("Written reorganized data to %s", out_path)
 
+    # 5) Optional: bootstrap confidence intervals for Tm and plate report
+    boot_flag = cfg.get('BOOTSTRAP', False)
+    report_flag = cfg.get('REPORT', False)
+    if not (boot_flag or report_flag):
+        return
+    sys.path.append(str(Path(__file__).resolve().parents[1]))
+    import dsf_common
+
+    temp_min = cfg.get('TEMP_MIN', None)
+    temp_max = cfg.get('TEMP_MAX', None)
+    temps = result_df['Temperature'].to_numpy(dtype=float)
+    samples = [name for name in result_df.columns if name != 'Temperature']
+
+    tm_values = None
+    if boot_flag:
+        boot_params = dsf_common.bootstrap_params(cfg)
+        tm_entries = [(name, temps, result_df[name].to_numpy(dtype=float)) for name in samples]
+        tm_table = dsf_common.bootstrap_tm_table(tm_entries, temp_min=temp_min, temp_max=temp_max,
+                                                 **boot_params)
+        dsf_common.log_tm_table(tm_table, boot_params['ci'])
+        tm_path = out_folder / f"{Path(out_name).stem}_tm.csv"
+        with stage('save'):
+            tm_table.to_csv(tm_path, index=False)
+        logging.info("Written Tm table to %s", tm_path)
+        tm_values = tm_table['Tm'].to_list()
+
+    if report_flag:
+        params = dsf_common.report_params(cfg, default_grid=(8, 12))
+        report_name = params.pop('name') or f"{Path(out_name).stem}_report"
+        if tm_values is None:
+            # One sample at a time: samples with missing points end up on grids of different lengths
+            tm_values = []
+            for name in samples:
+                grid, curve = dsf_common.uniform_grid(temps, result_df[name].to_numpy(dtype=float))
+                tm_values.append(float(dsf_common.estimate_tm(grid, curve, temp_min=temp_min, temp_max=temp_max)))
+        report_entries = [(name, temps, result_df[name].to_numpy(dtype=float), tm)
+                          for name, tm in zip(samples, tm_values)]
+        dsf_common.render_plate_report(report_entries, out_folder / report_name,
+                                       temp_min=temp_min, temp_max=temp_max, **params)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Plot combined data from multiple Excel files using a single YAML config.')
@@ -0,0 +1,386 @@
+"""
+Helpers shared by the DSF scripts (nanoDSF and Rotor-Gene Q).
+
+Melting temperatures are taken from the maximum of the Savitzky-Golay
+smoothed first derivative. Confidence intervals come from a residual
+bootstrap: the residuals of the smoothed curve are resampled with
+replacement, added back onto the smooth curve and the Tm is re-estimated
+for every resample.
+
+The plate report draws one mini-panel per sample/capillary. All panels of a
+page share a single Axes: every curve is shifted into its own grid cell and
+the whole page is drawn as one LineCollection, which is far cheaper than one
+Axes per panel. Neither instrument exports plate positions, so panels are
+filled in order and named by their sample label only.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy.signal import savgol_filter
+
+from labscripthub.instrument import stage
+
+
+def _window_points(window, step, n_points, polyorder):
+    """
+    Convert a smoothing window in °C into an odd number of points that fits the data.
+
+    Coarsely sampled runs (e.g. 1 °C steps) get the shortest window the
+    polynomial order allows.
+    """
+    points = max(int(round(window / step)), polyorder + 1)
+    if points % 2 == 0:
+        points += 1
+    if points > n_points:
+        raise ValueError(
+            f"Curve has only {n_points} points, too few for a smoothing window of {points} points.")
+    return points
+
+
+def uniform_grid(temps, signal):
+    """
+    Drop non-finite points and resample onto an evenly spaced temperature grid.
+
+    Savitzky-Golay derivatives assume equidistant points. nanoDSF exports are
+    close to, but not exactly, equidistant, so the curve is interpolated when
+    the spacing varies by more than 1 %.
+    """
+    temps = np.asarray(temps, dtype=float)
+    signal = np.asarray(signal, dtype=float)
+    mask = np.isfinite(temps) & np.isfinite(signal)
+    temps, signal = temps[mask], signal[mask]
+    order = np.argsort(temps, kind='stable')
+    temps, signal = temps[order], signal[order]
+
+    steps = np.diff(temps)
+    step = np.median(steps)
+    if np.allclose(steps, step, rtol=0.01):
+        return temps, signal
+    grid = np.arange(temps[0], temps[-1] + step / 2, step)
+    return grid, np.interp(grid, temps, signal)
+
+
+def estimate_tm(temps, curves, window=3.0, polyorder=3, temp_min=None, temp_max=None):
+    """
+    Tm at the maximum of the smoothed first derivative.
+
+    `curves` may be a single curve or a stack of curves (n_curves x n_temps)
+    on the same evenly spaced grid; `window` is the smoothing window in °C.
+    Half a window at either end is excluded, where the Savitzky-Golay
+    derivative is unreliable. The peak position is refined with a parabola
+    through the three points around the maximum.
+    """
+    temps = np.asarray(temps, dtype=float)
+    curves = np.asarray(curves, dtype=float)
+    step = temps[1] - temps[0]
+    points = _window_points(window, step, temps.size, polyorder)
+    deriv = savgol_filter(curves, points, polyorder, deriv=1, delta=step, axis=-1)
+
+    mask = np.zeros(temps.size, dtype=bool)
+    mask[points // 2: temps.size - points // 2] = True
+    if temp_min is not None:
+        mask &= temps >= temp_min
+    if temp_max is not None:
+        mask &= temps <= temp_max
+    if not mask.any():
+        raise ValueError(f"No data points between {temp_min} and {temp_max} °C.")
+    deriv = np.where(mask, deriv, -np.inf)
+
+    idx = np.argmax(deriv, axis=-1)
+    idx = np.clip(idx, 1, temps.size - 2)
+    y0 = np.take_along_axis(deriv, np.expand_dims(idx - 1, -1), axis=-1)[..., 0]
+    y1 = np.take_along_axis(deriv, np.expand_dims(idx, -1), axis=-1)[..., 0]
+    y2 = np.take_along_axis(deriv, np.expand_dims(idx + 1, -1), axis=-1)[..., 0]
+    denom = y0 - 2 * y1 + y2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where(np.isfinite(denom) & (denom != 0), 0.5 * (y0 - y2) / denom, 0.0)
+    return temps[idx] + np.clip(offset, -0.5, 0.5) * step
+
+
+def smoothed_derivative(temps, curves, window=3.0, polyorder=3):
+    """
+    Savitzky-Golay first derivative of one curve or a stack of curves
+    (n_curves x n_temps) sharing one temperature axis.
+
+    Unevenly spaced curves are differentiated on an even grid and
+    interpolated back onto the original temperatures.
+    """
+    temps = np.asarray(temps, dtype=float)
+    curves = np.atleast_2d(np.asarray(curves, dtype=float))
+    grid, _ = uniform_grid(temps, temps)
+    if grid.size != temps.size or not np.allclose(grid, temps):
+        even = np.vstack([np.interp(grid, temps, curve) for curve in curves])
+    else:
+        even = curves
+    step = grid[1] - grid[0]
+    points = _window_points(window, step, grid.size, polyorder)
+    deriv = savgol_filter(even, points, polyorder, deriv=1, delta=step, axis=-1)
+    if even is not curves:
+        deriv = np.vstack([np.interp(temps, grid, d) for d in deriv])
+    return deriv
+
+
+def bootstrap_tm(temps, signal, seed, n_boot=1000, window=3.0, polyorder=3,
+                 temp_min=None, temp_max=None):
+    """
+    Residual bootstrap of a single melting curve.
+
+    All resamples are drawn at once as an (n_boot x n_temps) array, so every
+    Tm re-estimate is one vectorized smoothing/derivative pass.
+    Returns the point estimate and the Tm of every resample.
+    """
+    temps, signal = uniform_grid(temps, signal)
+    points = _window_points(window, temps[1] - temps[0], temps.size, polyorder)
+    smooth = savgol_filter(signal, points, polyorder)
+    residuals = signal - smooth
+
+    rng = np.random.default_rng(seed)
+    resamples = smooth + residuals[rng.integers(0, residuals.size, size=(n_boot, residuals.size))]
+
+    tm = float(estimate_tm(temps, signal, window, polyorder, temp_min, temp_max))
+    boot_tms = estimate_tm(temps, resamples, window, polyorder, temp_min, temp_max)
+    return tm, boot_tms
+
+
+def _bootstrap_entry(entry, seed, **kwargs):
+    """Worker wrapper around `bootstrap_tm` for one (temps, signal) pair."""
+    temps, signal = entry
+    return bootstrap_tm(temps, signal, seed, **kwargs)
+
+
+@stage('bootstrap')
+def bootstrap_tm_table(entries, n_boot=1000, ci=95, window=3.0, polyorder=3,
+                       temp_min=None, temp_max=None, reference=None,
+                       workers=None, seed=None):
+    """
+    Bootstrap Tm for many wells/capillaries across a process pool.
+
+    entries: list of (label, temps, signal)
+    reference: label of the well/capillary that ΔTm is reported against
+
+    Returns a DataFrame with Tm, its confidence interval and, if a reference
+    is given, ΔTm with a confidence interval from the paired bootstrap
+    distributions.
+    """
+    if not entries:
+        raise ValueError("No curves given for the Tm bootstrap.")
+    labels = [str(label) for label, _, _ in entries]
+    if reference is not None and str(reference) not in labels:
+        raise KeyError(f"Reference '{reference}' not found. Available: {labels}")
+
+    seeds = np.random.SeedSequence(seed).spawn(len(entries))
+    worker = partial(_bootstrap_entry, n_boot=n_boot, window=window, polyorder=polyorder,
+                     temp_min=temp_min, temp_max=temp_max)
+    chunksize = max(1, len(entries) // (4 * (workers or 8)))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(worker,
+                                [(temps, signal) for _, temps, signal in entries],
+                                seeds,
+                                chunksize=chunksize))
+
+    lower_q = (100 - ci) / 2
+    upper_q = 100 - lower_q
+    boot_tms = np.vstack([tms for _, tms in results])
+    ci_low, ci_high = np.percentile(boot_tms, [lower_q, upper_q], axis=1)
+
+    table = pd.DataFrame({
+        'Sample': labels,
+        'Tm': [tm for tm, _ in results],
+        'Tm_CI_Low': ci_low,
+        'Tm_CI_High': ci_high,
+        'Tm_Std': boot_tms.std(axis=1, ddof=1),
+    })
+
+    if reference is not None:
+        ref_idx = labels.index(str(reference))
+        delta = boot_tms - boot_tms[ref_idx]
+        d_low, d_high = np.percentile(delta, [lower_q, upper_q], axis=1)
+        table['dTm'] = table['Tm'] - table['Tm'].iloc[ref_idx]
+        table['dTm_CI_Low'] = d_low
+        table['dTm_CI_High'] = d_high
+        # The reference against itself is exactly zero
+        table.loc[ref_idx, ['dTm_CI_Low', 'dTm_CI_High']] = 0.0
+
+    return table
+
+
+def log_tm_table(table, ci=95):
+    """Log one 'Tm ± CI' line per well/capillary."""
+    for _, row in table.iterrows():
+        msg = (f"{row['Sample']}: Tm = {row['Tm']:.2f} °C "
+               f"({ci:g}% CI {row['Tm_CI_Low']:.2f}–{row['Tm_CI_High']:.2f})")
+        if 'dTm' in table.columns:
+            msg += (f", ΔTm = {row['dTm']:+.2f} °C "
+                    f"({row['dTm_CI_Low']:+.2f}–{row['dTm_CI_High']:+.2f})")
+        logging.info(msg)
+
+
+def bootstrap_params(cfg):
+    """Read the optional BOOTSTRAP block of a YAML config (None if disabled)."""
+    params = cfg.get('BOOTSTRAP', None)
+    if not params:
+        return None
+    if params is True:
+        params = {}
+    return {
+        'n_boot': int(params.get('N_BOOT', 1000)),
+        'ci': float(params.get('CI', 95)),
+        'window': float(params.get('SMOOTH_WINDOW', 3.0)),
+        'polyorder': int(params.get('POLYORDER', 3)),
+        'reference': params.get('REFERENCE', None),
+        'workers': params.get('WORKERS', None),
+        'seed': params.get('SEED', None),
+    }
+
+
+def decimate(temps, signal, points=200):
+    """Average a curve down to at most `points` bins (keeps the curve shape, drops noise)."""
+    temps = np.asarray(temps, dtype=float)
+    signal = np.asarray(signal, dtype=float)
+    mask = np.isfinite(temps) & np.isfinite(signal)
+    temps, signal = temps[mask], signal[mask]
+    if temps.size <= points:
+        return temps, signal
+    edges = np.linspace(0, temps.size, points + 1).astype(int)[:-1]
+    counts = np.diff(np.append(edges, temps.size))
+    return np.add.reduceat(temps, edges) / counts, np.add.reduceat(signal, edges) / counts
+
+
+def _report_page_figure(page, grid, temp_range, title):
+    """
+    Figure of one report page (A4 landscape).
+
+    page: list of (label, temps, signal, tm) for at most rows x cols panels
+    """
+    # Imported here so that the workers never touch pyplot's global state
+    from matplotlib.collections import LineCollection
+    from matplotlib.figure import Figure
+
+    n_rows, n_cols = grid
+    t_lo, t_hi = temp_range
+    t_span = (t_hi - t_lo) or 1.0
+
+    fig = Figure(figsize=(11.69, 8.27))
+    ax = fig.add_axes([0.04, 0.04, 0.94, 0.90])
+
+    curves, markers = [], []
+    for idx, (label, temps, signal, tm) in enumerate(page):
+        row, col = divmod(idx, n_cols)
+        y0 = n_rows - 1 - row
+        s_lo, s_hi = np.nanmin(signal), np.nanmax(signal)
+        s_span = (s_hi - s_lo) or 1.0
+        x = col + 0.05 + 0.9 * (temps - t_lo) / t_span
+        y = y0 + 0.08 + 0.72 * (signal - s_lo) / s_span
+        curves.append(np.column_stack([x, y]))
+        ax.text(col + 0.04, y0 + 0.96, str(label), fontsize=5, va='top', ha='left', clip_on=True)
+        if tm is not None and np.isfinite(tm):
+            x_tm = col + 0.05 + 0.9 * (tm - t_lo) / t_span
+            markers.append([(x_tm, y0 + 0.05), (x_tm, y0 + 0.82)])
+            ax.text(col + 0.96, y0 + 0.04, f"{tm:.1f}", fontsize=5, va='bottom', ha='right',
+                    color='tab:red')
+
+    ax.add_collection(LineCollection(curves, colors='black', linewidths=0.5))
+    ax.add_collection(LineCollection(markers, colors='tab:red', linewidths=0.6, linestyles='dashed'))
+
+    ax.set_xlim(0, n_cols)
+    ax.set_ylim(0, n_rows)
+    # Panels are in input order, not plate positions: grid lines only, no row/column labels
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.set_xticks(np.arange(n_cols + 1), minor=True)
+    ax.set_yticks(np.arange(n_rows + 1), minor=True)
+    ax.tick_params(which='both', length=0)
+    ax.grid(which='minor', color='0.8', linewidth=0.5)
+    ax.set_title(title, fontsize=8, loc='left', pad=4)
+    fig.text(0.04, 0.015, f"Each panel: {t_lo:.1f}–{t_hi:.1f} °C, signal scaled per panel; "
+             f"dashed line and red number: Tm [°C]", fontsize=6)
+    return fig
+
+
+def _page_worker(args, grid, temp_range, dpi):
+    """Draw one page and save it as a PNG tile; runs in a worker process."""
+    page, title, output_file = args
+    _report_page_figure(page, grid, temp_range, title).savefig(output_file, dpi=dpi)
+    return output_file
+
+
+@stage('report')
+def render_plate_report(entries, output_path, grid=(8, 12), fmt='pdf', points=200,
+                        dpi=150, workers=None, temp_min=None, temp_max=None):
+    """
+    Small-multiples report with one mini-panel per sample/capillary, in the order of `entries`.
+
+    entries: list of (label, temps, signal, tm); tm may be None
+    Pages of rows x cols panels are written either as one multi-page PDF
+    (vector, drawn page by page) or as one PNG tile per page (at `dpi`,
+    rendered in parallel worker processes). Returns the list of written files.
+    """
+    if not entries:
+        raise ValueError("No curves given for the plate report.")
+    fmt = fmt.lower()
+    if fmt not in ('pdf', 'png'):
+        raise ValueError(f"Report FORMAT must be 'pdf' or 'png', not '{fmt}'.")
+    n_rows, n_cols = (int(g) for g in grid)
+    per_page = n_rows * n_cols
+
+    decimated = []
+    for label, temps, signal, tm in entries:
+        temps = np.asarray(temps, dtype=float)
+        signal = np.asarray(signal, dtype=float)
+        mask = np.ones_like(temps, dtype=bool)
+        if temp_min is not None:
+            mask &= temps >= temp_min
+        if temp_max is not None:
+            mask &= temps <= temp_max
+        t, s = decimate(temps[mask], signal[mask], points)
+        decimated.append((label, t, s, tm))
+
+    t_lo = temp_min if temp_min is not None else min(np.nanmin(t) for _, t, _, _ in decimated)
+    t_hi = temp_max if temp_max is not None else max(np.nanmax(t) for _, t, _, _ in decimated)
+
+    output_path = Path(output_path)
+    pages = [decimated[i:i + per_page] for i in range(0, len(decimated), per_page)]
+    titles = [f"{output_path.stem} – page {i + 1}/{len(pages)}" for i in range(len(pages))]
+
+    if fmt == 'pdf':
+        from matplotlib.backends.backend_pdf import PdfPages
+
+        with stage('render'):
+            figures = [_report_page_figure(page, (n_rows, n_cols), (t_lo, t_hi), title)
+                       for page, title in zip(pages, titles)]
+        out = output_path.with_suffix('.pdf')
+        with stage('save'), PdfPages(out) as pdf:
+            for fig in figures:
+                pdf.savefig(fig)
+        written = [out]
+    else:
+        outs = [output_path.with_name(f"{output_path.stem}_page{idx:02d}.png") for idx in range(1, len(pages) + 1)]
+        worker = partial(_page_worker, grid=(n_rows, n_cols), temp_range=(t_lo, t_hi), dpi=dpi)
+        # Every worker saves its own tile
+        with stage('render'), ProcessPoolExecutor(max_workers=workers) as pool:
+            written = list(pool.map(worker, zip(pages, titles, outs)))
+
+    for out in written:
+        logging.info("Written plate report to %s", out)
+    return written
+
+
+def report_params(cfg, default_grid):
+    """Read the optional REPORT block of a YAML config (None if disabled)."""
+    params = cfg.get('REPORT', None)
+    if not params:
+        return None
+    if params is True:
+        params = {}
+    return {
+        'grid': tuple(params.get('GRID', default_grid)),
+        'fmt': params.get('FORMAT', 'pdf'),
+        'points': int(params.get('POINTS', 200)),
+        'dpi': int(params.get('DPI', 150)),
+        'workers': params.get('WORKERS', None),
+        'name': params.get('NAME', None),
+    }
@@ -1,13 +1,18 @@
 import yaml
 import logging
 import numpy as np
-import matplotlib.pyplot as plt
+import matplotlib as mpl
 import pandas as pd
 import argparse
+import sys
 from pathlib import Path
 
+from labscripthub.instrument import stage
+from labscripthub.render import new_figure, plot_style, styled
+
 logging.basicConfig( level=logging.INFO, format='[%(levelname)s] %(message)s')
 
+@stage('read')
 def read_data(filename):
     """Read data from .xlsx"""
     df_overview    = pd.read_excel(filename, sheet_name='Overview', header=0)
@@ -15,10 +20,8 @@ def read_data(filename):
     df_first_deriv = pd.read_excel(filename, sheet_name='Ratio (1st deriv.)', header=0)
     return df_overview, df_ratio, df_first_deriv
 
-def apply_seaborn_style(param_dict):
-    import seaborn as sns
-    sns.set_theme(**param_dict)
 
+@stage('compute')
 def filter_data(df_ratio, df_first_deriv, capillary_list):
     """Filter and extract arrays for specified capillaries"""
     # Clean column names
@@ -35,37 +38,54 @@ def filter_data(df_ratio, df_first_deriv, capillary_list):
         data[cap_str] = (temps, ratio_vec, deriv_vec)
     return data
 
-def plot_combined(data_entries, output_path, temp_min=None, temp_max=None):
+def derivative_tm(temps, deriv, temp_min=None, temp_max=None):
+    """Tm at the maximum of the exported first derivative (None if out of range)"""
+    mask = np.isfinite(temps) & np.isfinite(deriv)
+    if temp_min is not None:
+        mask &= (temps >= temp_min)
+    if temp_max is not None:
+        mask &= (temps <= temp_max)
+    if not mask.any():
+        return None
+    return float(temps[mask][np.argmax(deriv[mask])])
+
+def plot_combined(data_entries, output_path, temp_min=None, temp_max=None, style=None):
     """Plot all entries on a single figure, respecting optional colors"""
-    fig, axes = plt.subplots(2, 1, sharex=True)
-    default_colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    with styled(style):
+        _plot_combined(data_entries, output_path, temp_min, temp_max)
+
+def _plot_combined(data_entries, output_path, temp_min, temp_max):
+    with stage('render'):
+        fig = new_figure()
+        axes = fig.subplots(2, 1, sharex=True)
+        default_colors = mpl.rcParams['axes.prop_cycle'].by_key()['color']
 
-    for idx, (temps, ratio, deriv, label, color) in enumerate(data_entries):
-        # Apply temperature bounds
-        mask = np.ones_like(temps, dtype=bool)
-        if temp_min is not None:
-            mask &= (temps >= temp_min)
-        if temp_max is not None:
-            mask &= (temps <= temp_max)
-        t, r, d = temps[mask], ratio[mask], deriv[mask]
+        for idx, (temps, ratio, deriv, label, color) in enumerate(data_entries):
+            # Apply temperature bounds
+            mask = np.ones_like(temps, dtype=bool)
+            if temp_min is not None:
+                mask &= (temps >= temp_min)
+            if temp_max is not None:
+                mask &= (temps <= temp_max)
+            t, r, d = temps[mask], ratio[mask], deriv[mask]
 
-        # choose color: explicit or default palette
-        plot_color = color if color else default_colors[idx % len(default_colors)]
+            # choose color: explicit or default palette
+            plot_color = color if color else default_colors[idx % len(default_colors)]
 
-        axes[0].plot(t, r, linewidth=0.7, color=plot_color)
-        axes[1].plot(t, d, linewidth=0.7, color=plot_color, label=label)
+            axes[0].plot(t, r, linewidth=0.7, color=plot_color)
+            axes[1].plot(t, d, linewidth=0.7, color=plot_color, label=label)
 
-    axes[0].set_ylabel('Ratio 350 nm / 330 nm')
-    axes[1].set_xlabel('Temperature [°C]')
-    axes[1].set_ylabel('First Derivative')
-    axes[1].set_yticks([])
-    axes[1].legend(fontsize=7)
+        axes[0].set_ylabel('Ratio 350 nm / 330 nm')
+        axes[1].set_xlabel('Temperature [°C]')
+        axes[1].set_ylabel('First Derivative')
+        axes[1].set_yticks([])
+        axes[1].legend(fontsize=7)
 
-    plt.subplots_adjust(hspace=0)
-    fig.align_ylabels(axes[:])
+        fig.subplots_adjust(hspace=0)
+        fig.align_ylabels(axes[:])
 
-    plt.savefig(output_path, dpi=600, bbox_inches='tight')
-    plt.close(fig)
+    with stage('save'):
+        fig.savefig(output_path, dpi=600, bbox_inches='tight')
 
 
 def main(yaml_config):
@@ -74,9 +94,8 @@ def main(yaml_config):
         cfg = yaml.safe_load(f)
 
     seaborn_flag = cfg.get('USE_SEABORN', False)
-    if seaborn_flag:
-        seaborn_params = cfg.get('SEABORN_PARAMS', {"style": "ticks", "context": "paper"})
-        apply_seaborn_style(seaborn_params)
+    seaborn_params = cfg.get('SEABORN_PARAMS', {"style": "ticks", "context": "paper"}) if seaborn_flag else None
+    style = plot_style(seaborn=seaborn_params)
 
     file_entries = cfg.get('FILES', [])
     if not file_entries:
@@ -119,7 +138,38 @@ def main(yaml_config):
                 label = f"{Path(fn).stem}_Cap{cap_str}"
             combined_entries.append((temps, ratio, deriv, label, color))
 
-    plot_combined(combined_entries, output_path, temp_min, temp_max)
+    plot_combined(combined_entries, output_path, temp_min, temp_max, style=style)
+
+    # Optional: bootstrap confidence intervals for Tm and plate report
+    boot_flag = cfg.get('BOOTSTRAP', False)
+    report_flag = cfg.get('REPORT', False)
+    if not (boot_flag or report_flag):
+        return
+    sys.path.append(str(Path(__file__).resolve().parents[1]))
+    import dsf_common
+
+    tm_values = None
+    if boot_flag:
+        boot_params = dsf_common.bootstrap_params(cfg)
+        tm_entries = [(label, temps, ratio) for temps, ratio, _, label, _ in combined_entries]
+        tm_table = dsf_common.bootstrap_tm_table(tm_entries, temp_min=temp_min, temp_max=temp_max, **boot_params)
+        dsf_common.log_tm_table(tm_table, boot_params['ci'])
+        tm_path = output_folder / f"{Path(output_name).stem}_tm.csv"
+        with stage('save'):
+            tm_table.to_csv(tm_path, index=False)
+        logging.info("Written Tm table to %s", tm_path)
+        tm_values = tm_table['Tm'].to_list()
+
+    if report_flag:
+        params = dsf_common.report_params(cfg, default_grid=(4, 12))
+        report_name = params.pop('name') or f"{Path(output_name).stem}_report"
+        if tm_values is None:
+            tm_values = [derivative_tm(temps, deriv, temp_min, temp_max)
+                         for temps, _, deriv, _, _ in combined_entries]
+        report_entries = [(label, temps, ratio, tm)
+                          for (temps, ratio, _, label, _), tm in zip(combined_entries, tm_values)]
+        dsf_common.render_plate_report(report_entries, output_folder / report_name,
+                                       temp_min=temp_min, temp_max=temp_max, **params)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import pandas as pd
 import yaml
 import argparse
@@ -7,6 +6,9 @@ import sys
 from pathlib import Path
 import matplotlib as mpl
 
+from labscripthub.instrument import stage
+from labscripthub.render import new_figure, plot_style, styled
+
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 
 uv_colors = {
@@ -15,10 +17,16 @@ uv_colors = {
     "UV_230": "tab:red",
 }
 
-def apply_seaborn_style(param_dict):
-    import seaborn as sns
-    sns.set_theme(**param_dict)
+@stage('read')
+def read_export(fn):
+    """ÄKTA export (UTF-16 tab-separated, or UTF-8 comma-separated) as a data frame"""
+    try:
+        return pd.read_csv(fn, header=2, delimiter='\t', encoding='UTF-16')
+    except UnicodeDecodeError as e:
+        logging.info(f"Error reading file {fn}: {e} with encoding UTF-16. Trying UTF-8.")
+        return pd.read_csv(fn, header=2, delimiter=',', encoding='UTF-8')
 
+@stage('read')
 def get_columns(fn, what_to_plot):
     """
     Gets the column index where the requested data is stored in the file.
@@ -83,14 +91,21 @@ def compute_plot_order(what_to_plot):
     non_uv = [t for t in what_to_plot if not t.startswith("UV_")]
     return non_uv + uv[::-1]
 
-def plot_run(input_list, global_params):
+def plot_run(input_list, global_params, style=None):
     """
     input_list: list of (Path or filename, list of plot_type strings,
                         fraction groups, color, uv_offset_override,
                         scaling_factor, legend_label)
     """
-    
-    fig, ax_left = plt.subplots(figsize=global_params['fig_size'])
+    with styled(style):
+        fig = _plot_run(input_list, global_params)
+        with stage('save'):
+            fig.savefig(global_params['output_name'], dpi=600)
+
+@stage('render')
+def _plot_run(input_list, global_params):
+    fig = new_figure(figsize=global_params['fig_size'])
+    ax_left = fig.add_subplot(111)
     ax_right = ax_left.twinx()
 
     plotted_on_left = False
@@ -102,11 +117,7 @@ def plot_run(input_list, global_params):
 
     for fn, what_to_plot, fraction_group, file_color, file_uv_offset, scaling_factor, legend_label in input_list:
         logging.info(f"Processing file: {fn}")
-        try:
-            df = pd.read_csv(fn, header=2, delimiter='\t', encoding='UTF-16')
-        except UnicodeDecodeError as e:
-            logging.info(f"Error reading file {fn}: {e} with encoding UTF-16. Trying UTF-8.")
-            df = pd.read_csv(fn, header=2, delimiter=',', encoding='UTF-8')
+        df = read_export(fn)
 
         what_to_plot_sorted = compute_plot_order(what_to_plot)
         print(f"Plotting in order: {what_to_plot_sorted}")
@@ -260,8 +271,8 @@ def plot_run(input_list, global_params):
 
     ax_left.xaxis.set_minor_locator(mpl.ticker.MultipleLocator(10))
     ax_left.tick_params(axis='y', which='both', left=True, labelleft=True)
-    plt.tight_layout()
-    plt.savefig(global_params['output_name'], dpi=600)
+    fig.tight_layout()
+    return fig
 
 
 def make_output_name(output_folder, output_name):
@@ -283,9 +294,8 @@ def main(yaml_config):
 
 
     seaborn_flag = cfg.get('USE_SEABORN', False)
-    if seaborn_flag:
-        seaborn_params = cfg.get('SEABORN_PARAMS', {"style": "ticks", "context": "paper"})
-        apply_seaborn_style(seaborn_params)
+    seaborn_params = cfg.get('SEABORN_PARAMS', {"style": "ticks", "context": "paper"}) if seaborn_flag else None
+    style = plot_style(seaborn=seaborn_params)
 
     file_entries = cfg.get('FILES', [])
     if not file_entries:
@@ -361,7 +371,7 @@ def main(yaml_config):
             )
         )
 
-    plot_run(all_plot_data, global_params)
+    plot_run(all_plot_data, global_params, style=style)
 
         
 
@@ -0,0 +1,270 @@
+"""
+Batch engine shared by the ITC figure GUIs (PySide6 and Tk).
+
+The workers and the pool live here, free of any GUI toolkit: a GUI creates a
+pool with `start_pool()`, wraps its files in a `Batch` and calls
+`Batch.run()` from a background thread. Every file is reported through the
+`on_file(row, status, message)` callback, which is called from that thread;
+the GUI marshals it to its own event loop (a Qt signal, Tk `after()`).
+
+Final figures (600 dpi) are kept in the labscripthub output cache (capped by
+$LABSCRIPTHUB_CACHE_MB, least recently used first out), keyed by the hash of
+the CSV and of the options: exporting an unchanged file again only copies the
+cached PNG. Previews are rendered at low dpi into memory by `preview_file()`.
+"""
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import pandas as pd
+
+import itc_final_figure
+from itc_final_figure import plot_itc
+import labscripthub.render
+from labscripthub.cache import OutputCache
+from labscripthub.instrument import stage
+from labscripthub.render import new_figure, plot_style
+
+SEABORN_PARAMS = {"style": "ticks", "context": "paper"}
+PREVIEW_DPI = 100
+EXPORT_DPI = 600
+# Hash of the plotting code and figure cache (per worker process)
+_code_hash = None
+_cache = None
+
+def init_worker() -> None:
+    """
+    Pool initializer: pay the plotting start-up cost once per worker.
+
+    Selects the Agg backend, imports matplotlib (and seaborn, if installed)
+    and renders one throw-away figure so fonts and the renderer are loaded
+    before the first real file arrives.
+    """
+    import matplotlib
+    matplotlib.use("Agg", force=True)
+
+    try:
+        plot_style(seaborn=SEABORN_PARAMS)  # imports seaborn (optional; only needed for the seaborn style)
+    except ImportError:
+        pass
+    fig = new_figure(figsize=(1, 1))
+    fig.text(0.5, 0.5, "0")
+    fig.canvas.draw()
+
+def warm_up() -> int:
+    """No-op task; submitting one per worker starts all processes right away."""
+    return os.getpid()
+
+def export_key(csv_bytes: bytes, **options) -> str:
+    """
+    Cache key of a final figure: hash of the CSV and of the options.
+
+    The plotting code is part of the options, so editing itc_final_figure.py
+    or the figure style (labscripthub/render.py) invalidates the cache.
+    """
+    global _code_hash
+    if _code_hash is None:
+        code = hashlib.sha256()
+        for module in (itc_final_figure, labscripthub.render):
+            code.update(Path(module.__file__).read_bytes())
+        _code_hash = code.hexdigest()
+    options = json.dumps({**options, "code": _code_hash}, sort_keys=True)
+    return (hashlib.sha256(csv_bytes).hexdigest()[:32]
+            + hashlib.sha256(options.encode()).hexdigest()[:16])
+
+def render(csv_bytes: bytes, output, sep: str, dec: str, energy: str, use_seaborn: bool, dpi: int) -> None:
+    """Draw the ITC figure of an in-memory CSV into a path or buffer."""
+    with stage('read'):
+        df = pd.read_csv(io.BytesIO(csv_bytes), sep=sep, decimal=dec)
+    plot_itc(df, output, energy_unit=energy, dpi=dpi, style=plot_style(seaborn=SEABORN_PARAMS if use_seaborn else None))
+
+def preview_file(fp: Path,
+                 sep: str,
+                 dec: str,
+                 energy: str,
+                 use_seaborn: bool,
+                 dpi: int = PREVIEW_DPI) -> bytes:
+    """Low-dpi PNG of one CSV, rendered in memory for display in a GUI."""
+    buffer = io.BytesIO()
+    render(Path(fp).read_bytes(), buffer, sep, dec, energy, use_seaborn, dpi)
+    return buffer.getvalue()
+
+def process_file(fp: Path,
+                 sep: str,
+                 dec: str,
+                 energy: str,
+                 out_folder: Path | None,
+                 use_seaborn: bool) -> str:
+    """
+    Read one CSV, make the ITC figure and return the path of the PNG.
+    Defined at top level so it can be pickled by multiprocessing on Windows.
+    The 600-dpi figure is only drawn when it is not in the cache yet.
+    """
+    with stage('read'):
+        csv_bytes = Path(fp).read_bytes()
+    out_path = (out_folder or fp.parent) / f"{fp.stem}.png"
+    key = export_key(csv_bytes, sep=sep, dec=dec, energy=energy, use_seaborn=use_seaborn, dpi=EXPORT_DPI)
+    global _cache
+    if _cache is None:
+        _cache = OutputCache()
+    outputs = _cache.lookup(key)
+    if outputs is not None:
+        with stage('save'):
+            _cache.restore([{**outputs[0], "path": str(out_path)}])
+    else:
+        # Write under a temporary name so a reader never sees a partial PNG
+        tmp_path = out_path.with_name(f"{out_path.name}.{os.getpid()}.tmp")
+        render(csv_bytes, tmp_path, sep, dec, energy, use_seaborn, EXPORT_DPI)
+        os.replace(tmp_path, out_path)
+        with stage('save'):
+            _cache.store(key, [out_path], base=out_path.parent)
+    _cache.save_index()
+    return str(out_path)
+
+def start_pool(workers: int | None = None) -> ProcessPoolExecutor:
+    """A pool of warmed-up workers; returns at once, the processes start in the background."""
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+    for _ in range(workers):
+        pool.submit(warm_up)
+    return pool
+
+
+class Batch:
+    """
+    One batch of files on a (long-lived) pool.
+
+    `run()` blocks until every file is done, failed or cancelled, so call it
+    from a background thread; `cancel()` may be called from any thread.
+    A failing file does not stop the batch. `broken` is set when a worker
+    process died, after which the pool must be replaced.
+    """
+
+    def __init__(self, pool: ProcessPoolExecutor, worker, file_paths: list[Path]) -> None:
+        self._pool = pool
+        self._worker = worker
+        self._file_paths = list(file_paths)
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self.broken = False
+
+    def cancel(self) -> None:
+        """Cancel all files that have not started yet; running ones finish."""
+        with self._lock:
+            self._cancelled = True
+            for fut in self._futures:
+                fut.cancel()
+
+    def run(self, on_file) -> None:
+        """Process all files; on_file(row, status, message) with status "done", "failed" or "cancelled"."""
+        with self._lock:
+            if self._cancelled:
+                for row in range(len(self._file_paths)):
+                    on_file(row, "cancelled", "")
+                return
+            try:
+                self._futures = {self._pool.submit(self._worker, fp): row
+                                 for row, fp in enumerate(self._file_paths)}
+            except BrokenProcessPool as exc:
+                self.broken = True
+                for row in range(len(self._file_paths)):
+                    on_file(row, "failed", f"worker pool is broken ({exc})")
+                return
+        for fut in as_completed(self._futures):
+            row = self._futures[fut]
+            if fut.cancelled():
+                on_file(row, "cancelled", "")
+                continue
+            try:
+                on_file(row, "done", fut.result())
+            except BrokenProcessPool as exc:
+                # A worker died (e.g. out of memory); the GUI starts a new pool
+                self.broken = True
+                on_file(row, "failed", f"worker process died ({exc})")
+            except Exception as exc:
+                on_file(row, "failed", str(exc))
+
+def main(yaml_config: Path) -> None:
+    """Export the final figures of many CSVs (FILES: paths or globs) through the figure cache."""
+    import glob
+    import logging
+    from functools import partial
+
+    import yaml
+
+    with open(yaml_config, "r") as f:
+        cfg = yaml.safe_load(f)
+
+    # Required
+    patterns = cfg.get("FILES", [])
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    if not patterns:
+        raise ValueError("Config YAML must contain a 'FILES' list with at least one path or glob.")
+    # Optional
+    delimiter     = cfg.get("DELIMITER", ",")
+    decimal       = cfg.get("DECIMAL", ".")
+    energy_unit   = cfg.get("ENERGY_UNIT", "kcal / mol")
+    use_seaborn   = cfg.get("USE_SEABORN", False)
+    output_folder = Path(cfg["OUTPUT_FOLDER"]) if "OUTPUT_FOLDER" in cfg else None
+    workers       = cfg.get("WORKERS", None)
+
+    files = [Path(p) for pattern in patterns for p in sorted(glob.glob(str(pattern)))]
+    if not files:
+        raise ValueError(f"No files match {patterns}.")
+    if output_folder is not None:
+        output_folder.mkdir(parents=True, exist_ok=True)
+    worker = partial(process_file, sep=delimiter, dec=decimal, energy=energy_unit,
+                     out_folder=output_folder, use_seaborn=use_seaborn)
+
+    failed = 0
+    def on_file(row: int, status: str, message: str) -> None:
+        nonlocal failed
+        if status == "done":
+            logging.info(f"{files[row]} -> {message}")
+        else:
+            failed += 1
+            logging.error(f"{files[row]}: {status} {message}")
+
+    if workers == 1 or len(files) == 1:
+        # A pool costs more than it saves for a single file
+        for row, fp in enumerate(files):
+            try:
+                on_file(row, "done", worker(fp))
+            except Exception as exc:
+                on_file(row, "failed", str(exc))
+    else:
+        # The figures are drawn in the workers
+        with stage('export'):
+            pool = start_pool(workers)
+            try:
+                Batch(pool, worker, files).run(on_file)
+            finally:
+                pool.shutdown()
+    logging.info(f"Exported {len(files) - failed} figure(s); {failed} failed.")
+
+if __name__ == "__main__":
+    import argparse
+    import logging
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Export ITC final figures of many CSV files per a YAML config.")
+    parser.add_argument("yaml_config",
+                        nargs="?",
+                        default=None,
+                        help="Path to the YAML configuration file (default: ./batch_input.yaml)")
+
+    args = parser.parse_args()
+    if args.yaml_config is None:
+        logging.info("No YAML config provided, using default: ./batch_input.yaml")
+        args.yaml_config = "./batch_input.yaml"  # Default config file
+
+    main(args.yaml_config)
@@ -1,17 +1,15 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
 from pathlib import Path
 import yaml
 import argparse
 import logging
 
-logging.basicConfig( level=logging.INFO, format='[%(levelname)s] %(message)s')
+from labscripthub.instrument import stage
+from labscripthub.render import new_figure, plot_style, styled
 
+logging.basicConfig( level=logging.INFO, format='[%(levelname)s] %(message)s')
 
-def apply_seaborn_style(param_dict):
-    import seaborn as sns
-    sns.set_theme(**param_dict)
 
 def round_up_to_half(x):
 
@@ -23,37 +21,85 @@ def round_up_to_half(x):
         arr = np.asarray(x)
         return np.ceil(arr * 2) / 2
 
-def get_visible_label_boxes(axis):
-    # Returns a list of (label_text, bounding_box) for visible y-tick labels
-    boxes = []
-    yticks = axis.get_yticks()
-    yticklabels = axis.get_yticklabels()
-    ymin, ymax = axis.get_ylim()
-    renderer = plt.gcf().canvas.get_renderer()
-    for tick, label in zip(yticks, yticklabels):
-        if ymin <= tick <= ymax and label.get_text().strip():
-            bbox = label.get_window_extent(renderer=renderer)
-            boxes.append((label.get_text(), bbox))
-    return boxes
-
-def bboxes_overlap(bbox1, bbox2, padding=2):
-    # Simple overlap test (with optional small padding)
-    return not (bbox1.x1 + padding < bbox2.x0 or
-                bbox1.x0 - padding > bbox2.x1 or
-                bbox1.y1 + padding < bbox2.y0 or
-                bbox1.y0 - padding > bbox2.y1)
-
-def has_overlap(ax, index1, index2):
-    boxes1 = get_visible_label_boxes(ax[index1])
-    boxes2 = get_visible_label_boxes(ax[index2])
-    # Check if any bounding boxes overlap
-    for label1, bbox1 in boxes1:
-        for label2, bbox2 in boxes2:
-            if bboxes_overlap(bbox1, bbox2):
-                return True
-    return False
-
-def plot_itc(df, output, energy_unit):
+# Minimum gap in pixels between tick labels of stacked axes
+LABEL_PADDING = 2
+
+def tick_label_height(ax, renderer):
+    # Height in pixels of one y tick label (all labels of an axis share the font).
+    # One text layout, no canvas draw.
+    from matplotlib.text import Text
+    font = ax.yaxis.get_major_ticks()[0].label1.get_fontproperties()
+    return Text(0, 0, "0", fontproperties=font, figure=ax.figure).get_window_extent(renderer).height
+
+def label_gap(ax, limits, side):
+    # Pixels between the lowest ("bottom") or highest ("top") visible y tick of ax
+    # and that edge of the axes, for the given y-limits. The tick locator is
+    # queried directly, so nothing is rendered.
+    ymin, ymax = limits
+    ticks = np.asarray(ax.yaxis.get_major_locator().tick_values(ymin, ymax))
+    ticks = ticks[(ticks >= ymin) & (ticks <= ymax)]
+    if ticks.size == 0:
+        return np.inf
+    edge = ticks.min() - ymin if side == "bottom" else ymax - ticks.max()
+    return ax.get_window_extent().height * edge / (ymax - ymin)
+
+def fit_top_limit(ax, limits, gap_needed, max_iter=20):
+    # Smallest upper y-limit that leaves gap_needed pixels above the highest
+    # visible tick. A larger range can bring in a new, higher tick, so the
+    # limit is solved again for that tick until it is stable.
+    ymin, ymax = limits
+    height = ax.get_window_extent().height
+    fraction = min(gap_needed / height, 0.45)
+    for _ in range(max_iter):
+        if label_gap(ax, (ymin, ymax), "top") >= gap_needed:
+            break
+        ticks = np.asarray(ax.yaxis.get_major_locator().tick_values(ymin, ymax))
+        top_tick = ticks[(ticks >= ymin) & (ticks <= ymax)].max()
+        ymax = max((top_tick - fraction * ymin) / (1 - fraction), ymax) * (1 + 1e-9)
+    return ymin, ymax
+
+@stage('compute')
+def compute_residuals(df, tolerance=1e-3, method="nearest"):
+    # Residuals NDH - fit at the NDH molar ratios.
+    # "nearest": the closest fit point within `tolerance` (in molar ratio),
+    #            so rounding differences between NDH_X and Fit_X do not drop points
+    # "interpolate": the fit curve linearly interpolated at every NDH_X
+    #            inside the fitted range
+    ndh_x, ndh_y = df[["NDH_X", "NDH_Y"]].dropna().to_numpy(dtype=float).T
+    fit_x, fit_y = df[["Fit_X", "Fit_Y"]].dropna().to_numpy(dtype=float).T
+    if ndh_x.size == 0 or fit_x.size == 0:
+        return np.empty(0), np.empty(0), ndh_x.size
+
+    order = np.argsort(fit_x, kind="stable")
+    fit_x, fit_y = fit_x[order], fit_y[order]
+    if method == "interpolate":
+        matched = (ndh_x >= fit_x[0]) & (ndh_x <= fit_x[-1])
+        fit_at_ndh = np.interp(ndh_x[matched], fit_x, fit_y)
+    elif method == "nearest":
+        right = np.searchsorted(fit_x, ndh_x).clip(0, fit_x.size - 1)
+        left = (right - 1).clip(0, fit_x.size - 1)
+        nearest = np.where(np.abs(ndh_x - fit_x[left]) <= np.abs(ndh_x - fit_x[right]), left, right)
+        matched = np.abs(ndh_x - fit_x[nearest]) <= tolerance
+        fit_at_ndh = fit_y[nearest[matched]]
+    else:
+        raise ValueError(f"Unknown residual method '{method}', use 'nearest' or 'interpolate'.")
+    return ndh_x[matched], ndh_y[matched] - fit_at_ndh, ndh_x.size
+
+def plot_itc(df, output, energy_unit, residual_tolerance=1e-3, residual_method="nearest", dpi=600, style=None):
+    """
+    Final ITC figure: thermogram, NDH with fit and residuals.
+
+    `output` is a path or a binary file-like object (PNG); use a low `dpi`
+    for previews and the default 600 for the final figure. `style` comes
+    from labscripthub.render.plot_style().
+    """
+    with styled(style):
+        with stage('render'):
+            fig = _plot_itc(df, energy_unit, residual_tolerance, residual_method)
+        with stage('save'):
+            fig.savefig(output, dpi=dpi, bbox_inches='tight', format='png')
+
+def _plot_itc(df, energy_unit, residual_tolerance, residual_method):
 
     time = df["DP_X"]
     dh = df["DP_Y"]
@@ -65,7 +111,8 @@ def plot_itc(df, output, energy_unit):
 
     # Create figure
     #fig, ax = plt.subplots(3, 1, figsize=(3.2,5))
-    fig, ax = plt.subplots(3, 1, figsize=(3.2,6, ), gridspec_kw={'height_ratios': [1, 1, 0.2]})
+    fig = new_figure(figsize=(3.2,6, ))
+    ax = fig.subplots(3, 1, gridspec_kw={'height_ratios': [1, 1, 0.2]})
     # Plot raw data
     ax[0].plot(time, dh, '-', color="black", label='raw data', linewidth=0.6)
     ax[0].set_xlabel('Time [min]')
@@ -85,23 +132,12 @@ def plot_itc(df, output, energy_unit):
     ax[1].tick_params(axis='both', which='major', labelsize=8)
 
     # Calculate residuals
-    ndh = (
-        df[["NDH_X", "NDH_Y"]]
-        .dropna()                
-        .set_index("NDH_X")["NDH_Y"]
-    )
-
-    fit = (
-        df[["Fit_X", "Fit_Y"]]
-        .dropna()
-        .set_index("Fit_X")["Fit_Y"]
-    )
-
-    residual = (ndh - fit).dropna()         # rows with no match become NaN
-
-    res_x = residual.index.to_numpy()
-    res_y = residual.to_numpy()
-
+    res_x, res_y, n_ndh = compute_residuals(df, tolerance=residual_tolerance, method=residual_method)
+    if res_x.size < n_ndh:
+        logging.warning(f"Residuals: only {res_x.size} of {n_ndh} NDH points matched the fit "
+                        f"({residual_method}, tolerance {residual_tolerance}).")
+    else:
+        logging.info(f"Residuals: {res_x.size} of {n_ndh} NDH points matched the fit.")
 
     ax[2].scatter(res_x, res_y, marker='s', color="black", label='NDH', sizes=(10,10))
     ax[2].set_xlabel('Molar Ratio')
@@ -109,7 +145,7 @@ def plot_itc(df, output, energy_unit):
     ax[2].axhline(y=0, color='black', linewidth=0.8)
     
     # the y zero should be in the middle of the plot
-    max_res = max([abs(i) for i in res_y])
+    max_res = np.abs(res_y).max() if res_y.size else 0.0
     lower_limit = round(-max_res - 0.1, 1)
     upper_limit = round(max_res + 0.1, 1)
     buffer_size = 0.1
@@ -120,30 +156,31 @@ def plot_itc(df, output, energy_unit):
 
 
     # The spacing between the two plots should be removed
-    plt.subplots_adjust(hspace=0)
+    fig.subplots_adjust(hspace=0)
     fig.align_ylabels(ax[:])
-    
-    plt.draw()
-    has_overlap_bool = has_overlap(ax, 1, 2)
-
-    # Add to the buffer size until there is no overlap
-    while has_overlap_bool:
-        buffer_size += 0.2
-        ax[2].set_ylim([lower_limit - buffer_size, upper_limit + buffer_size])
-        ax[2].tick_params(axis='both', which='major', labelsize=8)
-        new_limit = round_up_to_half(upper_limit + buffer_size/4)
+
+    # Keep the tick labels of the stacked axes apart. The label height is
+    # measured once and the limits are solved in display space, so the layout
+    # costs the same for any data.
+    renderer = fig.canvas.get_renderer()
+    gap_needed = tick_label_height(ax[1], renderer) + LABEL_PADDING + 0.5
+
+    # Residuals: symmetric limits +-L with ticks at +-T leave H * (L - T) / 2L
+    # pixels above the top tick
+    gap_middle = label_gap(ax[1], ax[1].get_ylim(), "bottom")
+    if gap_middle + label_gap(ax[2], ax[2].get_ylim(), "top") < gap_needed:
+        height = ax[2].get_window_extent().height
+        fraction = min((gap_needed - gap_middle) / height, 0.45)
+        new_limit = round_up_to_half(upper_limit)
+        half_range = max(new_limit / (1 - 2 * fraction), upper_limit + buffer_size)
+        ax[2].set_ylim([-half_range, half_range])
         ax[2].set_yticks([-new_limit, 0, new_limit])
-        plt.draw()  # Ensures ticks/labels are updated
-        has_overlap_bool = has_overlap(ax, 1, 2)
-
-    # Sanity Check for Plots 0 and 1
-    has_overlap_bool = has_overlap(ax, 0, 1)
-    new_buffer_size = 0.1
-    while has_overlap_bool:
-        new_buffer_size += 0.2
-        ax[1].set_ylim([ax[1].get_ylim()[0], ax[1].get_ylim()[1] + new_buffer_size])
-        plt.draw()  # Ensures ticks/labels are updated
-        has_overlap_bool = has_overlap(ax, 0, 1)
+
+    # Sanity Check for Plots 0 and 1: raise the top of the middle plot if needed
+    gap_top = label_gap(ax[0], ax[0].get_ylim(), "bottom")
+    limits = fit_top_limit(ax[1], ax[1].get_ylim(), gap_needed - gap_top)
+    if limits != ax[1].get_ylim():
+        ax[1].set_ylim(limits)
 
     # Save figure
     common_xlim = ax[1].get_xlim()       
@@ -154,9 +191,7 @@ def plot_itc(df, output, energy_unit):
     ax[1].tick_params(axis='x', which='both',
                   bottom=False, top=False, labelbottom=False)
 
-    plt.savefig(output, dpi=600, bbox_inches='tight')
-    #Close the figure
-    plt.close()
+    return fig
 
 
 def main(yaml_config: Path):
@@ -166,9 +201,8 @@ def main(yaml_config: Path):
         cfg = yaml.safe_load(f)
     
     seaborn_flag = cfg.get('USE_SEABORN', False)
-    if seaborn_flag:
-        seaborn_params = cfg.get('SEABORN_PARAMS', {"style": "ticks", "context": "paper"})
-        apply_seaborn_style(seaborn_params)
+    seaborn_params = cfg.get('SEABORN_PARAMS', {"style": "ticks", "context": "paper"}) if seaborn_flag else None
+    style = plot_style(seaborn=seaborn_params)
 
 
     # Required
@@ -179,6 +213,8 @@ def main(yaml_config: Path):
     output_name          = cfg.get('OUTPUT_NAME', f"{input_file.stem}")
     delimiter            = cfg.get('DELIMITER', ',')
     decimal              = cfg.get('DECIMAL', '.')
+    residual_tolerance   = cfg.get('RESIDUAL_TOLERANCE', 1e-3)
+    residual_method      = cfg.get('RESIDUAL_METHOD', 'nearest')
 
     # Prepare output folder
     output_folder.mkdir(parents=True, exist_ok=True)
@@ -192,8 +228,10 @@ def main(yaml_config: Path):
     
     # Load df
     #df = pd.read_csv(input_file, sep=';', decimal=',')
-    df = pd.read_csv(input_file, sep=delimiter, decimal=decimal)
-    plot_itc(df, output_name, energy_unit)
+    with stage('read'):
+        df = pd.read_csv(input_file, sep=delimiter, decimal=decimal)
+    plot_itc(df, output_name, energy_unit, residual_tolerance=residual_tolerance, residual_method=residual_method,
+             style=style)
 
 if __name__ == "__main__":
 
@@ -1,16 +1,19 @@
-import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
 import logging
+from functools import partial
 from pathlib import Path
+import queue
+import threading
 import tkinter as tk
-from tkinter import filedialog
-import sys
+from tkinter import filedialog, ttk
 
-from itc_final_figure import plot_itc, apply_seaborn_style
+from itc_batch import Batch, process_file, start_pool
 
 logging.basicConfig( level=logging.INFO, format='[%(levelname)s] %(message)s')
 
+# How often the GUI picks up results of the background batch [ms]
+POLL_MS = 50
+STATUS_COLORS = {"done": "darkgreen", "failed": "red", "cancelled": "gray"}
+
 
 # Create a simple GUI to select file and set options
 class ITCFinalFigureGUI:
@@ -53,9 +56,33 @@ class ITCFinalFigureGUI:
         self.seaborn_checkbox = tk.Checkbutton(master, text="Use seaborn style", variable=self.use_seaborn_var)
         self.seaborn_checkbox.grid(row=4, column=0, columnspan=3, sticky="w")
 
-        # Run button
+        # Run and cancel buttons
         self.run_button = tk.Button(master, text="Generate Figure", command=self.run)
         self.run_button.grid(row=5, column=1, pady=10)
+        self.cancel_button = tk.Button(master, text="Cancel", command=self.cancel, state=tk.DISABLED)
+        self.cancel_button.grid(row=5, column=2)
+
+        # Progress and per-file status
+        self.progress = ttk.Progressbar(master, mode="determinate", length=300)
+        self.progress.grid(row=6, column=0, columnspan=3, sticky="we", padx=5)
+        self.status_list = tk.Listbox(master, height=8, width=60)
+        self.status_list.grid(row=7, column=0, columnspan=3, sticky="nsew", padx=5, pady=5)
+        self.summary_label = tk.Label(master, text="")
+        self.summary_label.grid(row=8, column=0, columnspan=3, sticky="w", padx=5)
+        master.grid_rowconfigure(7, weight=1)
+        master.grid_columnconfigure(1, weight=1)
+
+        # Worker pool, warmed up in the background while files are picked
+        self.pool = None
+        self.batch = None
+        self.batch_thread = None
+        self.results = queue.Queue()
+        self.statuses = []
+        master.after(0, self.start_pool)
+        master.protocol("WM_DELETE_WINDOW", self.close)
+
+    def start_pool(self):
+        self.pool = start_pool()
 
     def browse_files(self):
         files = filedialog.askopenfilenames(
@@ -73,28 +100,98 @@ class ITCFinalFigureGUI:
 
     def run(self):
         if not self.file_paths:
-            logging.info("No files selected. Exiting.")
+            logging.info("No files selected.")
             return
 
-        sep = self.sep_entry.get()
-        decimal = self.decimal_entry.get()
-        energy_unit = self.energy_entry.get()
-        use_seaborn = self.use_seaborn_var.get()
-
-        if use_seaborn:
-            apply_seaborn_style({"style": "ticks", "context": "paper"})
-
-        for fp in self.file_paths:
-            inp = Path(fp)
-            out = inp.parent / (inp.stem + ".png")
-            df = pd.read_csv(inp, sep=sep, decimal=decimal)
-            plot_itc(df, out, energy_unit=energy_unit)
-            logging.info(f"Figure saved to {out}")
-
-        # cleanup
-        plt.close("all")
+        # Bind the constant arguments once; the style is applied in the workers
+        worker = partial(process_file,
+                         sep=self.sep_entry.get(),
+                         dec=self.decimal_entry.get(),
+                         energy=self.energy_entry.get(),
+                         out_folder=None,
+                         use_seaborn=self.use_seaborn_var.get())
+
+        paths = [Path(fp) for fp in self.file_paths]
+        self.statuses = ["queued"] * len(paths)
+        self.status_list.delete(0, tk.END)
+        for path in paths:
+            self.status_list.insert(tk.END, f"{path.name}  –  queued")
+        self.progress.configure(maximum=len(paths), value=0)
+        self.summary_label.configure(text="")
+        self.run_button.configure(state=tk.DISABLED)
+        self.browse_button.configure(state=tk.DISABLED)
+        self.cancel_button.configure(state=tk.NORMAL)
+
+        if self.pool is None:
+            self.start_pool()
+        # The batch blocks, so it runs on a background thread. Results come back
+        # through a queue that the Tk event loop polls with after(); Tk widgets
+        # are only touched from the GUI thread.
+        self.batch = Batch(self.pool, worker, paths)
+        on_file = lambda row, status, message: self.results.put((row, status, message))
+        self.batch_thread = threading.Thread(target=self.batch.run, args=(on_file,), daemon=True)
+        self.batch_thread.start()
+        self.master.after(POLL_MS, self.poll_results)
+
+    def poll_results(self):
+        while True:
+            try:
+                row, status, message = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.file_finished(row, status, message)
+        if self.batch_thread.is_alive() or not self.results.empty():
+            self.master.after(POLL_MS, self.poll_results)
+        else:
+            self.batch_finished()
+
+    def file_finished(self, row, status, message):
+        self.statuses[row] = status
+        name = Path(self.file_paths[row]).name
+        text = f"{name}  –  {status}"
+        if status == "done":
+            logging.info(f"Figure saved to {message}")
+        elif status == "failed":
+            logging.error(f"Failed on {name}: {message}")
+            text += f": {message}"
+        self.status_list.delete(row)
+        self.status_list.insert(row, text)
+        self.status_list.itemconfig(row, fg=STATUS_COLORS.get(status, "black"))
+        self.progress.configure(value=self.progress["value"] + 1)
+
+    def batch_finished(self):
+        done = self.statuses.count("done")
+        failed = self.statuses.count("failed")
+        cancelled = len(self.statuses) - done - failed
+        summary = f"Generated {done} figure{'s' if done != 1 else ''}"
+        if failed:
+            summary += f", {failed} failed"
+        if cancelled:
+            summary += f", {cancelled} cancelled"
+        self.summary_label.configure(text=summary + ".")
+        logging.info(summary + ".")
+
+        if self.batch.broken:
+            # A worker died; replace the pool for the next batch
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.start_pool()
+        self.batch = None
+        self.batch_thread = None
+        self.run_button.configure(state=tk.NORMAL)
+        self.browse_button.configure(state=tk.NORMAL)
+        self.cancel_button.configure(state=tk.DISABLED)
+
+    def cancel(self):
+        if self.batch is not None:
+            self.cancel_button.configure(state=tk.DISABLED)
+            self.batch.cancel()
+
+    def close(self):
+        if self.batch is not None:
+            self.batch.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
         self.master.destroy()
-        sys.exit(0)
 
 # Run the GUI
 if __name__ == "__main__":
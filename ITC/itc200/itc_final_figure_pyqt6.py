@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import os
 import sys
+from collections import OrderedDict
 from pathlib import Path
 
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import partial   # handy for binding common args
 
-import pandas as pd
-from PySide6.QtCore import Qt, QUrl
-from PySide6.QtGui import QColor, QPalette
+from PySide6.QtCore import Qt, QThread, QTimer, QUrl, Signal
+from PySide6.QtGui import QColor, QPalette, QPixmap
 from PySide6.QtWidgets import (
     QApplication,
     QFileDialog,
@@ -19,32 +21,45 @@ from PySide6.QtWidgets import (
     QListWidgetItem,
     QLineEdit,
     QMessageBox,
+    QProgressBar,
     QPushButton,
+    QSpinBox,
     QVBoxLayout,
     QWidget,
     QMainWindow,
     QCheckBox,
 )  
 
-from itc_final_figure import plot_itc, apply_seaborn_style
+from itc_batch import Batch, preview_file, process_file, start_pool
 
-def process_file(fp: Path,
-                 sep: str,
-                 dec: str,
-                 energy: str,
-                 out_folder: Path | None,
-                 use_seaborn: bool) -> str:
+PREVIEW_CACHE_SIZE = 32   # rendered previews kept in memory
+
+
+class BatchThread(QThread):
     """
-    Read one CSV, make the ITC figure and return the path of the PNG.
-    Defined at top level so it can be pickled by multiprocessing on Windows.
+    Runs a `Batch` off the GUI thread.
+
+    Every file reports back through `file_finished(row, status, message)` with
+    status "done", "failed" or "cancelled"; a failure does not stop the batch.
     """
-    if use_seaborn:
-        apply_seaborn_style({"style": "ticks", "context": "paper"})
 
-    df = pd.read_csv(fp, sep=sep, decimal=dec)
-    out_path = (out_folder or fp.parent) / f"{fp.stem}.png"
-    plot_itc(df, out_path, energy_unit=energy)
-    return str(out_path)
+    file_finished = Signal(int, str, str)
+
+    def __init__(self, pool: ProcessPoolExecutor, worker, file_paths: list[Path], parent=None) -> None:
+        super().__init__(parent)
+        self._batch = Batch(pool, worker, file_paths)
+
+    @property
+    def broken(self) -> bool:
+        return self._batch.broken
+
+    def cancel(self) -> None:
+        """Cancel all files that have not started yet; running ones finish."""
+        self._batch.cancel()
+
+    def run(self) -> None:  # noqa: D401 (runs in the worker thread)
+        # The pool belongs to the window and outlives the batch
+        self._batch.run(self.file_finished.emit)
 
 
 class FileListWidget(QListWidget):
@@ -73,16 +88,47 @@ class FileListWidget(QListWidget):
         event.acceptProposedAction()
 
 
+class PreviewLabel(QLabel):
+    """Shows a PNG scaled to the label size, keeping its aspect ratio."""
+
+    def __init__(self, parent=None) -> None:
+        super().__init__(parent)
+        self._pixmap: QPixmap | None = None
+        self.setAlignment(Qt.AlignCenter)
+        self.setMinimumWidth(220)
+
+    def set_png(self, data: bytes) -> None:
+        self._pixmap = QPixmap()
+        self._pixmap.loadFromData(data, "PNG")
+        self._rescale()
+
+    def set_message(self, text: str) -> None:
+        self._pixmap = None
+        self.setPixmap(QPixmap())
+        self.setText(text)
+
+    def _rescale(self) -> None:
+        if self._pixmap is not None and not self._pixmap.isNull():
+            self.setPixmap(self._pixmap.scaled(self.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+
+    def resizeEvent(self, event):  # noqa: N802
+        super().resizeEvent(event)
+        self._rescale()
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Main window
 # ──────────────────────────────────────────────────────────────────────────────
 
 
 class MainWindow(QMainWindow):
+    # (preview key, future) from the pool's callback thread to the GUI thread
+    preview_ready = Signal(object, object)
+
     def __init__(self) -> None:
         super().__init__()
         self.setWindowTitle("ITC Final Figure Generator")
-        self.resize(720, 480)
+        self.resize(960, 560)
 
         self.file_paths: list[Path] = []
         self.output_dir: Path | None = None
@@ -108,6 +154,11 @@ class MainWindow(QMainWindow):
         btn_col.addStretch()
         file_row.addLayout(btn_col)
 
+        # Low-dpi preview of the selected file, rendered in memory by the pool
+        self.preview = PreviewLabel(self)
+        self.preview.set_message("Select a file to preview")
+        file_row.addWidget(self.preview, 2)
+
         root.addLayout(file_row)
 
         # 2) options row
@@ -120,7 +171,18 @@ class MainWindow(QMainWindow):
         style_row = QHBoxLayout()
         self.seaborn_cb = QCheckBox("Use seaborn style")
         style_row.addWidget(self.seaborn_cb)
+        style_row.addStretch()
+        style_row.addWidget(QLabel("Workers:"))
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, max(os.cpu_count() or 1, 1))
+        self.workers_spin.setValue(os.cpu_count() or 1)
+        self.workers_spin.setToolTip("Number of worker processes (the pool restarts when changed)")
+        self.workers_spin.valueChanged.connect(self._restart_pool)
+        style_row.addWidget(self.workers_spin)
         root.addLayout(style_row)
+        for edit in (self.sep_edit, self.dec_edit, self.energy_edit):
+            edit.editingFinished.connect(self._request_preview)
+        self.seaborn_cb.toggled.connect(self._request_preview)
 
         # 3) output folder picker
         out_row = QHBoxLayout()
@@ -133,11 +195,104 @@ class MainWindow(QMainWindow):
         out_row.addWidget(out_browse)
         root.addLayout(out_row)
 
-        # 4) run button
-        run_btn = QPushButton("Generate Figure")
-        run_btn.setDefault(True)
-        run_btn.clicked.connect(self._generate)
-        root.addWidget(run_btn, alignment=Qt.AlignRight)
+        # 4) progress, cancel and run buttons
+        run_row = QHBoxLayout()
+        self.progress = QProgressBar()
+        self.progress.setFormat("%v / %m")
+        self.progress.setValue(0)
+        run_row.addWidget(self.progress, 1)
+        self.cancel_btn = QPushButton("Cancel")
+        self.cancel_btn.setEnabled(False)
+        self.cancel_btn.clicked.connect(self._cancel)
+        run_row.addWidget(self.cancel_btn)
+        self.run_btn = QPushButton("Generate Figure")
+        self.run_btn.setDefault(True)
+        self.run_btn.clicked.connect(self._generate)
+        run_row.addWidget(self.run_btn)
+        root.addLayout(run_row)
+
+        self._thread: BatchThread | None = None
+        self._batch_paths: list[Path] = []
+        self._statuses: list[str] = []
+        self._failed: list[str] = []
+        # Widgets that change the file list are locked while a batch runs
+        self._locked_widgets = [browse_btn, remove_btn, self.file_list, self.run_btn, self.workers_spin]
+
+        # Previews by (path, mtime, options); only the latest request is shown
+        self._previews: OrderedDict[tuple, bytes] = OrderedDict()
+        self._preview_key: tuple | None = None
+        self._closing = False
+        self.preview_ready.connect(self._on_preview_ready)
+        self.file_list.currentRowChanged.connect(self._request_preview)
+
+        # Long-lived worker pool, started in the background once the window is up
+        self._pool: ProcessPoolExecutor | None = None
+        QTimer.singleShot(0, self._start_pool)
+
+    # ---------- worker pool ----------
+    def _start_pool(self) -> None:
+        """Start the worker processes and warm them up without blocking the GUI."""
+        self._pool = start_pool(self.workers_spin.value())
+
+    def _restart_pool(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        self._start_pool()
+
+    # ---------- preview ----------
+    def _options(self) -> tuple[str, str, str, bool]:
+        return (self.sep_edit.text() or ",",
+                self.dec_edit.text() or ".",
+                self.energy_edit.text() or "kcal / mol",
+                self.seaborn_cb.isChecked())
+
+    def _request_preview(self, *_) -> None:
+        row = self.file_list.currentRow()
+        if not 0 <= row < len(self.file_paths):
+            self._preview_key = None
+            self.preview.set_message("Select a file to preview")
+            return
+        path = self.file_paths[row]
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError as exc:
+            self.preview.set_message(f"No preview:\n{exc.strerror}")
+            return
+        key = (path, mtime, *self._options())
+        self._preview_key = key
+        if key in self._previews:
+            self._previews.move_to_end(key)
+            self.preview.set_png(self._previews[key])
+            return
+        if self._pool is None:
+            self._start_pool()
+        self.preview.set_message("Rendering preview …")
+        try:
+            future = self._pool.submit(preview_file, path, *self._options())
+        except BrokenProcessPool:
+            self._restart_pool()
+            future = self._pool.submit(preview_file, path, *self._options())
+        future.add_done_callback(partial(self._preview_done, key))
+
+    def _preview_done(self, key: tuple, future: Future) -> None:
+        # Called from the pool's callback thread; hand over to the GUI thread
+        if not future.cancelled() and not self._closing:
+            self.preview_ready.emit(key, future)
+
+    def _on_preview_ready(self, key: tuple, future: Future) -> None:
+        # Runs on the GUI thread (queued signal from the pool's callback thread)
+        try:
+            data = future.result()
+        except Exception as exc:
+            if key == self._preview_key:
+                self.preview.set_message(f"No preview:\n{exc}")
+            return
+        self._previews[key] = data
+        if len(self._previews) > PREVIEW_CACHE_SIZE:
+            self._previews.popitem(last=False)
+        if key == self._preview_key:
+            self.preview.set_png(data)
 
     # ---------- tiny helpers ----------
     @staticmethod
@@ -182,14 +337,8 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "No files", "Add at least one CSV file first.")
             return
 
-        sep       = self.sep_edit.text() or ","
-        dec       = self.dec_edit.text() or "."
-        energy    = self.energy_edit.text() or "kcal / mol"
+        sep, dec, energy, use_sns = self._options()
         out_folder = self.output_dir if self.output_dir else None
-        use_sns   = self.seaborn_cb.isChecked()
-
-        # Freeze the UI button so the user cannot click twice
-        self.setEnabled(False)
 
         # Bind the constant arguments once
         worker = partial(process_file,
@@ -199,40 +348,91 @@ class MainWindow(QMainWindow):
                         out_folder=out_folder,
                         use_seaborn=use_sns)
 
-        try:
-            # One process per logical core by default
-            with ProcessPoolExecutor() as pool:
-                futures = {pool.submit(worker, fp): fp for fp in self.file_paths}
-
-                # Optional: basic progress feedback
-                done_cnt = 0
-                total = len(futures)
-                for fut in as_completed(futures):
-                    try:
-                        result_path = fut.result()      # raises if that job failed
-                        done_cnt += 1
-                    except Exception as exc:
-                        QMessageBox.critical(
-                            self,
-                            "Error",
-                            f"Failed on {futures[fut].name}:\n{exc}"
-                        )
-                        return  # bail out early
-
-                    # Keep the event loop alive so the window repaints
-                    QApplication.processEvents()
-
-            QMessageBox.information(
-                self,
-                "Done",
-                f"Generated {done_cnt} figure{'s' if done_cnt!=1 else ''} successfully."
-            )
-
-        finally:
-            # UI clean-up – always
-            self.file_list.clear()
-            self.file_paths.clear()
-            self.setEnabled(True)
+        self._batch_paths = list(self.file_paths)
+        self._statuses = ["queued"] * len(self._batch_paths)
+        self._failed = []
+        for row in range(len(self._batch_paths)):
+            self._set_status(row, "queued")
+        self.progress.setRange(0, len(self._batch_paths))
+        self.progress.setValue(0)
+
+        # Only lock what would change the running batch; the window stays responsive
+        for widget in self._locked_widgets:
+            widget.setEnabled(False)
+        self.cancel_btn.setEnabled(True)
+
+        if self._pool is None:
+            self._start_pool()
+        self._thread = BatchThread(self._pool, worker, self._batch_paths, self)
+        self._thread.file_finished.connect(self._on_file_finished)
+        self._thread.finished.connect(self._on_batch_finished)
+        self._thread.start()
+
+    def _cancel(self) -> None:
+        if self._thread is not None:
+            self.cancel_btn.setEnabled(False)
+            self._thread.cancel()
+
+    def _set_status(self, row: int, status: str, message: str = "") -> None:
+        self._statuses[row] = status
+        item = self.file_list.item(row)
+        text = f"{self._batch_paths[row].name}  –  {status}"
+        if message:
+            text += f": {message}"
+        item.setText(text)
+        item.setToolTip(message)
+        colors = {"done": QColor(80, 180, 80), "failed": QColor(220, 70, 70), "cancelled": QColor(150, 150, 150)}
+        if status in colors:
+            item.setForeground(colors[status])
+
+    def _on_file_finished(self, row: int, status: str, message: str) -> None:
+        # Runs on the GUI thread (queued signal from the batch thread)
+        if status == "done":
+            message = Path(message).name
+        elif status == "failed":
+            self._failed.append(f"{self._batch_paths[row].name}: {message}")
+        self._set_status(row, status, message)
+        self.progress.setValue(self.progress.value() + 1)
+
+    def _on_batch_finished(self) -> None:
+        # Files the batch never reached (cancelled before they were submitted)
+        for row, status in enumerate(self._statuses):
+            if status == "queued":
+                self._set_status(row, "cancelled")
+        statuses = self._statuses
+        done_cnt = statuses.count("done")
+        if self._thread.broken:
+            self._restart_pool()
+        self._thread.deleteLater()
+        self._thread = None
+        for widget in self._locked_widgets:
+            widget.setEnabled(True)
+        self.cancel_btn.setEnabled(False)
+
+        summary = f"Generated {done_cnt} figure{'s' if done_cnt!=1 else ''} successfully."
+        cancelled = statuses.count("cancelled")
+        if cancelled:
+            summary += f"\n{cancelled} file{'s' if cancelled!=1 else ''} cancelled."
+        if self._failed:
+            QMessageBox.warning(self, "Done with errors",
+                                summary + f"\n{len(self._failed)} failed:\n" + "\n".join(self._failed))
+        else:
+            QMessageBox.information(self, "Done", summary)
+
+        # Files that went through are removed; failed or cancelled ones stay for a retry
+        for row in reversed(range(len(self._batch_paths))):
+            if statuses[row] == "done":
+                self.file_list.takeItem(row)
+                del self.file_paths[row]
+
+    def closeEvent(self, event) -> None:  # noqa: N802
+        self._closing = True
+        if self._thread is not None:
+            self._thread.cancel()
+            self._thread.wait()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        super().closeEvent(event)
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -0,0 +1,387 @@
+"""
+Fit binding models to integrated ITC heats (NDH per injection).
+
+Models (as in MicroCal Origin, with the displaced-volume correction):
+    one_site    one set of sites:  N, K, dH
+    two_sites   two sets of sites: N1, K1, dH1, N2, K2, dH2
+Optionally a constant heat of dilution (Offset) per file.
+
+Input is the PEAQ-ITC/Origin CSV export (column NDH_Y) or the table written
+by itc_integrate.py (NDH_Y and Inj_Volume). Files with the same GROUP
+are fitted globally: parameters listed in SHARED are common to the group,
+all others are fitted per file. Groups are fitted in parallel.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import argparse
+import glob
+import logging
+import sys
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from labscripthub.instrument import stage
+
+logging.basicConfig( level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+# Gas constant per energy unit of NDH
+R_GAS = {'kcal': 1.987204259e-3, 'kJ': 8.314462618e-3}
+
+MODEL_PARAMS = {
+    'one_site': ['N', 'K', 'dH'],
+    'two_sites': ['N1', 'K1', 'dH1', 'N2', 'K2', 'dH2'],
+}
+
+# Models ---------------------------------------------------------------------------
+# Concentrations in M, volumes in any (common) unit. Every function works on
+# all injections of a run at once.
+
+def injection_concentrations(volumes, cell_volume, cell_conc, syringe_conc):
+    """Total macromolecule (Mt) and ligand (Xt) in the cell after every injection."""
+    injected = np.cumsum(volumes)
+    d = injected / (2 * cell_volume)
+    mt = cell_conc * (1 - d) / (1 + d)
+    xt = syringe_conc * injected / cell_volume * (1 - d)
+    return mt, xt
+
+def one_site_heat(mt, xt, n, k, dh, cell_volume):
+    """Total heat content Q after every injection for one set of sites (Wiseman isotherm)."""
+    r = xt / (n * mt)
+    b = 1 + r + 1 / (n * k * mt)
+    # b - sqrt(b^2 - 4r), written without the cancellation at high K
+    bound_fraction = 2 * r / (b + np.sqrt(np.maximum(b * b - 4 * r, 0)))
+    return n * mt * dh * cell_volume * bound_fraction
+
+def two_site_heat(mt, xt, n1, k1, dh1, n2, k2, dh2, cell_volume, iterations=64):
+    """
+    Total heat content Q after every injection for two independent sets of sites.
+
+    The free ligand concentration is found by bisection of the mass balance,
+    for all injections at once (the balance is monotonic in the free ligand).
+    """
+    low = np.zeros_like(xt)
+    high = np.array(xt, dtype=float)
+    for _ in range(iterations):
+        x = (low + high) / 2
+        excess = x + mt * (n1 * k1 * x / (1 + k1 * x) + n2 * k2 * x / (1 + k2 * x)) - xt
+        low = np.where(excess < 0, x, low)
+        high = np.where(excess < 0, high, x)
+    x = (low + high) / 2
+    return mt * cell_volume * (n1 * dh1 * k1 * x / (1 + k1 * x) + n2 * dh2 * k2 * x / (1 + k2 * x))
+
+def injection_heats(q, volumes, cell_volume):
+    """Heat of every injection from the heat contents, corrected for the displaced volume."""
+    q_prev = np.concatenate([[0.0], q[:-1]])
+    return q + volumes / cell_volume * (q + q_prev) / 2 - q_prev
+
+def heat_content(params, mt, xt, cell_volume, model):
+    """Total heat content Q of the model at the given concentrations."""
+    if model == 'one_site':
+        return one_site_heat(mt, xt, params['N'], params['K'], params['dH'], cell_volume)
+    return two_site_heat(mt, xt, params['N1'], params['K1'], params['dH1'],
+                         params['N2'], params['K2'], params['dH2'], cell_volume)
+
+def model_ndh(params, run, model):
+    """Normalized heat per injection (energy per mol injectant) for one run."""
+    q = heat_content(params, run['mt'], run['xt'], run['cell_volume'], model)
+    ndh = injection_heats(q, run['volumes'], run['cell_volume']) / (run['syringe_conc'] * run['volumes'])
+    return ndh + params.get('Offset', 0.0)
+
+def model_curve(params, run, model, points=400):
+    """
+    Fit curve on a fine molar-ratio grid: NDH of an injection of the run's
+    typical volume ending at every grid point, merged with the fitted
+    injections (exact there, so residuals can be matched to it).
+    """
+    def at(injected):
+        mt, xt = injection_concentrations(np.diff(np.r_[0.0, injected]), run['cell_volume'],
+                                          run['cell_conc'], run['syringe_conc'])
+        return xt / mt, heat_content(params, mt, xt, run['cell_volume'], model)
+
+    volume = float(np.median(run['volumes'][run['mask']]))
+    injected = np.linspace(volume, run['volumes'].sum(), points)
+    ratio, q = at(injected)
+    _, q_prev = at(injected - volume)
+    ndh = (q + volume / run['cell_volume'] * (q + q_prev) / 2 - q_prev) / (run['syringe_conc'] * volume)
+    x = np.r_[ratio, (run['xt'] / run['mt'])[run['mask']]]
+    y = np.r_[ndh + params.get('Offset', 0.0), run['fit_ndh'][run['mask']]]
+    order = np.argsort(x, kind='stable')
+    return x[order], y[order]
+
+# Fitting --------------------------------------------------------------------------
+
+def _layout(names, shared, n_runs):
+    """Index of every (run, parameter) in the fit vector; shared parameters appear once."""
+    index = np.zeros((n_runs, len(names)), dtype=int)
+    position = 0
+    for j, name in enumerate(names):
+        if name in shared:
+            index[:, j] = position
+            position += 1
+        else:
+            index[:, j] = np.arange(position, position + n_runs)
+            position += n_runs
+    return index, position
+
+def _initial_guesses(runs, names, model, fit_offset):
+    """A few starting points per parameter; K values are tried on a grid."""
+    first = np.mean([run['ndh'][run['mask']][0] for run in runs])
+    last = np.mean([run['ndh'][run['mask']][-1] for run in runs])
+    dh = first - last if fit_offset else first
+    base = {'N': 1.0, 'dH': dh, 'N1': 0.5, 'dH1': dh, 'N2': 0.5, 'dH2': dh / 2, 'Offset': last if fit_offset else 0.0}
+    if model == 'one_site':
+        k_grid = [{'K': k} for k in (1e4, 1e5, 1e6, 1e7, 1e8)]
+    else:
+        k_grid = [{'K1': k1, 'K2': k2} for k1 in (1e6, 1e7, 1e8) for k2 in (1e4, 1e5)]
+    return [{name: (np.log(ks[name]) if name in ks else base[name]) for name in names} for ks in k_grid]
+
+def fit_runs(runs, model='one_site', shared=None, fit_offset=False, temperature=298.15, energy_unit='kcal'):
+    """
+    Fit one or several runs together (global fit).
+
+    runs: dicts with ndh, volumes, cell_volume, cell_conc, syringe_conc (M),
+          mask (injections to fit) and name
+    shared: parameter names common to all runs (default: all but Offset)
+
+    K is fitted as ln K. Errors come from the Jacobian at the optimum, scaled
+    by the reduced chi-square; K, Kd, dG and dS errors follow by error
+    propagation with the full covariance. Returns one result dict per run.
+    """
+    from scipy.optimize import least_squares
+
+    names = MODEL_PARAMS[model] + (['Offset'] if fit_offset else [])
+    shared = set(MODEL_PARAMS[model] if shared is None else shared) - {'Offset'}
+    index, n_params = _layout(names, shared, len(runs))
+    for run in runs:
+        run['mt'], run['xt'] = injection_concentrations(run['volumes'], run['cell_volume'],
+                                                        run['cell_conc'], run['syringe_conc'])
+    log_k = np.array([name.startswith('K') for name in names])
+
+    def unpack(theta, i):
+        values = theta[index[i]]
+        values = np.where(log_k, np.exp(np.clip(values, -50, 50)), values)
+        return dict(zip(names, values))
+
+    def residuals(theta):
+        return np.concatenate([(model_ndh(unpack(theta, i), run, model) - run['ndh'])[run['mask']]
+                               for i, run in enumerate(runs)])
+
+    n_points = sum(int(run['mask'].sum()) for run in runs)
+    if n_points <= n_params:
+        raise ValueError(f"{n_points} injections are too few for {n_params} parameters.")
+
+    best = None
+    for guess in _initial_guesses(runs, names, model, fit_offset):
+        theta0 = np.zeros(n_params)
+        for j, name in enumerate(names):
+            theta0[index[:, j]] = guess[name]
+        try:
+            result = least_squares(residuals, theta0, method='lm', x_scale='jac')
+        except ValueError:
+            continue
+        if np.isfinite(result.cost) and (best is None or result.cost < best.cost):
+            best = result
+    if best is None:
+        raise RuntimeError("The fit did not converge from any starting point.")
+
+    dof = n_points - n_params
+    chi2_red = 2 * best.cost / dof
+    jac = best.jac
+    cov = np.linalg.pinv(jac.T @ jac) * chi2_red
+
+    rt = R_GAS[energy_unit] * temperature
+    per_kelvin = 1000 / temperature    # dS in cal/(mol K) or J/(mol K)
+    results = []
+    for i, run in enumerate(runs):
+        values = unpack(best.x, i)
+        result = {'File': run['name'], 'Model': model, 'Injections': int(run['mask'].sum())}
+        for j, name in enumerate(names):
+            sigma = np.sqrt(cov[index[i, j], index[i, j]])
+            result[name] = values[name]
+            result[f'{name}_Err'] = values[name] * sigma if log_k[j] else sigma
+        # Kd, dG and dS per set of sites
+        for suffix in ([''] if model == 'one_site' else ['1', '2']):
+            k_pos, h_pos = index[i, names.index(f'K{suffix}')], index[i, names.index(f'dH{suffix}')]
+            var_lnk, var_h, cov_hk = cov[k_pos, k_pos], cov[h_pos, h_pos], cov[h_pos, k_pos]
+            k, dh = values[f'K{suffix}'], values[f'dH{suffix}']
+            dg = -rt * np.log(k)
+            result[f'Kd{suffix}'] = 1 / k
+            result[f'Kd{suffix}_Err'] = np.sqrt(var_lnk) / k
+            result[f'dG{suffix}'] = dg
+            result[f'dG{suffix}_Err'] = rt * np.sqrt(var_lnk)
+            result[f'dS{suffix}'] = per_kelvin * (dh - dg)
+            # dS = (dH + RT ln K) / T
+            result[f'dS{suffix}_Err'] = per_kelvin * np.sqrt(max(var_h + rt ** 2 * var_lnk + 2 * rt * cov_hk, 0))
+        fit_ndh = model_ndh(values, run, model)
+        result['RMSE'] = float(np.sqrt(np.mean((fit_ndh - run['ndh'])[run['mask']] ** 2)))
+        result['Chi2_Red'] = chi2_red
+        result['Shared'] = ', '.join(sorted(shared)) if len(runs) > 1 else ''
+        results.append(result)
+        run['fit_ndh'] = fit_ndh
+        run['fit_curve'] = model_curve(values, run, model)
+    return results
+
+# Batch ----------------------------------------------------------------------------
+
+@stage('read')
+def load_run(entry, defaults, sep, decimal):
+    """
+    Read the heats (NDH_Y) of one file; injection volumes from an Inj_Volume
+    column (itc_integrate.py) or the config.
+    """
+    settings = {**defaults, **entry}
+    df = pd.read_csv(settings['FILE'], sep=sep, decimal=decimal)
+    ndh = pd.to_numeric(df['NDH_Y'], errors='coerce').dropna().to_numpy(dtype=float)
+    if 'Inj_Volume' in df.columns:
+        volumes = pd.to_numeric(df['Inj_Volume'], errors='coerce').dropna().to_numpy(dtype=float)
+    else:
+        volume = settings['INJECTION_VOLUME']
+        volumes = np.resize(np.asarray(volume, dtype=float), ndh.size)
+        if 'FIRST_INJECTION_VOLUME' in settings and not isinstance(volume, list):
+            volumes[0] = settings['FIRST_INJECTION_VOLUME']
+    if volumes.size != ndh.size:
+        raise ValueError(f"{settings['FILE']}: {ndh.size} heats but {volumes.size} injection volumes.")
+
+    mask = np.isfinite(ndh)
+    if settings.get('DROP_FIRST', True):
+        mask[0] = False
+    excluded = [int(injection) for injection in settings.get('EXCLUDE_INJECTIONS', [])]
+    outside = [injection for injection in excluded if not 1 <= injection <= ndh.size]
+    if outside:
+        raise ValueError(f"{settings['FILE']}: EXCLUDE_INJECTIONS {outside} are outside injections 1 to {ndh.size}.")
+    for injection in excluded:
+        mask[injection - 1] = False
+    return {
+        'name': str(settings['FILE']),
+        'group': settings.get('GROUP'),
+        'ndh': ndh,
+        'volumes': volumes,
+        'mask': mask,
+        'cell_volume': float(settings['CELL_VOLUME']),
+        'cell_conc': float(settings['CELL_CONC']) * 1e-6,      # µM -> M
+        'syringe_conc': float(settings['SYRINGE_CONC']) * 1e-6,
+    }
+
+def fit_group(runs, model, shared, fit_offset, temperature, energy_unit):
+    """Fit one group of runs; runs in a worker process."""
+    try:
+        results = fit_runs(runs, model, shared, fit_offset, temperature, energy_unit)
+    except (RuntimeError, ValueError, np.linalg.LinAlgError) as exc:
+        return [{'File': run['name'], 'Model': model, 'Message': str(exc)} for run in runs], runs
+    for result in results:
+        result['Message'] = 'OK'
+    return results, runs
+
+@stage('save')
+def write_curve(run, sep, decimal, output_folder):
+    """Copy of the input with the fit curve as Fit_X/Fit_Y, ready for itc_final_figure.py."""
+    df = pd.read_csv(run['name'], sep=sep, decimal=decimal)
+    fit_x, fit_y = run['fit_curve']
+    fit = pd.DataFrame({'Fit_X': fit_x, 'Fit_Y': fit_y})
+    df = df.drop(columns=['Fit_X', 'Fit_Y'], errors='ignore')
+    if 'NDH_X' not in df.columns:
+        df = pd.concat([df, pd.DataFrame({'NDH_X': run['xt'] / run['mt']})], axis=1)
+    df = pd.concat([df, fit], axis=1)
+    output_file = Path(output_folder) / f"{Path(run['name']).stem}_fit.csv"
+    df.to_csv(output_file, sep=sep, decimal=decimal, index=False)
+    return output_file
+
+def expand_files(entries):
+    """FILES entries (paths, globs or dicts with FILE and per-file settings) -> list of dicts."""
+    files = []
+    for entry in entries:
+        entry = dict(entry) if isinstance(entry, dict) else {'FILE': entry}
+        if glob.has_magic(str(entry['FILE'])):
+            matches = sorted(glob.glob(str(entry['FILE'])))
+            if not matches:
+                logging.warning(f"No files match '{entry['FILE']}'.")
+        else:
+            matches = [entry['FILE']]
+        files.extend({**entry, 'FILE': match} for match in matches)
+    return files
+
+def main(yaml_config: Path):
+    # Load YAML
+    with open(yaml_config, 'r') as f:
+        cfg = yaml.safe_load(f)
+
+    # Required
+    entries = cfg.get('FILES', [])
+    if isinstance(entries, (str, dict)):
+        entries = [entries]
+    if not entries:
+        raise ValueError("Config YAML must contain a 'FILES' list with at least one entry.")
+    # Optional
+    model          = cfg.get('MODEL', 'one_site')
+    shared         = cfg.get('SHARED', None)
+    fit_offset     = cfg.get('FIT_OFFSET', False)
+    temperature    = float(cfg.get('TEMPERATURE', 25.0)) + 273.15
+    energy_unit    = 'kJ' if 'kj' in str(cfg.get('ENERGY_UNIT', 'kcal / mol')).lower() else 'kcal'
+    delimiter      = cfg.get('DELIMITER', ',')
+    decimal        = cfg.get('DECIMAL', '.')
+    output_folder  = Path(cfg.get('OUTPUT_FOLDER', '.'))
+    output_name    = cfg.get('OUTPUT_NAME', 'itc_fits')
+    write_curves   = cfg.get('WRITE_CURVES', True)
+    workers        = cfg.get('WORKERS', None)
+
+    if model not in MODEL_PARAMS:
+        logging.error(f"Unknown MODEL '{model}'. Choose from {list(MODEL_PARAMS)}.")
+        sys.exit(1)
+    defaults = {key: cfg[key] for key in ('CELL_CONC', 'SYRINGE_CONC', 'CELL_VOLUME', 'INJECTION_VOLUME',
+                                          'FIRST_INJECTION_VOLUME', 'DROP_FIRST', 'EXCLUDE_INJECTIONS')
+                if key in cfg}
+    defaults.setdefault('CELL_VOLUME', 200.0)
+
+    # Files with the same GROUP are fitted together, all others alone
+    groups = {}
+    for entry in expand_files(entries):
+        try:
+            run = load_run(entry, defaults, delimiter, decimal)
+        except (OSError, KeyError, ValueError) as exc:
+            logging.error(f"Skipping {entry['FILE']}: {exc!r}")
+            continue
+        groups.setdefault(run['group'] or run['name'], []).append(run)
+    if not groups:
+        logging.error("None of the FILES could be loaded; nothing to fit.")
+        sys.exit(1)
+
+    output_folder.mkdir(parents=True, exist_ok=True)
+    if not output_name.endswith('.xlsx'):
+        output_name += '.xlsx'
+
+    rows = []
+    with stage('fit'), ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(name, pool.submit(fit_group, runs, model, shared, fit_offset, temperature, energy_unit))
+                   for name, runs in groups.items()]
+        for name, fut in futures:
+            results, runs = fut.result()
+            for result in results:
+                rows.append({'Group': name, **result})
+            if write_curves and results[0]['Message'] == 'OK':
+                for run in runs:
+                    logging.info(f"Fit curve written to {write_curve(run, delimiter, decimal, output_folder)}")
+
+    table = pd.DataFrame(rows)
+    output_file = output_folder / output_name
+    with stage('save'):
+        table.to_excel(output_file, index=False)
+    failed = int((table['Message'] != 'OK').sum())
+    logging.info(f"Fitted {len(groups)} group(s) with the {model} model; {failed} file(s) failed.")
+    logging.info(f"Fit results written to {output_file}")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Fit binding models to integrated ITC heats per a YAML config.")
+    parser.add_argument('yaml_config',
+                        nargs='?',
+                        default=None,
+                        help='Path to the YAML configuration file (default: ./fit_input.yaml)')
+
+    args = parser.parse_args()
+    if args.yaml_config is None:
+        logging.info("No YAML config provided, using default: ./fit_input.yaml")
+        args.yaml_config = './fit_input.yaml'  # Default config file
+
+    main(args.yaml_config)
@@ -0,0 +1,225 @@
+"""
+Integrate raw ITC thermograms (DP_X/DP_Y) into heats per injection.
+
+1. Segment the trace into injections: given INJECTION_TIMES, or the onsets of
+   the spikes in the differential power.
+2. Baseline: a monotone cubic spline (PCHIP) through the mean of the quiet
+   end of every segment (and the stretch before the first injection).
+3. Integrate the baseline-corrected trace once (cumulative trapezoid) and
+   take the difference between segment boundaries as the heat of every
+   injection.
+
+The output table (<file>_integrated.csv) keeps DP_X/DP_Y and adds Baseline,
+NDH_X (molar ratio), NDH_Y and Inj_Volume, so it can be plotted with
+itc_final_figure.py and fitted with itc_fit.py.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from labscripthub.instrument import stage
+from itc_fit import expand_files, injection_concentrations
+
+logging.basicConfig( level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+# Differential power unit -> energy per mol of NDH (time in minutes)
+POWER_UNITS = {'ucal/s': 'kcal / mol', 'uw': 'kJ / mol'}
+
+def detect_injections(time, power, min_spacing=1.0, threshold=8.0, smooth=5, regular=True):
+    """
+    Onset times of the injection spikes.
+
+    A spike starts where the slope of the (lightly smoothed) trace exceeds
+    `threshold` robust standard deviations of the slope; onsets closer than
+    `min_spacing` (time units) to the previous steep point belong to the same peak.
+    With `regular`, the injections are taken to be evenly spaced (as
+    programmed on the instrument): the schedule is extended at the median
+    spacing to the end of the trace, so small peaks near saturation that do
+    not stand out of the noise still get their own segment.
+    """
+    from scipy.ndimage import uniform_filter1d
+
+    smooth = max(int(smooth), 1)
+    slope = np.abs(np.gradient(uniform_filter1d(power, smooth), time))
+    center = np.median(slope)
+    noise = 1.4826 * np.median(np.abs(slope - center))
+    steep = np.flatnonzero(slope > center + threshold * max(noise, np.finfo(float).tiny))
+    if steep.size == 0:
+        return np.empty(0)
+    onsets = steep[np.r_[True, np.diff(time[steep]) > min_spacing]]
+    # The slope crosses the threshold a little after the syringe fires
+    onsets = time[np.maximum(onsets - smooth, 0)]
+    if not regular or onsets.size < 3:
+        return onsets
+
+    spacing = np.median(np.diff(onsets))
+    grid = onsets[0] + spacing * np.arange(int((time[-1] - onsets[0]) / spacing + 0.5))
+    # Snap the schedule to the detected onsets where there is one nearby
+    nearest = np.clip(np.searchsorted(onsets, grid), 1, onsets.size - 1)
+    nearest -= (grid - onsets[nearest - 1]) < (onsets[nearest] - grid)
+    snap = np.abs(onsets[nearest] - grid) < spacing / 4
+    return np.where(snap, onsets[nearest], grid)
+
+def integrate_trace(time, power, injection_times, quiet_fraction=0.25):
+    """
+    Baseline and heat (power x time) of every injection.
+
+    Returns the baseline at every sample and one heat per injection.
+    """
+    from scipy.interpolate import PchipInterpolator
+
+    starts = np.searchsorted(time, injection_times)
+    bounds = np.r_[starts, time.size]
+    # Quiet end of every segment, plus the end of the stretch before the first injection
+    seg_start = np.r_[0, starts]
+    seg_end = bounds
+    quiet_start = seg_end - np.maximum(((seg_end - seg_start) * quiet_fraction).astype(int), 1)
+    valid = seg_end > seg_start
+    quiet_start, seg_end = quiet_start[valid], seg_end[valid]
+
+    # Mean time and power of every quiet window from one cumulative sum each
+    t_cum = np.r_[0.0, np.cumsum(time)]
+    p_cum = np.r_[0.0, np.cumsum(power)]
+    count = seg_end - quiet_start
+    knot_t = (t_cum[seg_end] - t_cum[quiet_start]) / count
+    knot_p = (p_cum[seg_end] - p_cum[quiet_start]) / count
+    if knot_t.size > 1:
+        baseline = PchipInterpolator(knot_t, knot_p, extrapolate=True)(time)
+    else:
+        baseline = np.full_like(power, knot_p[0] if knot_p.size else 0.0)
+
+    # One cumulative trapezoid over the corrected trace; heats are differences of it
+    corrected = power - baseline
+    area = np.r_[0.0, np.cumsum((corrected[1:] + corrected[:-1]) / 2 * np.diff(time))]
+    # Up to the start of the next injection (the last one up to the end of the trace)
+    heats = area[np.minimum(bounds[1:], time.size - 1)] - area[starts]
+    return baseline, heats
+
+def integrate_file(entry, defaults, sep, decimal, output_folder, plot=False):
+    """Integrate one thermogram and write its table; runs in a worker process."""
+    settings = {**defaults, **entry}
+    input_file = Path(settings['FILE'])
+    df = pd.read_csv(input_file, sep=sep, decimal=decimal)
+    trace = df[['DP_X', 'DP_Y']].apply(pd.to_numeric, errors='coerce').dropna()
+    time = trace['DP_X'].to_numpy(dtype=float)
+    power = trace['DP_Y'].to_numpy(dtype=float)
+
+    if 'INJECTION_TIMES' in settings:
+        injection_times = np.sort(np.asarray(settings['INJECTION_TIMES'], dtype=float))
+        outside = injection_times[(injection_times < time[0]) | (injection_times >= time[-1])]
+        if outside.size:
+            raise ValueError(f"INJECTION_TIMES {outside.tolist()} are outside the trace "
+                             f"({time[0]:g} to {time[-1]:g} min).")
+    else:
+        injection_times = detect_injections(time, power,
+                                            min_spacing=float(settings.get('MIN_SPACING', 1.0)),
+                                            threshold=float(settings.get('THRESHOLD', 8.0)),
+                                            regular=settings.get('REGULAR_SPACING', True))
+    n_inj = injection_times.size
+    if n_inj == 0:
+        raise ValueError("No injections found; set INJECTION_TIMES or lower THRESHOLD.")
+
+    volume = settings['INJECTION_VOLUME']
+    volumes = np.resize(np.asarray(volume, dtype=float), n_inj)
+    if 'FIRST_INJECTION_VOLUME' in settings and not isinstance(volume, list):
+        volumes[0] = settings['FIRST_INJECTION_VOLUME']
+
+    baseline, heats = integrate_trace(time, power, injection_times, float(settings.get('QUIET_FRACTION', 0.25)))
+    # power x min -> power x s; µcal / (µM x µL) = 1e6 cal/mol = 1e3 kcal/mol (µW: kJ/mol)
+    heats = heats * float(settings.get('TIME_FACTOR', 60.0))
+    syringe_conc = float(settings['SYRINGE_CONC'])
+    ndh = heats / (syringe_conc * volumes) * 1e3
+    mt, xt = injection_concentrations(volumes, float(settings.get('CELL_VOLUME', 200.0)),
+                                      float(settings['CELL_CONC']), syringe_conc)
+
+    table = pd.concat([
+        pd.DataFrame({'DP_X': time, 'DP_Y': power, 'Baseline': baseline}),
+        pd.DataFrame({'NDH_X': xt / mt, 'NDH_Y': ndh, 'Injection': np.arange(1, n_inj + 1),
+                      'Inj_Time': injection_times, 'Inj_Volume': volumes, 'Heat': heats}),
+    ], axis=1)
+    output_file = Path(output_folder) / f"{input_file.stem}_integrated.csv"
+    table.to_csv(output_file, sep=sep, decimal=decimal, index=False)
+    if plot:
+        plot_integration(time, power, baseline, injection_times, output_file.with_suffix('.png'))
+    return str(input_file), n_inj, str(output_file)
+
+def plot_integration(time, power, baseline, injection_times, output_file):
+    """Trace, baseline and injection onsets, to check the segmentation."""
+    # Object-oriented figure on its own canvas: safe inside worker processes
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(8, 3))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.plot(time, power, color='black', linewidth=0.6, label='DP')
+    ax.plot(time, baseline, color='red', linewidth=0.8, label='baseline')
+    for t in injection_times:
+        ax.axvline(t, color='gray', linewidth=0.4, linestyle=':')
+    ax.set_xlabel('Time [min]')
+    ax.set_ylabel('DP')
+    ax.legend(fontsize=7)
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=150)
+
+def main(yaml_config: Path):
+    # Load YAML
+    with open(yaml_config, 'r') as f:
+        cfg = yaml.safe_load(f)
+
+    # Required
+    entries = cfg.get('FILES', [])
+    if isinstance(entries, (str, dict)):
+        entries = [entries]
+    if not entries:
+        raise ValueError("Config YAML must contain a 'FILES' list with at least one entry.")
+    # Optional
+    delimiter     = cfg.get('DELIMITER', ',')
+    decimal       = cfg.get('DECIMAL', '.')
+    output_folder = Path(cfg.get('OUTPUT_FOLDER', '.'))
+    plot          = cfg.get('PLOT', False)
+    workers       = cfg.get('WORKERS', None)
+    power_unit    = str(cfg.get('POWER_UNIT', 'ucal/s')).lower().replace('µ', 'u').replace(' ', '')
+    if power_unit not in POWER_UNITS:
+        raise ValueError(f"POWER_UNIT must be one of {list(POWER_UNITS)}.")
+    defaults = {key: value for key, value in cfg.items()
+                if key in ('CELL_CONC', 'SYRINGE_CONC', 'CELL_VOLUME', 'INJECTION_VOLUME', 'FIRST_INJECTION_VOLUME',
+                           'INJECTION_TIMES', 'MIN_SPACING', 'THRESHOLD', 'REGULAR_SPACING', 'QUIET_FRACTION',
+                           'TIME_FACTOR')}
+
+    output_folder.mkdir(parents=True, exist_ok=True)
+    files = expand_files(entries)
+    failed = 0
+    # Every file is read, integrated and written in a worker
+    with stage('integrate'), ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(entry['FILE'], pool.submit(integrate_file, entry, defaults, delimiter, decimal, output_folder, plot))
+                   for entry in files]
+        for name, fut in futures:
+            try:
+                _, n_inj, output_file = fut.result()
+            except Exception as exc:
+                logging.error(f"Failed on {name}: {exc!r}")
+                failed += 1
+                continue
+            logging.info(f"{name}: {n_inj} injections integrated -> {output_file}")
+    logging.info(f"Integrated {len(files) - failed} file(s) (NDH in {POWER_UNITS[power_unit]}); {failed} failed.")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Integrate raw ITC thermograms into heats per injection per a YAML config.")
+    parser.add_argument('yaml_config',
+                        nargs='?',
+                        default=None,
+                        help='Path to the YAML configuration file (default: ./integrate_input.yaml)')
+
+    args = parser.parse_args()
+    if args.yaml_config is None:
+        logging.info("No YAML config provided, using default: ./integrate_input.yaml")
+        args.yaml_config = './integrate_input.yaml'  # Default config file
+
+    main(args.yaml_config)
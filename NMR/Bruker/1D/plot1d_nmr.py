@@ -1,21 +1,27 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import nmrglue as ng
 import yaml
 import argparse
 import logging
 from pathlib import Path
-import matplotlib as mpl
-mpl.rcParams["mathtext.fontset"] = "dejavuserif" # nicer omega symbol
-mpl.rcParams["contour.negative_linestyle"] = "solid" # make negative contours solid
+
+from labscripthub.instrument import stage
+from labscripthub.render import new_figure, plot_style, styled
 
 logging.basicConfig( level=logging.INFO, format='[%(levelname)s] %(message)s')
 
-def apply_seaborn_style(param_dict):
-    import seaborn as sns
-    sns.set_theme(**param_dict)
+PLOT_RC = {
+    "mathtext.fontset": "dejavuserif",  # nicer omega symbol
+    "contour.negative_linestyle": "solid",  # make negative contours solid
+}
+
 
+@stage('read')
+def read_spectrum(fname):
+    """Processed Bruker spectrum (pdata folder) -> (dic, data)"""
+    return ng.bruker.read_pdata(fname)
 
+@stage('compute')
 def make_ppm_scale(dic):
     """Create ppm scale from dic (Bruker)"""
     SF = dic["procs"]["SF"]
@@ -26,6 +32,7 @@ def make_ppm_scale(dic):
     
     return ppm_scale
 
+@stage('compute')
 def get_max_between_ppm(ppm_scale, data, ppm=[2.4, 2.7], mode="max"):
     """Return max/min of data between two ppm values, independent of axis direction."""
 
@@ -47,12 +54,20 @@ def get_max_between_ppm(ppm_scale, data, ppm=[2.4, 2.7], mode="max"):
         raise ValueError("mode must be 'max' or 'min'")
 
 
-def plot_data(input_list, output_name, xlimits, ylimits, x_axis_label, scale_range, scale_mode, figure_size, legend_params=None):
+def plot_data(input_list, output_name, xlimits, ylimits, x_axis_label, scale_range, scale_mode, figure_size, legend_params=None, style=None):
+    with styled(style):
+        fig = _plot_data(input_list, xlimits, ylimits, x_axis_label, scale_range, scale_mode, figure_size, legend_params)
+        with stage('save'):
+            fig.savefig(output_name, dpi=600, bbox_inches='tight')
+
+@stage('render')
+def _plot_data(input_list, xlimits, ylimits, x_axis_label, scale_range, scale_mode, figure_size, legend_params):
 
     if figure_size is not None:
-        plt.figure(figsize=figure_size)
+        fig = new_figure(figsize=figure_size)
     else:
-        plt.figure()
+        fig = new_figure()
+    ax = fig.add_subplot(111)
 
     for spectrum_data in input_list:
         fname, color, label, offset, scale_factor, linewidth = spectrum_data # unpack the input list 
@@ -61,7 +76,7 @@ def plot_data(input_list, output_name, xlimits, ylimits, x_axis_label, scale_ran
         linewidth = float(linewidth)
 
         # read in the data from the Bruker folder
-        dic, data = ng.bruker.read_pdata(fname)
+        dic, data = read_spectrum(fname)
         data = data * scale_factor
 
         # make ppm scale
@@ -72,30 +87,29 @@ def plot_data(input_list, output_name, xlimits, ylimits, x_axis_label, scale_ran
             data = data / max_val
         data = data + offset
 
-        plt.plot(ppm_scale, data, color=color, label=label, linewidth=linewidth)
+        ax.plot(ppm_scale, data, color=color, label=label, linewidth=linewidth)
 
-    plt.xlabel(x_axis_label)
+    ax.set_xlabel(x_axis_label)
 
     if xlimits is not None:
         x_start, x_end = xlimits
         x_start = float(x_start)
         x_end = float(x_end)
-        plt.xlim((x_start, x_end))
+        ax.set_xlim((x_start, x_end))
     if ylimits is not None:
         y_start, y_end = ylimits
         y_start = float(y_start)
         y_end = float(y_end)
-        plt.ylim((y_start, y_end))
+        ax.set_ylim((y_start, y_end))
     
-    plt.yticks([])
-    plt.legend()
+    ax.set_yticks([])
+    ax.legend()
     # Make the legend text smaller and more compact
     if legend_params is not None:
         print("Applying legend parameters:", legend_params)
-        legend = plt.legend(**legend_params)
-    plt.gca().invert_xaxis()
-    #plt.show()
-    plt.savefig(output_name, dpi=600, bbox_inches='tight')
+        legend = ax.legend(**legend_params)
+    ax.invert_xaxis()
+    return fig
 
 
 
@@ -105,9 +119,8 @@ def main(yaml_config):
         cfg = yaml.safe_load(f)
 
     seaborn_flag = cfg.get('USE_SEABORN', False)
-    if seaborn_flag:
-        seaborn_params = cfg.get('SEABORN_PARAMS', {"style": "ticks", "context": "paper"})
-        apply_seaborn_style(seaborn_params)
+    seaborn_params = cfg.get('SEABORN_PARAMS', {"style": "ticks", "context": "paper"}) if seaborn_flag else None
+    style = plot_style(seaborn=seaborn_params, rc=PLOT_RC)
 
     file_entries = cfg.get('FILES', [])
     if not file_entries:
@@ -153,7 +166,7 @@ def main(yaml_config):
         all_input_list.append(file_input_list)
 
     # Do Plotting
-    plot_data(all_input_list, output_name, xlimits, ylimits, x_axis_label, scale_range, scale_mode, figure_size, legend_params)
+    plot_data(all_input_list, output_name, xlimits, ylimits, x_axis_label, scale_range, scale_mode, figure_size, legend_params, style=style)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Plot 1D NMR data from bruker files/folder.")
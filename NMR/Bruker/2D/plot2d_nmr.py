@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import nmrglue as ng
 import numpy as np
 import yaml
@@ -6,22 +5,36 @@ import argparse
 import logging
 from pathlib import Path
 import matplotlib as mpl
-mpl.rcParams["mathtext.fontset"] = "dejavuserif" # nicer omega symbol
-mpl.rcParams["contour.negative_linestyle"] = "solid" # make negative contours solid
+
+from labscripthub.instrument import stage
+from labscripthub.render import new_figure, plot_style, styled
 
 logging.basicConfig( level=logging.INFO, format='[%(levelname)s] %(message)s')
 
-def apply_seaborn_style(param_dict):
-    import seaborn as sns
-    sns.set_theme(**param_dict)
+PLOT_RC = {
+    "mathtext.fontset": "dejavuserif",  # nicer omega symbol
+    "contour.negative_linestyle": "solid",  # make negative contours solid
+}
+
+
+@stage('read')
+def read_spectrum(fname):
+    """Sparky (.ucsf) file -> (dic, data)"""
+    return ng.sparky.read(fname)
 
+def hsqc_plot(input_list, output_name, xlimits, ylimits, x_axis_label, y_axis_label, no_legend, style=None):
+    with styled(style):
+        fig = _hsqc_plot(input_list, xlimits, ylimits, x_axis_label, y_axis_label, no_legend)
+        with stage('save'):
+            fig.savefig(f"{output_name}", dpi=600)
 
-def hsqc_plot(input_list, output_name, xlimits, ylimits, x_axis_label, y_axis_label, no_legend):
+@stage('render')
+def _hsqc_plot(input_list, xlimits, ylimits, x_axis_label, y_axis_label, no_legend):
     ### Plotting stuff ###
 
-    fig = plt.figure()
+    fig = new_figure()
     ax = fig.add_subplot(111)
-    default_colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    default_colors = mpl.rcParams['axes.prop_cycle'].by_key()['color']
     color_iter = iter(default_colors)
     # loop over the files, colors and contour start
 
@@ -31,7 +44,7 @@ def hsqc_plot(input_list, output_name, xlimits, ylimits, x_axis_label, y_axis_la
         fname, color, label, cl, neg_list = spectrum_data # unpack the input list 
 
         # read in the data from the Sparky (.ucsf) file
-        dic, data = ng.sparky.read(fname)
+        dic, data = read_spectrum(fname)
 
         # make ppm scales for both dimensions.
         uc_x = ng.sparky.make_uc(dic, data, dim=1)
@@ -87,9 +100,9 @@ def hsqc_plot(input_list, output_name, xlimits, ylimits, x_axis_label, y_axis_la
             line.set_linewidth(2) 
 
         
-    plt.tight_layout()
+    fig.tight_layout()
 
-    fig.savefig(f"{output_name}", dpi=600) 
+    return fig
     
 
 def main(yaml_config):
@@ -98,9 +111,8 @@ def main(yaml_config):
         cfg = yaml.safe_load(f)
 
     seaborn_flag = cfg.get('USE_SEABORN', False)
-    if seaborn_flag:
-        seaborn_params = cfg.get('SEABORN_PARAMS', {"style": "ticks", "context": "paper"})
-        apply_seaborn_style(seaborn_params)
+    seaborn_params = cfg.get('SEABORN_PARAMS', {"style": "ticks", "context": "paper"}) if seaborn_flag else None
+    style = plot_style(seaborn=seaborn_params, rc=PLOT_RC)
 
     file_entries = cfg.get('FILES', [])
     if not file_entries:
@@ -156,7 +168,7 @@ def main(yaml_config):
             no_legend = False
             break
     # Do Plotting
-    hsqc_plot(all_input_list, output_name, xlimits, ylimits, x_axis_label, y_axis_label, no_legend)
+    hsqc_plot(all_input_list, output_name, xlimits, ylimits, x_axis_label, y_axis_label, no_legend, style=style)
 
 
 if __name__ == "__main__":
@@ -2,96 +2,348 @@ import argparse
 from pathlib import Path
 import pandas as pd
 import numpy as np
-from uncertainties import ufloat
 import yaml
 import logging
+import re
 import sys
+
+from labscripthub.instrument import stage
+
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 
-def process_file(input_file: Path, output_folder: Path, output_name: str, skiprows=None, sheet_name="All Cycles", reference_standard="Standard S12"):
-    # 1) Read the sheet, with skiprows if provided
+WELL_COLUMNS = ['Well\nRow', 'Well\nCol', 'Content', 'Group']
+
+def file_label(text) -> str:
+    """Plate or sample label usable in a file name ('/', ':' and the like become '_')."""
+    return re.sub(r'[^\w.-]+', '_', str(text)).strip('._') or 'unnamed'
+
+def expand_inputs(spec, suffixes=('.xlsx', '.xls')) -> list:
+    """
+    Turn a file name, directory, glob pattern or a list of those into a
+    sorted list of plate files.
+    """
+    import glob
+
+    specs = spec if isinstance(spec, (list, tuple)) else [spec]
+    files = []
+    for item in specs:
+        path = Path(item)
+        if path.is_dir():
+            files.extend(p for p in path.iterdir() if p.suffix.lower() in suffixes and not p.name.startswith('~$'))
+        elif path.exists():
+            files.append(path)
+        else:
+            files.extend(Path(p) for p in glob.glob(str(item), recursive=True))
+    return sorted(set(files))
+
+@stage('read')
+def read_plate(input_file: Path, skiprows=None, sheet_name="All Cycles"):
+    """
+    Read one plate export and keep it wide.
+
+    Returns the well annotation (Well Row/Col, Content, Group), the
+    polarization values as an (n_wells x n_cycles) array, the cycle column
+    names and the cycle times (first row below the header; NaN if missing).
+    """
+    # Read the sheet, with skiprows if provided
     if skiprows is not None:
         df = pd.read_excel(input_file, sheet_name=sheet_name, skiprows=skiprows)
     else:
         df = pd.read_excel(input_file, sheet_name=sheet_name)
 
-    # 2) Filter and reset index
+    cycle_columns = list(df.columns[4:])
+    times = pd.to_numeric(df.iloc[0][cycle_columns], errors='coerce').to_numpy(dtype=float)
     filtered_data = df.iloc[1:].reset_index(drop=True)
+    wells = filtered_data[WELL_COLUMNS]
+    raw = filtered_data[cycle_columns].to_numpy()
+    values = pd.to_numeric(pd.Series(raw.ravel()), errors='coerce').to_numpy(dtype=float).reshape(raw.shape)
+    return wells, values, cycle_columns, times
 
-    # 3) Melt all polarization columns into one
-    melted_data = pd.melt(
-        filtered_data,
-        id_vars=['Well\nRow', 'Well\nCol', 'Content', 'Group'],
-        value_vars=filtered_data.columns[4:],
-        var_name='Time',
-        value_name='Polarization'
-    )
-    melted_data['Polarization'] = pd.to_numeric(melted_data['Polarization'], errors='coerce')
+def group_index(wells: pd.DataFrame):
+    """
+    Integer code per well for its (Group, Content) pair, plus the sorted pairs.
+    Wells without a Group or Content get -1, as pandas' groupby would drop them.
+    """
+    keys = wells[['Group', 'Content']]
+    valid = keys.notna().all(axis=1).to_numpy()
+    pairs = pd.MultiIndex.from_frame(keys[valid]).unique().sort_values()
+    codes = np.full(len(wells), -1)
+    codes[valid] = pairs.get_indexer(pd.MultiIndex.from_frame(keys[valid]))
+    return codes, pairs
 
-    # 4) Group & aggregate
-    grouped = melted_data.groupby(['Group', 'Content'])['Polarization']
-    summary = grouped.agg(
-        Mean='mean',
-        Std='std' # Pandas default is ddof=1, which is what we want
-    )
+@stage('compute')
+def summarize_plate(wells: pd.DataFrame, values: np.ndarray, reference_standard="Standard S12") -> pd.DataFrame:
+    """
+    Mean/Std per (Group, Content) over all wells and cycles, referenced and
+    scaled per group.
+    """
+    # 1) Group & aggregate on the wide matrix (no melt into one long column)
+    codes, pairs = group_index(wells)
+    keep = codes >= 0
+    per_group = pd.DataFrame(values[keep]).groupby(codes[keep])
+    count = per_group.count().sum(axis=1).to_numpy()
+    mean = per_group.sum().sum(axis=1).to_numpy() / count
+    # Second pass on the deviations for a numerically stable std (ddof=1, as pandas)
+    deviations = (values[keep] - mean[codes[keep]][:, None]) ** 2
+    sum_sq = pd.DataFrame(deviations).groupby(codes[keep]).sum().sum(axis=1).to_numpy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(sum_sq / (count - 1))
 
-    # 5) Flatten to DataFrame
-    final = summary.reset_index()
-    final.columns = ['Group', 'Content', 'Mean', 'Std']
+    # 2) Flatten to DataFrame
+    final = pairs.to_frame(index=False)
+    final.columns = ['Group', 'Content']
+    final['Mean'] = mean
+    final['Std'] = std
 
-    # 6) Sort by Group, then numerically by Content
-    try:
-        final['Content_Num'] = final['Content'].str.extract(r'(\d+)').astype(int)
-    except ValueError:
-        logging.error("A numeric value could not be extracted from 'Content'. To sort the values, they need numbers from 1-X.\nAborting")
-        sys.exit(1)
-    final = final.sort_values(['Group', 'Content_Num']).drop('Content_Num', axis=1)
+    # 3) Sort by Group, then numerically by Content
+    final = sort_by_content(final)
 
-    # 7) Create ufloats and subtract reference
-    final['Mean_U'] = final.apply(lambda r: ufloat(r['Mean'], r['Std']), axis=1)
-    refs = final[final['Content'] == reference_standard].set_index('Group')['Mean_U']
-    final['Diff_U'] = final.apply(lambda r: r['Mean_U'] - refs[r['Group']], axis=1)
-    final['Mean_SubRef'], final['Std_SubRef'] = zip(*final['Diff_U'].apply(lambda x: (x.n, x.s)))
-    #final['Mean_SubRef'] = final.apply(lambda r: (r['Mean_U'] - refs[r['Group']]).n, axis=1)
-    #final['Std_SubRef']  = final.apply(lambda r: (r['Mean_U'] - refs[r['Group']]).s, axis=1)
+    # 4) Subtract the reference of each group and propagate the (uncorrelated) errors
+    refs = final[final['Content'] == reference_standard].set_index('Group')
+    missing = sorted(set(final['Group']) - set(refs.index))
+    if missing:
+        raise ValueError(f"No '{reference_standard}' found for group(s) {missing}.")
+    ref_mean = final['Group'].map(refs['Mean'])
+    ref_std  = final['Group'].map(refs['Std'])
+    final['Mean_SubRef'] = final['Mean'] - ref_mean
+    final['Std_SubRef']  = np.sqrt(final['Std']**2 + ref_std**2)
+    # The reference minus itself is fully correlated: exactly 0 ± 0 (as in `uncertainties`)
+    is_ref = final['Content'] == reference_standard
+    final.loc[is_ref, 'Std_SubRef'] = 0 * final.loc[is_ref, 'Std']
 
-    # 8) Scale to the maximum per group
+    # 5) Scale to the maximum per group
     max_subref = final.groupby('Group')['Mean_SubRef'].transform('max')
     final['Mean_Scaled'] = 100 * final['Mean_SubRef'] / max_subref
     final['Std_Scaled']  = 100 * final['Std_SubRef']  / max_subref
+    return final
+
+def sort_by_content(frame: pd.DataFrame) -> pd.DataFrame:
+    """Sort by Group, then numerically by the number in Content."""
+    try:
+        content_num = frame['Content'].str.extract(r'(\d+)', expand=False).astype(int)
+    except ValueError:
+        raise ValueError("A numeric value could not be extracted from 'Content'. "
+                         "To sort the values, they need numbers from 1-X.") from None
+    return frame.assign(Content_Num=content_num).sort_values(['Group', 'Content_Num']).drop('Content_Num', axis=1)
+
+@stage('compute')
+def kinetic_summary(wells: pd.DataFrame, values: np.ndarray, times: np.ndarray):
+    """
+    Per-cycle Mean/Std per (Group, Content), computed as grouped reductions
+    over the rows of the wide (well x cycle) matrix. Columns are the cycle times.
+    """
+    codes, pairs = group_index(wells)
+    keep = codes >= 0
+    grouped = pd.DataFrame(values[keep], columns=times).groupby(codes[keep])
+    tables = []
+    for stat in (grouped.mean(), grouped.std()):
+        stat.index = pairs[stat.index]
+        stat.index.names = ['Group', 'Content']
+        tables.append(sort_by_content(stat.reset_index()))
+    return tables
+
+def approach_to_equilibrium(t, y_eq, y0, k):
+    """Exponential approach from y0 (at t=0) to the equilibrium value y_eq."""
+    return y_eq + (y0 - y_eq) * np.exp(-k * t)
+
+def _fit_wells(chunk: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """Fit `approach_to_equilibrium` to every well (row) of a chunk."""
+    from scipy.optimize import curve_fit
+
+    t = times - times[0]
+    span = t[-1] if t[-1] > 0 else 1.0
+    results = np.full((len(chunk), 4), np.nan)
+    for idx, y in enumerate(chunk):
+        mask = np.isfinite(y)
+        if mask.sum() < 4:
+            continue
+        p0 = [y[mask][-1], y[mask][0], 3 / span]
+        try:
+            popt, _ = curve_fit(approach_to_equilibrium, t[mask], y[mask], p0=p0,
+                                bounds=([-np.inf, -np.inf, 0], [np.inf, np.inf, np.inf]), maxfev=5000)
+        except (RuntimeError, ValueError):
+            continue
+        rmse = np.sqrt(np.mean((approach_to_equilibrium(t[mask], *popt) - y[mask]) ** 2))
+        results[idx] = [*popt, rmse]
+    return results
 
-    # 9) Clean up interim columns
-    #final = final.drop(columns=['Mean_U', 'Mean', 'Std', 'Mean_SubRef', 'Std_SubRef'], errors='ignore')
-    final = final.drop(columns=['Mean_U', 'Diff_U'], errors='ignore')
+@stage('fit')
+def fit_equilibration(wells: pd.DataFrame, values: np.ndarray, times: np.ndarray, workers=None) -> pd.DataFrame:
+    """
+    Fit an exponential approach to equilibrium per well across a process pool.
+
+    A well counts as equilibrated when 95 % of the approach (t95 = 3/k) is
+    reached within the measured time.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+
+    n_chunks = min(len(values), 4 * (workers or 8)) or 1
+    chunks = np.array_split(values, n_chunks)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = np.vstack(list(pool.map(partial(_fit_wells, times=times), chunks)))
+
+    fits = wells.copy()
+    fits['Y_Eq'], fits['Y0'], fits['K'], fits['RMSE'] = results.T
+    with np.errstate(divide='ignore'):
+        fits['Tau'] = 1 / fits['K']
+    fits['T95'] = 3 * fits['Tau']
+    fits['Equilibrated'] = fits['T95'] <= times[-1] - times[0]
+    return fits
+
+def process_file(input_file: Path, output_folder: Path, output_name: str, skiprows=None, sheet_name="All Cycles", reference_standard="Standard S12", kinetic=None):
+    """
+    Summarize one plate and write it to output_folder / output_name.
+
+    kinetic: optional dict (FIT, WORKERS) to also write per-cycle statistics
+             and per-well equilibration fits to <output_name>_kinetic.xlsx
+    """
+    wells, values, cycle_columns, times = read_plate(input_file, skiprows=skiprows, sheet_name=sheet_name)
+    final = summarize_plate(wells, values, reference_standard=reference_standard)
 
-    # 10) Write out
     output_file = output_folder / output_name
-    final.to_excel(output_file, index=False)
+    with stage('save'):
+        final.to_excel(output_file, index=False)
     logging.info(f"Processed data written to {output_file}")
 
+    if kinetic is not None:
+        if not np.isfinite(times).all():
+            logging.warning("No cycle times found in the first row, using the cycle number instead.")
+            times = np.arange(len(cycle_columns), dtype=float)
+        mean, std = kinetic_summary(wells, values, times)
+        fits = None
+        if kinetic.get('FIT', True):
+            fits = fit_equilibration(wells, values, times, workers=kinetic.get('WORKERS', None))
+            n_eq = int(fits['Equilibrated'].sum())
+            logging.info(f"{n_eq} of {len(fits)} wells equilibrated within the measurement; "
+                         f"slowest well reaches 95 % after {np.nanmax(fits['T95']):.4g} (time units of the export)")
+        kinetic_file = output_folder / f"{Path(output_name).stem}_kinetic.xlsx"
+        with stage('save'), pd.ExcelWriter(kinetic_file) as writer:
+            mean.to_excel(writer, sheet_name='Mean', index=False)
+            std.to_excel(writer, sheet_name='Std', index=False)
+            if fits is not None:
+                fits.to_excel(writer, sheet_name='Well_Fits', index=False)
+        logging.info(f"Kinetic data written to {kinetic_file}")
+
+def process_plate(input_file: Path, skiprows=None, sheet_name="All Cycles", reference_standard="Standard S12") -> pd.DataFrame:
+    """Summary of one plate with its plate ID columns; runs in a worker process in batch mode."""
+    wells, values, _, _ = read_plate(input_file, skiprows=skiprows, sheet_name=sheet_name)
+    final = summarize_plate(wells, values, reference_standard=reference_standard)
+    final[['Group', 'Content']] = final[['Group', 'Content']].astype(str)
+    final.insert(0, 'Source_File', str(input_file))
+    final.insert(0, 'Plate', Path(input_file).stem)
+    return final
+
+def process_batch(files: list, output_file: Path, skiprows=None, sheet_name="All Cycles", reference_standard="Standard S12", workers=None):
+    """
+    Summarize many plates across a process pool into one CSV or Parquet file.
+
+    Rows are appended in the order of `files` as soon as a plate and the ones
+    before it are done, so only plates that finished early are held in memory
+    and the output is the same on every run. Plates that fail are skipped and
+    listed in <output>_manifest.csv together with the plates that succeeded.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    parquet = output_file.suffix.lower() == '.parquet'
+    if parquet:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    writer = None
+    written = 0
+    manifest = []
+    # A file of an earlier run must not survive a run in which every plate fails
+    output_file.unlink(missing_ok=True)
+    try:
+        # The plates are read and summarized in the workers, written here
+        with stage('batch'), ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(process_plate, fn, skiprows, sheet_name, reference_standard): i
+                       for i, fn in enumerate(files)}
+            done = {}
+            next_index = 0
+            for fut in as_completed(futures):
+                done[futures[fut]] = fut
+                while next_index in done:
+                    fn = files[next_index]
+                    fut = done.pop(next_index)
+                    next_index += 1
+                    try:
+                        final = fut.result()
+                    except Exception as exc:
+                        logging.error(f"Failed on {fn}: {exc}")
+                        manifest.append({'Plate': fn.stem, 'Source_File': str(fn), 'Status': 'failed', 'Rows': 0,
+                                         'Error': f"{type(exc).__name__}: {exc}"})
+                        continue
+                    if parquet:
+                        table = pa.Table.from_pandas(final, preserve_index=False)
+                        if writer is None:
+                            writer = pq.ParquetWriter(output_file, table.schema)
+                        writer.write_table(table.cast(writer.schema))
+                    else:
+                        final.to_csv(output_file, mode='a' if written else 'w', header=not written, index=False)
+                    written += 1
+                    manifest.append({'Plate': fn.stem, 'Source_File': str(fn), 'Status': 'ok', 'Rows': len(final), 'Error': ''})
+                    logging.info(f"Processed {fn} ({len(manifest)}/{len(files)})")
+    finally:
+        if writer is not None:
+            writer.close()
+
+    manifest = pd.DataFrame(manifest, columns=['Plate', 'Source_File', 'Status', 'Rows', 'Error'])
+    manifest_file = output_file.with_name(f"{output_file.stem}_manifest.csv")
+    manifest.sort_values('Plate').to_csv(manifest_file, index=False)
+    failed = int((manifest['Status'] == 'failed').sum())
+    logging.info(f"{len(manifest) - failed} plate(s) written to {output_file}; {failed} failed (see {manifest_file}).")
+
 def main(yaml_config: Path):
     # Load YAML
     with open(yaml_config, 'r') as f:
         cfg = yaml.safe_load(f)
 
-    # Required
-    input_file = Path(cfg['FILENAME'])
+    # Required: FILENAME (one plate) or FILES (batch: folder, glob or list)
+    if 'FILES' not in cfg and 'FILENAME' not in cfg:
+        logging.error("Config YAML must contain either 'FILENAME' or 'FILES'.")
+        sys.exit(1)
     # Optional
     output_folder        = Path(cfg.get('OUTPUT_FOLDER', '.'))
-    output_name          = cfg.get('OUTPUT_NAME', f"preprocessed_{input_file.stem}")
     skiprows             = cfg.get('SKIPROWS', None)
     sheet_name           = cfg.get('SHEET_NAME', 'All Cycles')
     reference_standard   = cfg.get('REFERENCE_STANDARD', 'Standard S12')
+    kinetic              = cfg.get('KINETIC', None)
+    if kinetic is True:
+        kinetic = {}
+    elif not kinetic:
+        kinetic = None
 
     # Prepare output folder
     output_folder.mkdir(parents=True, exist_ok=True)
 
+    if 'FILES' in cfg:
+        files = expand_inputs(cfg['FILES'])
+        if not files:
+            logging.error(f"No plate files found for {cfg['FILES']}.")
+            sys.exit(1)
+        output_name = cfg.get('OUTPUT_NAME', 'preprocessed_batch.csv')
+        if Path(output_name).suffix.lower() not in ('.csv', '.parquet'):
+            output_name += '.csv'
+        if kinetic is not None:
+            logging.warning("KINETIC is only supported for a single FILENAME and is ignored in batch mode.")
+        process_batch(files, output_folder / output_name, skiprows=skiprows, sheet_name=sheet_name,
+                      reference_standard=reference_standard, workers=cfg.get('WORKERS', None))
+        return
+
+    input_file = Path(cfg['FILENAME'])
+    output_name = cfg.get('OUTPUT_NAME', f"preprocessed_{input_file.stem}")
+
     # Check if output filename has .xlsx extension
     if not output_name.endswith('.xlsx'):
         output_name += '.xlsx'
 
     # Run
-    process_file(input_file, output_folder, output_name=output_name, skiprows=skiprows, sheet_name=sheet_name, reference_standard=reference_standard)
+    try:
+        process_file(input_file, output_folder, output_name=output_name, skiprows=skiprows, sheet_name=sheet_name, reference_standard=reference_standard, kinetic=kinetic)
+    except ValueError as exc:
+        logging.error(f"{exc}\nAborting")
+        sys.exit(1)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process a polarization-time Excel file per a YAML config.')
@@ -0,0 +1,262 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+import glob
+import logging
+import sys
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from labscripthub.instrument import stage
+from FP_Assay_preprocessing import file_label
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+# Models -------------------------------------------------------------------------
+# R: total titrant (receptor) concentration, L: total tracer concentration.
+# Both return the signal on the scale of Mean_Scaled (0-100).
+
+def quadratic_model(R, bottom, top, kd, L):
+    """1:1 binding with ligand depletion (exact solution of the quadratic)."""
+    b = L + R + kd
+    fraction_bound = (b - np.sqrt(np.maximum(b ** 2 - 4 * L * R, 0))) / (2 * L)
+    return bottom + (top - bottom) * fraction_bound
+
+def hill_model(R, bottom, top, kd, n):
+    """Hill equation; kd is the half-saturating titrant concentration."""
+    return bottom + (top - bottom) * R ** n / (kd ** n + R ** n)
+
+PARAMETERS = {
+    'quadratic': ['Bottom', 'Top', 'Kd'],
+    'hill': ['Bottom', 'Top', 'Kd', 'Hill'],
+}
+
+def fit_group(conc, mean, std, model, tracer_conc):
+    """
+    Weighted least-squares fit of one binding curve.
+
+    Points are weighted by 1/Std_Scaled. Missing or zero errors get the median
+    error of the curve. Kd and the Hill coefficient are fitted on a log scale,
+    which keeps them positive without bounds, so the fast unconstrained
+    Levenberg-Marquardt solver can be used. Their errors follow from the
+    delta method. Parameter errors are scaled by the reduced chi-square.
+    """
+    from scipy.optimize import curve_fit
+
+    mask = np.isfinite(conc) & np.isfinite(mean) & (conc > 0)
+    conc, mean, std = conc[mask], mean[mask], std[mask]
+    names = PARAMETERS[model]
+    result = {'Model': model, 'N': int(mask.sum())}
+    if conc.size <= len(names):
+        result['Message'] = 'Too few points'
+        return result
+
+    good_std = np.isfinite(std) & (std > 0)
+    sigma = np.where(good_std, std, np.median(std[good_std]) if good_std.any() else 1.0)
+
+    if model == 'quadratic':
+        def func(x, bottom, top, log_kd):
+            return quadratic_model(x, bottom, top, np.exp(log_kd), tracer_conc)
+        p0 = [mean.min(), mean.max(), np.mean(np.log(conc))]
+    else:
+        def func(x, bottom, top, log_kd, log_n):
+            return hill_model(x, bottom, top, np.exp(log_kd), np.exp(log_n))
+        p0 = [mean.min(), mean.max(), np.mean(np.log(conc)), 0.0]
+
+    try:
+        popt, pcov = curve_fit(func, conc, mean, p0=p0, sigma=sigma, absolute_sigma=False, maxfev=10000)
+    except (RuntimeError, ValueError) as exc:
+        result['Message'] = str(exc)
+        return result
+
+    perr = np.sqrt(np.diag(pcov))
+    values = popt.copy()
+    errors = perr.copy()
+    # log-parameters back to linear scale (delta method: d exp(p) = exp(p) dp)
+    values[2:] = np.exp(popt[2:])
+    errors[2:] = values[2:] * perr[2:]
+    for name, value, error in zip(names, values, errors):
+        result[name] = value
+        result[f'{name}_Err'] = error
+
+    residuals = mean - func(conc, *popt)
+    chi2 = float(np.sum((residuals / sigma) ** 2))
+    dof = conc.size - len(names)
+    ss_tot = float(np.sum((mean - mean.mean()) ** 2))
+    result['R2'] = 1 - float(np.sum(residuals ** 2)) / ss_tot if ss_tot > 0 else np.nan
+    result['Chi2_Red'] = chi2 / dof
+    result['AIC'] = conc.size * np.log(chi2 / conc.size) + 2 * len(names)
+    result['Message'] = 'OK'
+    return result
+
+# Batch ------------------------------------------------------------------------
+
+def plot_group(curve, fits, output_file, conc_unit, dpi):
+    """Data with error bars and the fitted curves of one group."""
+    # Object-oriented figure on its own canvas: safe inside worker processes
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(4, 3))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.errorbar(curve['Conc'], curve['Mean_Scaled'], yerr=curve['Std_Scaled'],
+                fmt='s', color='black', markersize=4, capsize=2, linewidth=0.8)
+    conc = curve['Conc'].to_numpy(dtype=float)
+    conc = conc[conc > 0]
+    x = np.geomspace(conc.min() / 2, conc.max() * 2, 200)
+    for fit in fits:
+        if fit.get('Message') != 'OK':
+            continue
+        params = [fit[name] for name in PARAMETERS[fit['Model']]]
+        if fit['Model'] == 'quadratic':
+            y = quadratic_model(x, *params, L=fit['Tracer_Conc'])
+        else:
+            y = hill_model(x, *params)
+        ax.plot(x, y, linewidth=1,
+                label=f"{fit['Model']}: Kd = {fit['Kd']:.3g} ± {fit['Kd_Err']:.2g}")
+    ax.set_xscale('log')
+    ax.set_xlabel(f'Concentration [{conc_unit}]')
+    ax.set_ylabel('Polarization [%]')
+    ax.set_title(f"{curve['Plate'].iloc[0]} – {curve['Group'].iloc[0]}", fontsize=9)
+    ax.legend(fontsize=7)
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=dpi)
+
+def fit_task(task, models, tracer_conc, plot_folder, conc_unit, dpi):
+    """Fit all models to one (plate, group) curve; runs in a worker process."""
+    (plate, group), curve = task
+    conc = curve['Conc'].to_numpy(dtype=float)
+    mean = curve['Mean_Scaled'].to_numpy(dtype=float)
+    std = curve['Std_Scaled'].to_numpy(dtype=float)
+    fits = []
+    for model in models:
+        fit = {'Plate': plate, 'Group': group, 'Tracer_Conc': tracer_conc if model == 'quadratic' else np.nan}
+        fit.update(fit_group(conc, mean, std, model, tracer_conc))
+        fits.append(fit)
+    if plot_folder is not None:
+        plot_group(curve, fits, Path(plot_folder) / f"{file_label(plate)}_{file_label(group)}.png", conc_unit, dpi)
+    return fits
+
+def concentration_map(cfg, contents):
+    """Content -> concentration, either listed explicitly or as a dilution series."""
+    if 'CONCENTRATIONS' in cfg:
+        return {str(k): float(v) for k, v in cfg['CONCENTRATIONS'].items()}
+    if 'CONCENTRATION_SERIES' in cfg:
+        series = cfg['CONCENTRATION_SERIES']
+        start = float(series['START'])
+        dilution = float(series.get('DILUTION', 2))
+        mapping = {}
+        for content in contents:
+            number = pd.Series([content]).str.extract(r'(\d+)', expand=False).iloc[0]
+            if pd.notna(number):
+                mapping[content] = start / dilution ** (int(number) - 1)
+        return mapping
+    logging.error("Config YAML must contain either 'CONCENTRATIONS' or 'CONCENTRATION_SERIES'.")
+    sys.exit(1)
+
+@stage('read')
+def read_inputs(patterns):
+    """Read preprocessed tables (xlsx, csv or parquet); the plate ID is the 'Plate' column or the file name."""
+    frames = []
+    for pattern in patterns:
+        files = sorted(glob.glob(str(pattern))) or [pattern]
+        for fn in files:
+            fn = Path(fn)
+            if fn.suffix.lower() == '.csv':
+                df = pd.read_csv(fn)
+            elif fn.suffix.lower() == '.parquet':
+                df = pd.read_parquet(fn)
+            else:
+                df = pd.read_excel(fn)
+            if 'Plate' not in df.columns:
+                df['Plate'] = fn.stem
+            frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+def main(yaml_config: Path):
+    # Load YAML
+    with open(yaml_config, 'r') as f:
+        cfg = yaml.safe_load(f)
+
+    # Required
+    patterns = cfg.get('FILES', [])
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    if not patterns:
+        raise ValueError("Config YAML must contain a 'FILES' list with at least one entry.")
+    # Optional
+    output_folder = Path(cfg.get('OUTPUT_FOLDER', '.'))
+    output_name   = cfg.get('OUTPUT_NAME', 'kd_fits')
+    models        = [m.lower() for m in cfg.get('MODELS', ['quadratic', 'hill'])]
+    tracer_conc   = float(cfg.get('TRACER_CONC', 0.0))
+    exclude       = cfg.get('EXCLUDE', [cfg.get('REFERENCE_STANDARD', 'Standard S12')])
+    conc_unit     = cfg.get('CONC_UNIT', 'µM')
+    workers       = cfg.get('WORKERS', None)
+    plot          = cfg.get('PLOT', False)
+    dpi           = cfg.get('DPI', 300)
+
+    unknown = [m for m in models if m not in PARAMETERS]
+    if unknown:
+        logging.error(f"Unknown model(s) {unknown}. Choose from {list(PARAMETERS)}.")
+        sys.exit(1)
+    if 'quadratic' in models and tracer_conc <= 0:
+        logging.error("The quadratic model needs the total tracer concentration TRACER_CONC (> 0).")
+        sys.exit(1)
+
+    output_folder.mkdir(parents=True, exist_ok=True)
+    if not output_name.endswith('.xlsx'):
+        output_name += '.xlsx'
+    plot_folder = None
+    if plot:
+        plot_folder = output_folder / 'fit_plots'
+        plot_folder.mkdir(parents=True, exist_ok=True)
+
+    # Map Content to concentrations
+    data = read_inputs(patterns)
+    data = data[~data['Content'].isin(exclude)]
+    mapping = concentration_map(cfg, data['Content'].unique())
+    data = data.assign(Conc=data['Content'].map(mapping))
+    unmapped = sorted(data.loc[data['Conc'].isna(), 'Content'].unique())
+    if unmapped:
+        logging.warning(f"No concentration for {unmapped}; these points are not fitted.")
+    data = data.dropna(subset=['Conc'])
+    if data.empty:
+        logging.error("No points with a concentration are left to fit; check CONCENTRATIONS or CONCENTRATION_SERIES "
+                      "against the Content of the plates.")
+        sys.exit(1)
+
+    # Fit every (plate, group) on a process pool
+    tasks = list(data.groupby(['Plate', 'Group'], sort=True))
+    worker = partial(fit_task, models=models, tracer_conc=tracer_conc, plot_folder=plot_folder,
+                     conc_unit=conc_unit, dpi=dpi)
+    chunksize = max(1, len(tasks) // (4 * (workers or 8)))
+    with stage('fit'), ProcessPoolExecutor(max_workers=workers) as pool:
+        results = [fit for fits in pool.map(worker, tasks, chunksize=chunksize) for fit in fits]
+
+    table = pd.DataFrame(results)
+    output_file = output_folder / output_name
+    with stage('save'):
+        table.to_excel(output_file, index=False)
+    failed = int((table['Message'] != 'OK').sum())
+    logging.info(f"Fitted {len(tasks)} curve(s) with {len(models)} model(s); {failed} fit(s) failed.")
+    logging.info(f"Fit results written to {output_file}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit FP binding curves (Kd) for all groups and plates per a YAML config.')
+    parser.add_argument(
+        "yaml_config",
+        nargs="?",
+        default=None,
+        help="Path to the YAML configuration file (default: ./fit_input.yaml)"
+    )
+
+    args = parser.parse_args()
+
+    if args.yaml_config is None:
+        logging.info("No YAML specified, defaulting to ./fit_input.yaml")
+        args.yaml_config = "fit_input.yaml"
+
+    main(args.yaml_config)
@@ -0,0 +1,309 @@
+"""
+Plate QC for CLARIOstar FP screens, run before any fitting.
+
+Per plate (endpoint = mean over all cycles of a well):
+    Z_Prime       1 - 3 (sd_pos + sd_neg) / |mean_pos - mean_neg|
+    Signal_Window (|mean_pos - mean_neg| - 3 (sd_pos + sd_neg)) / sd_pos
+    CV            per control well group (Group x Content), in %
+    Edge_Effect   mean deviation of the outer ring minus the inner wells, in %
+    Row/Col_Trend change of the median-polish row/column effects across the plate, in %
+    Drift         change of the plate median from the first to the last cycle, in %
+
+Deviations are taken relative to the mean of each well's (Group, Content), so
+plate patterns are not confused with the plate layout.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+import logging
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from FP_Assay_preprocessing import read_plate, group_index, expand_inputs, file_label
+from labscripthub.instrument import stage  # on sys.path through FP_Assay_preprocessing
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+# Standard plate formats as (rows, columns)
+PLATE_FORMATS = [(8, 12), (16, 24), (32, 48)]
+
+@contextmanager
+def _quiet():
+    """Silence the warnings of empty (all-NaN) rows, columns and groups."""
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        yield
+
+def _row_number(label: str) -> int:
+    number = 0
+    for letter in label:
+        number = 26 * number + ord(letter) - ord('A') + 1
+    return number - 1
+
+def well_positions(wells: pd.DataFrame):
+    """
+    Zero-based (row, column) index of every well and the plate shape.
+
+    Row labels are letters (A..Z, AA..AF for 1536-well plates). The shape is
+    the smallest standard format that holds all wells.
+    """
+    labels = wells['Well\nRow'].astype(str).str.strip().str.upper()
+    # 'A' -> 0, 'Z' -> 25, 'AA' -> 26, ...; only the distinct labels are converted
+    numbers = {label: _row_number(label) for label in labels.unique()}
+    rows = labels.map(numbers).to_numpy(dtype=int)
+    cols = pd.to_numeric(wells['Well\nCol'], errors='coerce').to_numpy(dtype=float)
+    cols = np.where(np.isfinite(cols), cols, 0).astype(int) - 1
+    n_rows, n_cols = rows.max() + 1, cols.max() + 1
+    shape = next(((r, c) for r, c in PLATE_FORMATS if n_rows <= r and n_cols <= c), (n_rows, n_cols))
+    return rows, cols, shape
+
+def median_polish(matrix: np.ndarray, max_iter=10, tol=1e-6):
+    """
+    Tukey's median polish of a 2D array (NaN = empty well).
+
+    Returns the overall value, row effects, column effects and residuals.
+    """
+    resid = np.array(matrix, dtype=float)
+    overall = 0.0
+    row_eff = np.zeros(resid.shape[0])
+    col_eff = np.zeros(resid.shape[1])
+    with _quiet():
+        for _ in range(max_iter):
+            r = np.nan_to_num(np.nanmedian(resid, axis=1))
+            resid -= r[:, None]
+            row_eff += r
+            m = np.nan_to_num(np.nanmedian(col_eff))
+            col_eff -= m
+            overall += m
+            c = np.nan_to_num(np.nanmedian(resid, axis=0))
+            resid -= c[None, :]
+            col_eff += c
+            m = np.nan_to_num(np.nanmedian(row_eff))
+            row_eff -= m
+            overall += m
+            if max(np.abs(r).max(), np.abs(c).max()) < tol:
+                break
+    return overall, row_eff, col_eff, resid
+
+def _trend(effects: np.ndarray) -> float:
+    """Linear change of the effects from the first to the last row/column."""
+    x = np.arange(len(effects), dtype=float)
+    slope = np.polyfit(x, effects, 1)[0]
+    return float(slope * (len(effects) - 1))
+
+def plate_qc(wells: pd.DataFrame, values: np.ndarray, times: np.ndarray,
+             positive_control: str, negative_control: str):
+    """
+    QC metrics of one plate.
+
+    Returns a dict of plate metrics, a table of control CVs and the endpoint
+    and relative-deviation plate maps (rows x columns) for the heatmaps.
+    """
+    rows, cols, shape = well_positions(wells)
+    with _quiet():
+        endpoint = np.nanmean(values, axis=1)
+
+    # Deviation of every well from the mean of its (Group, Content), in %
+    codes, pairs = group_index(wells)
+    keep = (codes >= 0) & np.isfinite(endpoint)
+    sums = np.bincount(codes[keep], weights=endpoint[keep], minlength=len(pairs))
+    counts = np.bincount(codes[keep], minlength=len(pairs))
+    with _quiet():
+        group_mean = sums / counts
+        deviation = np.where(keep, 100 * (endpoint / group_mean[np.maximum(codes, 0)] - 1), np.nan)
+    # Single wells cannot deviate from themselves
+    deviation[keep & (counts[np.maximum(codes, 0)] < 2)] = np.nan
+
+    signal_map = np.full(shape, np.nan)
+    signal_map[rows, cols] = endpoint
+    deviation_map = np.full(shape, np.nan)
+    deviation_map[rows, cols] = deviation
+
+    # Controls
+    content = wells['Content'].to_numpy()
+    pos = endpoint[(content == positive_control) & np.isfinite(endpoint)]
+    neg = endpoint[(content == negative_control) & np.isfinite(endpoint)]
+    metrics = {'Wells': int(np.isfinite(endpoint).sum()), 'N_Pos': pos.size, 'N_Neg': neg.size}
+    if pos.size > 1 and neg.size > 1:
+        mean_pos, sd_pos = pos.mean(), pos.std(ddof=1)
+        mean_neg, sd_neg = neg.mean(), neg.std(ddof=1)
+        band = abs(mean_pos - mean_neg)
+        metrics.update({
+            'Mean_Pos': mean_pos, 'Std_Pos': sd_pos, 'Mean_Neg': mean_neg, 'Std_Neg': sd_neg,
+            'Z_Prime': 1 - 3 * (sd_pos + sd_neg) / band if band > 0 else np.nan,
+            'Signal_Window': (band - 3 * (sd_pos + sd_neg)) / sd_pos if sd_pos > 0 else np.nan,
+        })
+    else:
+        logging.warning(f"Fewer than two '{positive_control}' or '{negative_control}' wells; no Z' or signal window.")
+
+    # CV of every control well group
+    is_control = np.isin(content, [positive_control, negative_control]) & keep
+    control = pd.DataFrame({'Group': wells['Group'].to_numpy()[is_control],
+                            'Content': content[is_control], 'Value': endpoint[is_control]})
+    cv = control.groupby(['Group', 'Content'])['Value'].agg(['count', 'mean', 'std']).reset_index()
+    cv.columns = ['Group', 'Content', 'N', 'Mean', 'Std']
+    cv['CV'] = 100 * cv['Std'] / cv['Mean'].abs()
+    metrics['CV_Max'] = cv['CV'].max() if not cv.empty else np.nan
+
+    # Edge effect: outer ring vs. inner wells
+    edge = np.zeros(shape, dtype=bool)
+    edge[[0, -1], :] = True
+    edge[:, [0, -1]] = True
+    with _quiet():
+        metrics['Edge_Effect'] = np.nanmean(deviation_map[edge]) - np.nanmean(deviation_map[~edge])
+
+        # Row/column trends from the median polish of the deviations
+        _, row_eff, col_eff, _ = median_polish(deviation_map)
+        metrics['Row_Trend'] = _trend(row_eff)
+        metrics['Col_Trend'] = _trend(col_eff)
+
+        # Drift of the plate median over the cycles
+        if values.shape[1] > 1:
+            t = times if np.isfinite(times).all() else np.arange(values.shape[1], dtype=float)
+            plate_median = np.nanmedian(values, axis=0)
+            ok = np.isfinite(plate_median)
+            slope = np.polyfit(t[ok], plate_median[ok], 1)[0]
+            metrics['Drift'] = 100 * slope * (t[ok][-1] - t[ok][0]) / np.mean(plate_median[ok])
+        else:
+            metrics['Drift'] = np.nan
+    return metrics, cv, signal_map, deviation_map
+
+def plot_heatmaps(plate, signal_map, deviation_map, output_file, dpi=150):
+    """Endpoint signal and relative deviation of every well, side by side."""
+    # Object-oriented figure on its own canvas: safe inside worker processes
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    n_rows, n_cols = signal_map.shape
+    fig = Figure(figsize=(2 * (2 + n_cols / 4), 1 + n_rows / 4))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(1, 2)
+    limit = np.nanmax(np.abs(deviation_map)) if np.isfinite(deviation_map).any() else 1.0
+    panels = [(signal_map, 'viridis', None, 'Endpoint polarization'),
+              (deviation_map, 'RdBu_r', (-limit, limit), 'Deviation from group mean [%]')]
+    row_labels = [chr(ord('A') + i) if i < 26 else 'A' + chr(ord('A') + i - 26) for i in range(n_rows)]
+    step = 1 if n_rows <= 16 else 2
+    for ax, (data, cmap, limits, title) in zip(axes, panels):
+        image = ax.imshow(data, cmap=cmap, aspect='equal',
+                          vmin=limits[0] if limits else None, vmax=limits[1] if limits else None)
+        ax.set_xticks(range(0, n_cols, step))
+        ax.set_xticklabels(range(1, n_cols + 1, step), fontsize=6)
+        ax.set_yticks(range(0, n_rows, step))
+        ax.set_yticklabels(row_labels[::step], fontsize=6)
+        ax.set_title(title, fontsize=8)
+        fig.colorbar(image, ax=ax, shrink=0.8)
+    fig.suptitle(plate, fontsize=9)
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=dpi)
+
+def qc_file(input_file, skiprows, sheet_name, positive_control, negative_control, heatmap_folder, dpi):
+    """QC of one plate export; runs in a worker process."""
+    wells, values, cycle_columns, times = read_plate(input_file, skiprows=skiprows, sheet_name=sheet_name)
+    metrics, cv, signal_map, deviation_map = plate_qc(wells, values, times, positive_control, negative_control)
+    plate = Path(input_file).stem
+    if heatmap_folder is not None:
+        plot_heatmaps(plate, signal_map, deviation_map, Path(heatmap_folder) / f"{file_label(plate)}_qc.png", dpi=dpi)
+    metrics = {'Plate': plate, 'Source_File': str(input_file), 'Cycles': len(cycle_columns), **metrics}
+    cv.insert(0, 'Plate', plate)
+    return metrics, cv
+
+def flag_plates(table: pd.DataFrame, limits: dict) -> pd.DataFrame:
+    """Add a QC_Pass column and the list of failed checks per plate."""
+    checks = {
+        "Z'":          table['Z_Prime'] >= limits['Z_PRIME_MIN'] if 'Z_Prime' in table else pd.Series(False, index=table.index),
+        'CV':          table['CV_Max'] <= limits['CV_MAX'],
+        'Edge':        table['Edge_Effect'].abs() <= limits['EDGE_MAX'],
+        'Row trend':   table['Row_Trend'].abs() <= limits['TREND_MAX'],
+        'Col trend':   table['Col_Trend'].abs() <= limits['TREND_MAX'],
+        'Drift':       table['Drift'].abs() <= limits['DRIFT_MAX'],
+    }
+    passed = pd.DataFrame(checks).fillna(False)
+    table['QC_Pass'] = passed.all(axis=1)
+    table['Failed_Checks'] = passed.apply(lambda row: ', '.join(row.index[~row.astype(bool)]), axis=1)
+    return table
+
+def main(yaml_config: Path):
+    # Load YAML
+    with open(yaml_config, 'r') as f:
+        cfg = yaml.safe_load(f)
+
+    # Required
+    files = expand_inputs(cfg['FILES'])
+    positive_control = cfg['POSITIVE_CONTROL']
+    # Optional
+    negative_control = cfg.get('NEGATIVE_CONTROL', cfg.get('REFERENCE_STANDARD', 'Standard S12'))
+    skiprows         = cfg.get('SKIPROWS', None)
+    sheet_name       = cfg.get('SHEET_NAME', 'All Cycles')
+    output_folder    = Path(cfg.get('OUTPUT_FOLDER', '.'))
+    output_name      = cfg.get('OUTPUT_NAME', 'plate_qc')
+    heatmaps         = cfg.get('HEATMAPS', True)
+    dpi              = cfg.get('DPI', 150)
+    workers          = cfg.get('WORKERS', None)
+    limits = {
+        'Z_PRIME_MIN': cfg.get('Z_PRIME_MIN', 0.5),
+        'CV_MAX':      cfg.get('CV_MAX', 10.0),
+        'EDGE_MAX':    cfg.get('EDGE_MAX', 10.0),
+        'TREND_MAX':   cfg.get('TREND_MAX', 10.0),
+        'DRIFT_MAX':   cfg.get('DRIFT_MAX', 10.0),
+    }
+
+    if not files:
+        logging.error(f"No plate files found for {cfg['FILES']}.")
+        sys.exit(1)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    if not output_name.endswith('.xlsx'):
+        output_name += '.xlsx'
+    heatmap_folder = None
+    if heatmaps:
+        heatmap_folder = output_folder / 'qc_heatmaps'
+        heatmap_folder.mkdir(parents=True, exist_ok=True)
+
+    # One plate per task, across a process pool
+    plates, cvs = [], []
+    with stage('qc'), ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(qc_file, fn, skiprows, sheet_name, positive_control, negative_control,
+                               heatmap_folder, dpi): fn for fn in files}
+        for fut in as_completed(futures):
+            try:
+                metrics, cv = fut.result()
+            except Exception as exc:
+                logging.error(f"Failed on {futures[fut]}: {exc}")
+                continue
+            plates.append(metrics)
+            cvs.append(cv)
+
+    if not plates:
+        logging.error("No plate could be processed.")
+        sys.exit(1)
+    table = flag_plates(pd.DataFrame(plates).sort_values('Plate').reset_index(drop=True), limits)
+    cv_table = pd.concat(cvs, ignore_index=True).sort_values(['Plate', 'Group', 'Content'])
+
+    output_file = output_folder / output_name
+    with stage('save'), pd.ExcelWriter(output_file) as writer:
+        table.to_excel(writer, sheet_name='Plate_QC', index=False)
+        cv_table.to_excel(writer, sheet_name='Control_CV', index=False)
+    logging.info(f"{int(table['QC_Pass'].sum())} of {len(table)} plate(s) passed QC "
+                 f"({len(files) - len(table)} failed to load).")
+    logging.info(f"QC table written to {output_file}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plate QC (Z\', CV, edge effect, trends, drift) for CLARIOstar FP exports per a YAML config.')
+    parser.add_argument(
+        "yaml_config",
+        nargs="?",
+        default=None,
+        help="Path to the YAML configuration file (default: ./qc_input.yaml)"
+    )
+
+    args = parser.parse_args()
+
+    if args.yaml_config is None:
+        logging.info("No YAML specified, defaulting to ./qc_input.yaml")
+        args.yaml_config = "qc_input.yaml"
+
+    main(args.yaml_config)
@@ -0,0 +1,254 @@
+"""
+Benchmarks of every instrument pipeline on synthetic data.
+
+    python benchmarks/bench.py run                       # small scale, 3 repeats -> benchmarks/results/<commit>-small.json
+    python benchmarks/bench.py run --scale medium --cases nmr2d itc-fit
+    python benchmarks/bench.py compare results/a.json results/b.json
+    python benchmarks/bench.py list
+
+Every repeat of a case is a fresh `python -m labscripthub <command> <config>
+--force --profile` (uncached, with a private output cache per run), so
+the import of the libraries is part of the numbers, as for a user. Per case
+the result holds the median wall and CPU seconds and the largest peak RSS of
+the run and of every stage (import, read, compute, render, save, ...), from
+the --profile lines. Inputs are generated once per scale into
+benchmarks/data/<scale> (see synthetic.py) and again when the generators (or
+the ITC model they use) change.
+
+Results are plain JSON, named after the commit (with -dirty for uncommitted
+changes) and with the machine they ran on, so two commits are compared
+offline with `compare`: it exits with 1 when a case or stage got slower or
+bigger by more than --threshold percent (and more than the noise floor).
+"""
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = Path(__file__).resolve().parent
+ROOT = HERE.parent
+sys.path.append(str(HERE))
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+# Differences below these are noise, whatever the percentage
+MIN_SECONDS = 0.02
+MIN_MB = 5.0
+LIBRARIES = ('numpy', 'pandas', 'scipy', 'matplotlib', 'seaborn', 'nmrglue', 'openpyxl', 'xlrd', 'pyarrow')
+
+# Data ---------------------------------------------------------------------------
+
+def _generator_hash(scale):
+    import synthetic
+
+    sources = (HERE / 'synthetic.py').read_bytes() + (synthetic.ITC_DIR / 'itc_fit.py').read_bytes()
+    return hashlib.sha256(sources + scale.encode()).hexdigest()[:16]
+
+def prepare(data_root, scale):
+    """Inputs and configs of `scale`, generated unless they are there for the current generators."""
+    import synthetic
+
+    folder = Path(data_root) / scale
+    stamp = folder / 'cases.json'
+    if stamp.exists():
+        saved = json.loads(stamp.read_text())
+        if saved.get('generator') == _generator_hash(scale):
+            return folder, {name: tuple(case) for name, case in saved['cases'].items()}
+    if folder.exists():
+        shutil.rmtree(folder)
+    logging.info(f"Generating the {scale} inputs in {folder} ...")
+    start = time.perf_counter()
+    cases = synthetic.build(folder, scale)
+    stamp.write_text(json.dumps({'generator': _generator_hash(scale), 'cases': cases}, indent=1))
+    logging.info(f"Generated {len(cases)} cases in {time.perf_counter() - start:.1f} s.")
+    return folder, cases
+
+# Running ------------------------------------------------------------------------
+
+def run_case(folder, command, config, repeat):
+    """`repeat` fresh runs of one case: the --profile records, or the error of the first failed run."""
+    records = []
+    with tempfile.TemporaryDirectory(prefix='labscripthub-bench-') as tmp:
+        log = Path(tmp) / 'profile.jsonl'
+        for i in range(repeat):
+            env = dict(os.environ, LABSCRIPTHUB_PROFILE_LOG=str(log), LABSCRIPTHUB_CACHE=str(Path(tmp) / f"cache-{i}"),
+                       MPLBACKEND='Agg',
+                       PYTHONPATH=os.pathsep.join(filter(None, [str(ROOT), os.environ.get('PYTHONPATH')])))
+            env.pop('LABSCRIPTHUB_PROFILE', None)
+            shutil.rmtree(folder / 'out', ignore_errors=True)
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, '-m', 'labscripthub', command, config, '--force', '--profile'],
+                                    cwd=folder, env=env, capture_output=True, text=True)
+            process_wall = time.perf_counter() - start
+            lines = log.read_text().splitlines() if log.exists() else []
+            log.unlink(missing_ok=True)
+            if result.returncode != 0 or not lines:
+                return records, result.stderr.strip().splitlines()[-1:] or [f"exit code {result.returncode}"]
+            record = json.loads(lines[-1])
+            record['process_wall'] = round(process_wall, 4)
+            records.append(record)
+    return records, None
+
+def summarize(records):
+    """Median times and largest peak per case and stage."""
+    def median(values):
+        return round(statistics.median(values), 4)
+
+    paths = sorted({path for record in records for path in record['stages']})
+    stages = {}
+    for path in paths:
+        values = [record['stages'][path] for record in records if path in record['stages']]
+        stages[path] = {'calls': values[0]['calls'], 'wall': median([v['wall'] for v in values]),
+                        'cpu': median([v['cpu'] for v in values]),
+                        'peak_rss_mb': max(v['peak_rss_mb'] for v in values)}
+    return {'repeats': len(records), 'process_wall': median([r['process_wall'] for r in records]),
+            'wall': median([r['wall'] for r in records]), 'cpu': median([r['cpu'] for r in records]),
+            'peak_rss_mb': max(r['peak_rss_mb'] for r in records),
+            'walls': [r['wall'] for r in records], 'stages': stages}
+
+def machine():
+    from importlib import metadata
+
+    versions = {}
+    for name in LIBRARIES:
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            versions[name] = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(), 'libraries': versions}
+
+def commit():
+    """Short hash of HEAD, with -dirty for uncommitted changes to tracked files."""
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+
+    head = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    return head + ('-dirty' if git('status', '--porcelain', '--untracked-files=no') else '')
+
+def run(args):
+    folder, cases = prepare(args.data, args.scale)
+    names = args.cases or list(cases)
+    unknown = [name for name in names if name not in cases]
+    if unknown:
+        logging.error(f"Unknown cases {unknown}; available: {', '.join(cases)}")
+        return 2
+
+    results = {}
+    failed = []
+    for name in names:
+        command, config = cases[name]
+        records, error = run_case(folder, command, config, args.repeat)
+        if error:
+            logging.error(f"{name}: failed ({' '.join(error)})")
+            failed.append(name)
+            continue
+        results[name] = summarize(records)
+        logging.info(f"{name:<16} {results[name]['wall']:8.3f} s  {results[name]['peak_rss_mb']:8.1f} MB")
+
+    label = commit()
+    output = Path(args.output or HERE / 'results' / f"{label}-{args.scale}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({'commit': label, 'scale': args.scale, 'repeat': args.repeat,
+                                  'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': machine(),
+                                  'failed': failed, 'cases': results}, indent=1))
+    logging.info(f"Results written to {output}")
+    return 1 if failed else 0
+
+# Comparing ----------------------------------------------------------------------
+
+def _change(old, new, floor):
+    """Relative change in %, None when the difference is below the noise floor."""
+    if old is None or new is None or abs(new - old) < floor:
+        return None
+    return 100.0 * (new - old) / old if old else float('inf')
+
+def compare(args):
+    base, new = (json.loads(Path(path).read_text()) for path in (args.base, args.new))
+    if base['machine'] != new['machine'] or base['scale'] != new['scale']:
+        logging.warning("The results come from different machines, libraries or scales; differences are not "
+                        "only the code's.")
+    rows = []
+    regressions = []
+    for name in sorted(set(base['cases']) | set(new['cases'])):
+        old_case, new_case = base['cases'].get(name), new['cases'].get(name)
+        if old_case is None or new_case is None:
+            rows.append((name, '', 'only in ' + ('new' if old_case is None else 'base'), '', '', '', '', ''))
+            continue
+        entries = [('(total)', old_case, new_case)]
+        entries += [(path, old_case['stages'].get(path), new_case['stages'].get(path))
+                    for path in sorted(set(old_case['stages']) | set(new_case['stages']))]
+        for path, old, new_ in entries:
+            old, new_ = old or {}, new_ or {}
+            wall = _change(old.get('wall'), new_.get('wall'), MIN_SECONDS)
+            peak = _change(old.get('peak_rss_mb'), new_.get('peak_rss_mb'), MIN_MB)
+            flag = ''
+            if (wall or 0) > args.threshold or (peak or 0) > args.threshold:
+                flag = 'REGRESSION'
+                regressions.append(f"{name} {path}")
+            elif (wall or 0) < -args.threshold or (peak or 0) < -args.threshold:
+                flag = 'faster' if (wall or 0) < -args.threshold else 'smaller'
+            rows.append((name, path, old.get('wall', '-'), new_.get('wall', '-'),
+                         '' if wall is None else f"{wall:+.0f}%", old.get('peak_rss_mb', '-'),
+                         new_.get('peak_rss_mb', '-'), ('' if peak is None else f"{peak:+.0f}%") + ' ' + flag))
+
+    print(f"base {base['commit']} ({base['date']})  new {new['commit']} ({new['date']})  scale {new['scale']}")
+    print(f"{'case':<16} {'stage':<22} {'wall s':>9} {'->':>9} {'':>6} {'peak MB':>9} {'->':>9}")
+    for name, path, old_wall, new_wall, wall, old_peak, new_peak, peak in rows:
+        print(f"{name:<16} {path:<22} {old_wall!s:>9} {new_wall!s:>9} {wall:>6} {old_peak!s:>9} {new_peak!s:>9} {peak}")
+    sys.stdout.flush()
+    if regressions:
+        logging.warning(f"{len(regressions)} regression(s) above {args.threshold:g}%: {', '.join(regressions)}")
+        return 1
+    logging.info(f"No regression above {args.threshold:g}%.")
+    return 0
+
+def list_cases(args):
+    import synthetic
+
+    folder, cases = prepare(args.data, args.scale)
+    for name, (command, config) in cases.items():
+        print(f"{name:<16} {command:<14} {folder / config}")
+    print(f"\nscales: {', '.join(synthetic.SCALES)}")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the instrument pipelines on synthetic data.")
+    sub = parser.add_subparsers(dest='action', required=True)
+
+    def add_data_arguments(p):
+        p.add_argument('--scale', default='small', choices=('small', 'medium', 'large'),
+                       help='Size of the synthetic inputs (default: small)')
+        p.add_argument('--data', default=HERE / 'data', type=Path,
+                       help='Folder of the generated inputs (default: benchmarks/data)')
+
+    p = sub.add_parser('run', help='Run the cases and write a result file')
+    add_data_arguments(p)
+    p.add_argument('--cases', nargs='+', help='Only these cases (default: all)')
+    p.add_argument('--repeat', type=int, default=3, help='Runs per case; the median is kept (default: 3)')
+    p.add_argument('--output', help='Result file (default: benchmarks/results/<commit>-<scale>.json)')
+    p.set_defaults(func=run)
+
+    p = sub.add_parser('compare', help='Compare two result files')
+    p.add_argument('base')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=10.0,
+                   help='Slowdown or memory growth in %% counted as a regression (default: 10)')
+    p.set_defaults(func=compare)
+
+    p = sub.add_parser('list', help='List the cases (generates the inputs if needed)')
+    add_data_arguments(p)
+    p.set_defaults(func=list_cases)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
@@ -0,0 +1,376 @@
+"""
+Synthetic instrument exports for the benchmarks, in the formats the scripts read.
+
+Every generator is deterministic (fixed seeds), so the same scale gives the
+same files on every machine and commit. `build(folder, scale)` writes the
+inputs and the YAML configs of all benchmark cases and returns the cases.
+
+    akta_export        ÄKTA pure UTF-16 tab export: UV, conductivity, fractions
+    bruker_1d          Bruker processed 1D folder (pdata/1/1r + procs)
+    sparky_2d          Sparky .ucsf HSQC with positive and negative peaks
+    nanodsf_xlsx       nanoDSF export: Overview, Ratio and Ratio (1st deriv.) sheets
+    rotorgene_xls      Rotor-Gene Q export: (name, X, Y) column blocks (.xls, needs xlwt)
+    clariostar_plate   CLARIOstar FP "All Cycles" sheet with a kinetic per well
+    fp_curves          Preprocessed FP binding curves (input of FP_binding_fit.py)
+    itc_trace          Raw ITC thermogram (DP_X/DP_Y) with injection spikes
+    itc_export         ITC export with thermogram, NDH and fit (input of the figure)
+"""
+from pathlib import Path
+import string
+import sys
+
+import numpy as np
+import pandas as pd
+import yaml
+
+# The ITC data comes from the model of itc_fit.py, so fits of it recover the parameters
+ITC_DIR = Path(__file__).resolve().parents[1] / 'ITC' / 'itc200'
+sys.path.append(str(ITC_DIR))
+
+# Sizes per scale. small: seconds per case, for a quick check; medium: typical
+# lab data; large: the biggest exports seen in practice.
+SCALES = {
+    'small': {
+        'akta_points': 4000, 'akta_files': 1,
+        'nmr_size': 32768, 'nmr_spectra': 2,
+        'sparky_shape': (256, 512), 'sparky_files': 1,
+        'nano_capillaries': 24, 'nano_points': 750, 'nano_files': 2,
+        'rg_blocks': 36, 'rg_step': 0.5, 'rg_files': 2,
+        'plate_shape': (16, 24), 'plate_cycles': 10, 'plates': 2,
+        'fp_plates': 2, 'fp_groups': 8,
+        'itc_injections': 19, 'itc_rate': 30, 'itc_points': 4000, 'itc_files': 2,
+    },
+    'medium': {
+        'akta_points': 20000, 'akta_files': 2,
+        'nmr_size': 65536, 'nmr_spectra': 4,
+        'sparky_shape': (512, 1024), 'sparky_files': 2,
+        'nano_capillaries': 48, 'nano_points': 1500, 'nano_files': 8,
+        'rg_blocks': 72, 'rg_step': 0.5, 'rg_files': 8,
+        'plate_shape': (16, 24), 'plate_cycles': 30, 'plates': 8,
+        'fp_plates': 8, 'fp_groups': 16,
+        'itc_injections': 25, 'itc_rate': 60, 'itc_points': 20000, 'itc_files': 8,
+    },
+    'large': {
+        'akta_points': 100000, 'akta_files': 4,
+        'nmr_size': 262144, 'nmr_spectra': 8,
+        'sparky_shape': (1024, 2048), 'sparky_files': 4,
+        'nano_capillaries': 48, 'nano_points': 3000, 'nano_files': 24,
+        'rg_blocks': 72, 'rg_step': 0.1, 'rg_files': 24,
+        'plate_shape': (32, 48), 'plate_cycles': 30, 'plates': 24,
+        'fp_plates': 24, 'fp_groups': 32,
+        'itc_injections': 40, 'itc_rate': 120, 'itc_points': 100000, 'itc_files': 24,
+    },
+}
+
+# HPLC -------------------------------------------------------------------------
+
+def akta_export(path, points=4000, seed=0):
+    """
+    ÄKTA pure export: a run name row, a header row (curve name, empty) and a
+    unit row, then (ml, value) column pairs for UV 280, conductivity and the
+    fractions. Fractions are 2 ml wide and named 1.A.1, 1.A.2, ...; the last
+    one is Waste.
+    """
+    rng = np.random.default_rng(seed)
+    ml = np.linspace(0, 120, points)
+    uv = (5 + 400 * np.exp(-(ml - 45) ** 2 / 8) + 150 * np.exp(-(ml - 70) ** 2 / 20)
+          + rng.normal(0, 1, points))
+    cond = 2 + 0.6 * ml
+    fraction_ml = np.arange(10, 110, 2.0)
+    fraction_no = [f"1.{'ABCDEF'[i // 12]}.{i % 12 + 1}" for i in range(len(fraction_ml))]
+    fraction_no[-1] = 'Waste'
+
+    rows = ["run\t\t\t\t\t", "UV 1_280\t\tCond\t\tFraction\t", "ml\tmAU\tml\tmS/cm\tml\t(Fractions)"]
+    for i in range(points):
+        fraction = f"{fraction_ml[i]:.2f}\t{fraction_no[i]}" if i < len(fraction_ml) else "\t"
+        rows.append(f"{ml[i]:.3f}\t{uv[i]:.3f}\t{ml[i]:.3f}\t{cond[i]:.3f}\t{fraction}")
+    Path(path).write_text("\n".join(rows) + "\n", encoding='utf-16')
+
+# NMR --------------------------------------------------------------------------
+
+def bruker_1d(folder, size=32768, scale=1.0, seed=0):
+    """Processed Bruker 1D spectrum: <folder>/pdata/1/1r and procs (600 MHz, 12 ppm window)."""
+    import nmrglue as ng
+
+    rng = np.random.default_rng(seed)
+    dic = {'procs': {'SF': 600.13, 'SW_p': 7200.0, 'SI': size, 'OFFSET': 12.0, 'BYTORDP': 0, 'DTYPP': 0,
+                     'NC_proc': 0, '_comments': [], '_coreheader': ['##TITLE= Parameter file', '##JCAMPDX= 5.0']}}
+    ppm = np.linspace(12, 12 - 7200 / 600.13, size, endpoint=False)
+    spectrum = sum(height / (1 + ((ppm - shift) / 0.005) ** 2)
+                   for height, shift in [(1e6, 7.2), (5e5, 3.4), (8e5, 2.5), (3e5, 1.2)])
+    spectrum = (spectrum + rng.normal(0, 2e3, size)) * scale
+    Path(folder, 'pdata', '1').mkdir(parents=True, exist_ok=True)
+    ng.bruker.write_pdata(str(folder), dic, spectrum.astype('int32'), pdata_folder=1,
+                          write_procs=True, overwrite=True)
+
+def sparky_2d(path, shape=(256, 512), peaks=None, seed=0):
+    """1H-15N HSQC as a Sparky .ucsf file: Gaussian peaks and one negative peak."""
+    import nmrglue as ng
+
+    rng = np.random.default_rng(seed)
+    n_y, n_x = shape
+    peaks = peaks or n_x // 8
+    udic = {'ndim': 2,
+            0: {'sw': 3000.0, 'complex': False, 'obs': 60.8, 'car': 118 * 60.8, 'size': n_y, 'label': '15N',
+                'encoding': 'states', 'time': False, 'freq': True},
+            1: {'sw': 7000.0, 'complex': False, 'obs': 600.13, 'car': 8.0 * 600.13, 'size': n_x, 'label': '1H',
+                'encoding': 'direct', 'time': False, 'freq': True}}
+    data = np.zeros(shape, 'float32')
+    width_y, width_x = 2.0 * n_y / 256, 1.7 * n_x / 512
+    half = int(4 * max(width_y, width_x)) + 1
+    # Every peak only on a window around it: the full grid per peak would cost more than the benchmark
+    for _ in range(peaks):
+        cy, cx = rng.uniform(half, n_y - half), rng.uniform(half, n_x - half)
+        y0, x0 = int(cy) - half, int(cx) - half
+        y, x = np.mgrid[y0:y0 + 2 * half, x0:x0 + 2 * half]
+        data[y0:y0 + 2 * half, x0:x0 + 2 * half] += 1e6 * np.exp(-((y - cy) ** 2 / (2 * width_y ** 2)
+                                                                    + (x - cx) ** 2 / (2 * width_x ** 2)))
+    y, x = np.mgrid[0:n_y, 0:n_x]
+    data -= (3e5 * np.exp(-((y - n_y / 2) ** 2 / (20 * width_y ** 2) + (x - n_x / 2) ** 2 / (20 * width_x ** 2)))
+             ).astype('float32')
+    ng.sparky.write(str(path), ng.sparky.create_dic(udic), data, overwrite=True)
+
+# DSF --------------------------------------------------------------------------
+
+def _melting_curves(temps, n_curves, low, high, width, rng, noise):
+    """Sigmoid unfolding curves with Tm spread between 45 and 65 °C."""
+    tms = np.linspace(45, 65, n_curves)
+    curves = low + (high - low) / (1 + np.exp(-(temps[None, :] - tms[:, None]) / width))
+    return curves + rng.normal(0, noise, curves.shape)
+
+def nanodsf_xlsx(path, capillaries=24, points=750, seed=0):
+    """nanoDSF export: Overview (Capillary, Sample ID) and per-capillary Ratio and derivative sheets."""
+    rng = np.random.default_rng(seed)
+    temps = np.linspace(20, 95, points)
+    ratios = _melting_curves(temps, capillaries, 0.8, 1.0, 1.5, rng, 0.001)
+    caps = list(range(1, capillaries + 1))
+    # Two rows of labels above the data, as in the export
+    ratio = {'Capillary': ['', ''] + list(temps)}
+    deriv = {'Capillary': ['', ''] + list(temps)}
+    for cap, curve in zip(caps, ratios):
+        ratio[cap] = ['Ratio', '350/330'] + list(curve)
+        deriv[cap] = ['Ratio', "1st deriv."] + list(np.gradient(curve, temps))
+    with pd.ExcelWriter(path) as writer:
+        pd.DataFrame({'Capillary': caps, 'Sample ID': [f"S{cap}" for cap in caps]}).to_excel(
+            writer, sheet_name='Overview', index=False)
+        pd.DataFrame(ratio).to_excel(writer, sheet_name='Ratio', index=False)
+        pd.DataFrame(deriv).to_excel(writer, sheet_name='Ratio (1st deriv.)', index=False)
+
+def rotorgene_xls(path, blocks=36, step=0.5, seed=0):
+    """Rotor-Gene Q export: one (name, X, Y) column block per sample; needs xlwt for .xls."""
+    import xlwt
+
+    rng = np.random.default_rng(seed)
+    temps = np.arange(25, 95 + step / 2, step)
+    curves = _melting_curves(temps, blocks, 1000, 6000, 2.0, rng, 20)
+    workbook = xlwt.Workbook()
+    sheet = workbook.add_sheet('Sheet1')
+    for block, curve in enumerate(curves):
+        col = 3 * block
+        sheet.write(0, col, 'Name')
+        sheet.write(0, col + 1, 'X')
+        sheet.write(0, col + 2, 'Y')
+        sheet.write(1, col, f"Sample: S{block % (blocks // 2 or 1)}")
+        for row, (temp, value) in enumerate(zip(temps, curve), start=1):
+            sheet.write(row, col + 1, float(temp))
+            sheet.write(row, col + 2, float(value))
+    workbook.save(str(path))
+
+# Optical assays ----------------------------------------------------------------
+
+def _row_label(index):
+    letters = string.ascii_uppercase
+    return (letters[index // 26 - 1] if index >= 26 else '') + letters[index % 26]
+
+def clariostar_plate(path, shape=(16, 24), cycles=10, seed=0, skiprows=10):
+    """
+    CLARIOstar FP export, "All Cycles" sheet: `skiprows` lines of run info,
+    the header, a row with the cycle times, then one row per well. Every 12
+    columns x 4 rows form a group: a dilution series Sample X1..X11 and the
+    reference Standard S12, equilibrating over the cycles.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows, n_cols = shape
+    records = []
+    for i in range(n_rows):
+        for j in range(n_cols):
+            group = f"{string.ascii_uppercase[j // 12]}{i // 4}"
+            k = j % 12 + 1
+            content = 'Standard S12' if k == 12 else f"Sample X{k}"
+            base = 40 if k == 12 else 50 + 200 / (1 + np.exp(k - 6))
+            values = base * (1 - 0.3 * np.exp(-np.arange(cycles) / 3)) + rng.normal(0, 3, cycles)
+            records.append([_row_label(i), j + 1, content, group] + list(values))
+    columns = ['Well\nRow', 'Well\nCol', 'Content', 'Group'] + [f"{c + 1} - {c * 60} s" for c in range(cycles)]
+    table = pd.DataFrame(records, columns=columns)
+    times = pd.DataFrame([['', '', '', 'Time [s]'] + [c * 60 for c in range(cycles)]], columns=columns)
+    table = pd.concat([times, table], ignore_index=True)
+    header = pd.DataFrame([['User: benchmark']] + [['']] * (skiprows - 1))
+    with pd.ExcelWriter(path) as writer:
+        header.to_excel(writer, sheet_name='All Cycles', index=False, header=False)
+        table.to_excel(writer, sheet_name='All Cycles', index=False, startrow=skiprows)
+
+def fp_curves(path, plates=2, groups=8, seed=0):
+    """Preprocessed FP table (Plate, Group, Content, Mean_Scaled, Std_Scaled): quadratic binding, Kd 0.1-2 µM."""
+    rng = np.random.default_rng(seed)
+    conc = 10 / 2.0 ** np.arange(11)       # Sample X1 = 10 µM, 1:2 dilutions
+    tracer = 0.01
+    rows = []
+    for plate in range(plates):
+        for group in range(groups):
+            kd = rng.uniform(0.1, 2.0)
+            b = conc + tracer + kd
+            bound = (b - np.sqrt(b ** 2 - 4 * conc * tracer)) / (2 * tracer)
+            mean = 100 * bound + rng.normal(0, 2, conc.size)
+            for k, value in enumerate(mean, start=1):
+                rows.append({'Plate': f"plate{plate + 1:02d}", 'Group': f"G{group + 1}", 'Content': f"Sample X{k}",
+                             'Mean_Scaled': value, 'Std_Scaled': abs(rng.normal(2, 0.5))})
+            rows.append({'Plate': f"plate{plate + 1:02d}", 'Group': f"G{group + 1}", 'Content': 'Standard S12',
+                         'Mean_Scaled': 0.0, 'Std_Scaled': 0.0})
+    pd.DataFrame(rows).to_csv(path, index=False)
+
+# ITC --------------------------------------------------------------------------
+
+CELL_CONC, SYRINGE_CONC, CELL_VOLUME = 20.0, 200.0, 200.0   # µM, µM, µL
+
+def _one_site_ndh(injections, volume=2.0, first_volume=0.4, n=1.0, kd=1e-7, dh=-10.0):
+    """Molar ratio and NDH (kcal/mol) per injection of a one-site titration, with the model of itc_fit.py."""
+    from itc_fit import injection_concentrations, injection_heats, one_site_heat
+
+    volumes = np.full(injections, volume)
+    volumes[0] = first_volume
+    mt, xt = injection_concentrations(volumes, CELL_VOLUME, CELL_CONC * 1e-6, SYRINGE_CONC * 1e-6)
+    q = one_site_heat(mt, xt, n, 1 / kd, dh, CELL_VOLUME)
+    ndh = injection_heats(q, volumes, CELL_VOLUME) / (volumes * SYRINGE_CONC * 1e-6)
+    return xt / mt, ndh, volumes
+
+def itc_trace(path, injections=19, rate=30, seed=0):
+    """Raw thermogram (DP_X [min], DP_Y [µcal/s]): drifting baseline and one spike per injection."""
+    rng = np.random.default_rng(seed)
+    _, ndh, volumes = _one_site_ndh(injections)
+    heats = ndh * SYRINGE_CONC * volumes / 1e3      # µcal
+    start, spacing = 2.0, 2.5
+    time = np.arange(0, start + injections * spacing, 1 / rate)
+    power = 5.0 + 0.02 * time + 0.01 * np.sin(time / 10)
+    tau, rise = 0.15, 0.03
+    for i, heat in enumerate(heats):
+        s = time - (start + i * spacing)
+        after = s >= 0
+        power[after] += heat / 60 / (tau - rise) * (np.exp(-s[after] / tau) - np.exp(-s[after] / rise))
+    power += rng.normal(0, 0.002, time.size)
+    pd.DataFrame({'DP_X': time, 'DP_Y': power}).to_csv(path, index=False)
+
+def itc_export(path, injections=19, points=4000, seed=0):
+    """ITC export as written by the instrument software: DP_X/DP_Y, NDH_X/NDH_Y and the fit Fit_X/Fit_Y."""
+    rng = np.random.default_rng(seed)
+    ratio, ndh, _ = _one_site_ndh(injections)
+    time = np.linspace(0, 2 + 2.5 * injections, points)
+    power = np.zeros(points)
+    for i, value in enumerate(ndh):
+        start = 2 + 2.5 * i
+        power += np.where(time > start, value * 0.03 * np.exp(-(time - start) / 0.2), 0)
+    table = pd.DataFrame({'DP_X': time, 'DP_Y': power + rng.normal(0, 0.002, points)})
+    table['NDH_X'] = pd.Series(np.round(ratio, 6))
+    table['NDH_Y'] = pd.Series(ndh + rng.normal(0, 0.1, injections))
+    table['Fit_X'] = pd.Series(np.round(ratio, 6))
+    table['Fit_Y'] = pd.Series(ndh)
+    table.to_csv(path, index=False)
+
+# Cases ------------------------------------------------------------------------
+
+def _write_config(path, cfg):
+    with open(path, 'w') as f:
+        yaml.safe_dump(cfg, f, sort_keys=False, allow_unicode=True)
+    return path.name
+
+def build(folder, scale='small'):
+    """
+    Write the inputs and configs of every case for `scale` into `folder`.
+    Returns {case: (command, config file name)}; the configs are relative to
+    `folder`. Cases whose generator needs a missing package are left out.
+    """
+    import logging
+
+    sizes = SCALES[scale]
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    cases = {}
+
+    def add(name, command, cfg):
+        cases[name] = (command, _write_config(folder / f"{name}.yaml", cfg))
+
+    # ÄKTA
+    (folder / 'akta').mkdir(exist_ok=True)
+    files = []
+    for i in range(sizes['akta_files']):
+        akta_export(folder / 'akta' / f"run{i + 1}.csv", sizes['akta_points'], seed=i)
+        files.append({'FILENAME': f"akta/run{i + 1}.csv", 'TYPE': ['UV_280', 'Cond'],
+                      'FRACTION_GROUPS': [{'START': '1.A.5', 'END': '1.A.10'}]})
+    add('akta', 'akta', {'FILES': files, 'SHOW_FRACTIONS': True, 'OUTPUT_FOLDER': 'out/akta'})
+
+    # NMR
+    files = []
+    for i in range(sizes['nmr_spectra']):
+        bruker_1d(folder / 'bruker' / f"{i + 1}", sizes['nmr_size'], scale=1 + 0.1 * i, seed=i)
+        files.append({'FILENAME': f"bruker/{i + 1}", 'LABEL': f"spectrum {i + 1}", 'OFFSET': 0.2 * i})
+    add('nmr1d', 'nmr1d', {'FILES': files, 'SCALE_RANGE': [7.0, 7.4, 'max'], 'X_LIM': [10, 0],
+                           'OUTPUT_FOLDER': 'out/nmr1d'})
+    files = []
+    for i in range(sizes['sparky_files']):
+        sparky_2d(folder / f"hsqc{i + 1}.ucsf", sizes['sparky_shape'], seed=i)
+        entry = {'FILENAME': f"hsqc{i + 1}.ucsf", 'LABEL': f"HSQC {i + 1}", 'CONTOUR': 1e5}
+        if i == 0:
+            entry['NEGATIVE'] = {'LABEL': 'negative'}
+        files.append(entry)
+    add('nmr2d', 'nmr2d', {'FILES': files, 'OUTPUT_FOLDER': 'out/nmr2d'})
+
+    # DSF
+    (folder / 'nanodsf').mkdir(exist_ok=True)
+    for i in range(sizes['nano_files']):
+        nanodsf_xlsx(folder / 'nanodsf' / f"nano{i + 1:02d}.xlsx", sizes['nano_capillaries'], sizes['nano_points'],
+                     seed=i)
+    capillaries = list(range(1, sizes['nano_capillaries'] + 1))
+    add('nanodsf', 'nanodsf', {'FILES': [{'FILENAME': 'nanodsf/nano01.xlsx', 'CAPILLARY_LIST': capillaries}],
+                               'OUTPUT_FOLDER': 'out/nanodsf'})
+    add('nanodsf-tm', 'nanodsf', {'FILES': [{'FILENAME': 'nanodsf/nano01.xlsx', 'CAPILLARY_LIST': capillaries}],
+                                  'BOOTSTRAP': {'N_BOOT': 200, 'SEED': 0}, 'REPORT': {'FORMAT': 'png'},
+                                  'OUTPUT_FOLDER': 'out/nanodsf-tm'})
+    runs = [{'PATTERN': 'nanodsf/*.xlsx', 'TYPE': 'nanodsf'}]
+    try:
+        (folder / 'rotorgene').mkdir(exist_ok=True)
+        for i in range(sizes['rg_files']):
+            rotorgene_xls(folder / 'rotorgene' / f"rg{i + 1:02d}.xls", sizes['rg_blocks'], sizes['rg_step'], seed=i)
+    except ImportError:
+        logging.warning("xlwt is not installed: no Rotor-Gene Q inputs, the rotorgene cases are left out.")
+    else:
+        add('rotorgene', 'rotorgene', {'FILENAME': 'rotorgene/rg01.xls', 'OUTPUT_FORMAT': 'csv',
+                                       'OUTPUT_FOLDER': 'out/rotorgene'})
+        runs.append({'PATTERN': 'rotorgene/*.xls', 'TYPE': 'rotorgene'})
+    add('dsf-ingest', 'dsf-ingest', {'RUNS': runs, 'OVERWRITE': True, 'OUTPUT_FOLDER': 'out/dsf_dataset'})
+
+    # CLARIOstar
+    (folder / 'plates').mkdir(exist_ok=True)
+    for i in range(sizes['plates']):
+        clariostar_plate(folder / 'plates' / f"plate{i + 1:02d}.xlsx", sizes['plate_shape'], sizes['plate_cycles'],
+                         seed=i)
+    add('fp-preprocess', 'fp-preprocess', {'FILENAME': 'plates/plate01.xlsx', 'SKIPROWS': 10, 'KINETIC': True,
+                                           'OUTPUT_FOLDER': 'out/fp'})
+    add('fp-batch', 'fp-preprocess', {'FILES': 'plates/', 'SKIPROWS': 10, 'OUTPUT_FOLDER': 'out/fp-batch'})
+    add('fp-qc', 'fp-qc', {'FILES': 'plates/', 'POSITIVE_CONTROL': 'Sample X1', 'SKIPROWS': 10,
+                           'OUTPUT_FOLDER': 'out/fp-qc'})
+    fp_curves(folder / 'fp_curves.csv', sizes['fp_plates'], sizes['fp_groups'])
+    add('fp-fit', 'fp-fit', {'FILES': ['fp_curves.csv'], 'CONCENTRATION_SERIES': {'START': 10, 'DILUTION': 2},
+                             'TRACER_CONC': 0.01, 'OUTPUT_FOLDER': 'out/fp-fit'})
+
+    # ITC
+    (folder / 'itc').mkdir(exist_ok=True)
+    for i in range(sizes['itc_files']):
+        itc_trace(folder / 'itc' / f"trace{i + 1:02d}.csv", sizes['itc_injections'], sizes['itc_rate'], seed=i)
+        itc_export(folder / 'itc' / f"export{i + 1:02d}.csv", sizes['itc_injections'], sizes['itc_points'], seed=i)
+    titration = {'CELL_CONC': CELL_CONC, 'SYRINGE_CONC': SYRINGE_CONC, 'CELL_VOLUME': CELL_VOLUME,
+                 'INJECTION_VOLUME': 2.0, 'FIRST_INJECTION_VOLUME': 0.4}
+    add('itc-integrate', 'itc-integrate', {'FILES': ['itc/trace*.csv'], **titration, 'PLOT': True,
+                                           'OUTPUT_FOLDER': 'out/itc-integrate'})
+    add('itc-fit', 'itc-fit', {'FILES': ['itc/export*.csv'], **titration, 'OUTPUT_FOLDER': 'out/itc-fit'})
+    add('itc-figure', 'itc-figure', {'FILENAME': 'itc/export01.csv', 'OUTPUT_FOLDER': 'out/itc-figure'})
+    add('itc-batch', 'itc-batch', {'FILES': ['itc/export*.csv'], 'OUTPUT_FOLDER': 'out/itc-batch'})
+    return cases
@@ -0,0 +1,3 @@
+"""LabScriptHub: plotting and analysis scripts for laboratory instruments."""
+
+__version__ = "0.1.0"
@@ -0,0 +1,5 @@
+import sys
+
+from labscripthub.cli import main
+
+sys.exit(main())
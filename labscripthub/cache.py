@@ -0,0 +1,265 @@
+"""
+Content-addressed cache of script outputs.
+
+A run is identified by the command, the normalized YAML config, the content
+of every input file and the code version (the scripts and the versions of
+the plotting libraries). The files a run writes are stored once per content
+hash; when the same key comes up again, outputs that are still in place are
+left alone and missing or changed ones are copied back, without running
+the script.
+
+Input hashes are remembered per path with the file size and mtime, so an
+unchanged file costs one stat(); the content is only hashed again when
+either changed. The cache is capped in size and evicts the least recently
+used entries.
+
+Layout of the cache folder:
+    objects/ab/cdef...   output files, named by their SHA-256
+    entries/<key>.json   outputs of one run (path relative to the working folder, hash, size)
+    index.json           path -> (size, mtime_ns, hash) of every file hashed so far
+"""
+from pathlib import Path
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+CACHE_VERSION = 2
+CACHE_DIR = Path(os.environ.get('LABSCRIPTHUB_CACHE', Path.home() / '.cache' / 'labscripthub'))
+SIZE_CAP_MB = float(os.environ.get('LABSCRIPTHUB_CACHE_MB', 2048))
+# Libraries whose version changes what the scripts write
+LIBRARIES = ('matplotlib', 'numpy', 'pandas', 'scipy', 'nmrglue', 'seaborn')
+CHUNK = 1 << 20
+
+def normalize_config(cfg):
+    """The config as canonical JSON: key order and YAML formatting do not change the key."""
+    return json.dumps(cfg, sort_keys=True, separators=(',', ':'), default=str)
+
+def library_versions():
+    """
+    Installed versions of LIBRARIES, from the names of the .dist-info folders
+    on sys.path (one directory scan; importlib.metadata takes ~100 ms here).
+    """
+    wanted = {name.lower() for name in LIBRARIES}
+    versions = dict.fromkeys(LIBRARIES)
+    for folder in sys.path:
+        try:
+            entries = os.scandir(folder or '.')
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.endswith('.dist-info'):
+                    name, _, version = entry.name[:-len('.dist-info')].partition('-')
+                    if name.lower() in wanted and versions[name.lower()] is None:
+                        versions[name.lower()] = version
+    return versions
+
+def expand_inputs(paths):
+    """Files behind a list of paths, globs and folders (folders recursively), sorted."""
+    import glob
+
+    files = set()
+    for path in paths:
+        matches = glob.glob(path, recursive=True) if glob.has_magic(path) else [path]
+        for match in map(Path, matches):
+            if match.is_dir():
+                files.update(p for p in match.rglob('*') if p.is_file())
+            elif match.is_file():
+                files.add(match)
+    return sorted(files)
+
+def snapshot_outputs(patterns, exclude=()):
+    """
+    Size and mtime (ns) of every file matching the output paths or globs of a
+    command; a pattern naming a folder covers the files below it. Taken before
+    and after a run, the difference is what the run wrote.
+    """
+    import glob
+
+    exclude = [str(Path(p).resolve()) for p in exclude]
+    files = {}
+    for pattern in patterns:
+        matches = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        for match in map(Path, matches):
+            candidates = (p for p in match.rglob('*') if p.is_file()) if match.is_dir() else [match]
+            for path in candidates:
+                try:
+                    st = path.stat()
+                except OSError:
+                    continue
+                resolved = str(path.resolve())
+                if path.is_file() and not any(resolved.startswith(root + os.sep) for root in exclude):
+                    files[path] = (st.st_mtime_ns, st.st_size)
+    return files
+
+class OutputCache:
+    """Cache folder with the stat index; see the module docstring for the layout."""
+
+    def __init__(self, root=None, size_cap_mb=None):
+        self.root = Path(root or CACHE_DIR)
+        self.size_cap = int((SIZE_CAP_MB if size_cap_mb is None else size_cap_mb) * 1024 ** 2)
+        self._index = None
+        self._dirty = False
+
+    # Hashing --------------------------------------------------------------------
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(self.root / 'index.json', 'r') as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def save_index(self):
+        """Write the stat index back (atomically) if new files were hashed."""
+        if not self._dirty:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.root / f'index.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.root / 'index.json')
+        self._dirty = False
+
+    def file_hash(self, path):
+        """SHA-256 of a file; reused from the index while its size and mtime are unchanged."""
+        path = Path(path).resolve()
+        st = path.stat()
+        index = self._load_index()
+        known = index.get(str(path))
+        if known is not None and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK), b''):
+                digest.update(chunk)
+        index[str(path)] = [st.st_size, st.st_mtime_ns, digest.hexdigest()]
+        self._dirty = True
+        return digest.hexdigest()
+
+    def key(self, command, cfg, inputs, code_files):
+        """Cache key of a run: command, normalized config, input contents and code version."""
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            'version': CACHE_VERSION,
+            'command': command,
+            'config': normalize_config(cfg),
+            'libraries': library_versions(),
+        }, sort_keys=True).encode())
+        for path in sorted(code_files):
+            digest.update(b'code\0' + self.file_hash(path).encode())
+        for path in inputs:
+            digest.update(b'input\0' + str(path).encode() + b'\0' + self.file_hash(path).encode())
+        return digest.hexdigest()
+
+    # Entries --------------------------------------------------------------------
+
+    def _object(self, digest):
+        return self.root / 'objects' / digest[:2] / digest[2:]
+
+    def _entry(self, key):
+        return self.root / 'entries' / f'{key}.json'
+
+    def lookup(self, key):
+        """Outputs recorded for `key`, or None; a hit counts as a use for the eviction."""
+        entry = self._entry(key)
+        try:
+            with open(entry, 'r') as f:
+                outputs = json.load(f)['outputs']
+        except (OSError, ValueError, KeyError):
+            return None
+        if not all(self._object(out['hash']).is_file() for out in outputs):
+            return None
+        os.utime(entry)
+        return outputs
+
+    def restore(self, outputs):
+        """Put the cached outputs in place; returns (unchanged, copied) file counts."""
+        unchanged = copied = 0
+        for out in outputs:
+            target = Path(out['path'])
+            if target.is_file() and target.stat().st_size == out['size'] and self.file_hash(target) == out['hash']:
+                unchanged += 1
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(self._object(out['hash']), target)
+            self.file_hash(target)
+            copied += 1
+        return unchanged, copied
+
+    def store(self, key, output_files, base='.'):
+        """Record the outputs of a run under `key` and evict old entries above the size cap."""
+        base = Path(base).resolve()
+        outputs = []
+        for path in output_files:
+            digest = self.file_hash(path)
+            blob = self._object(digest)
+            if not blob.is_file():
+                blob.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = blob.with_name(f'{blob.name}.{os.getpid()}.tmp')
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, blob)
+            resolved = Path(path).resolve()
+            relative = os.path.relpath(resolved, base)
+            outputs.append({'path': relative, 'hash': digest, 'size': resolved.stat().st_size})
+        entry = self._entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = entry.with_name(f'{entry.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'created': time.time(), 'outputs': outputs}, f, indent=1)
+        os.replace(tmp_path, entry)
+        self.evict()
+        return outputs
+
+    def evict(self):
+        """Drop least recently used entries, then unreferenced objects, until under the size cap."""
+        entries = sorted((self.root / 'entries').glob('*.json'), key=lambda p: p.stat().st_mtime)
+        referenced = {}
+        per_entry = []
+        for entry in entries:
+            try:
+                with open(entry, 'r') as f:
+                    outputs = json.load(f)['outputs']
+            except (OSError, ValueError, KeyError):
+                entry.unlink(missing_ok=True)
+                continue
+            per_entry.append((entry, outputs))
+            for out in outputs:
+                referenced[out['hash']] = referenced.get(out['hash'], 0) + 1
+
+        objects = {p.parent.name + p.name: p for p in (self.root / 'objects').glob('*/*') if not p.name.endswith('.tmp')}
+        sizes = {digest: path.stat().st_size for digest, path in objects.items()}
+        total = sum(sizes.values())
+        evicted = 0
+        for entry, outputs in per_entry:
+            if total <= self.size_cap:
+                break
+            entry.unlink(missing_ok=True)
+            evicted += 1
+            for out in outputs:
+                referenced[out['hash']] -= 1
+                if referenced[out['hash']] == 0 and out['hash'] in objects:
+                    total -= sizes[out['hash']]
+        for digest, path in objects.items():
+            if referenced.get(digest, 0) == 0:
+                path.unlink(missing_ok=True)
+        if evicted:
+            logging.info(f"Cache: evicted {evicted} entr{'y' if evicted == 1 else 'ies'} "
+                         f"({total / 1024 ** 2:.0f} MB of {self.size_cap / 1024 ** 2:.0f} MB in use).")
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        self._index = {}
+        self._dirty = False
+
+    def info(self):
+        """Number of entries and objects and their total size in bytes."""
+        entries = len(list((self.root / 'entries').glob('*.json')))
+        objects = [p for p in (self.root / 'objects').glob('*/*') if not p.name.endswith('.tmp')]
+        return entries, len(objects), sum(p.stat().st_size for p in objects)
@@ -0,0 +1,403 @@
+"""
+One entry point for all instrument scripts.
+
+    labscripthub <command> [config.yaml] [--dry-run]
+
+Only the standard library is imported at start-up. The script of a command
+(and with it matplotlib, pandas, nmrglue, ...) is imported when the command
+actually runs, after the Agg backend has been selected. `--help` and
+`--dry-run`, which checks the config and its input files, never import them;
+`labscripthub startup-check` measures that this stays within a time budget.
+
+Runs go through the output cache (labscripthub.cache): when the config, the
+input files and the code are unchanged, the outputs are restored instead of
+rendered again. `--force` runs the script anyway. `--profile` reports the
+time and memory of every stage of the run (labscripthub.instrument).
+"""
+from pathlib import Path
+import argparse
+import glob
+import importlib
+import logging
+import os
+import sys
+
+ROOT = Path(os.environ.get('LABSCRIPTHUB_ROOT', Path(__file__).resolve().parents[1]))
+
+# Command -> script (relative to ROOT), default config, description, required
+# keys (one key of every tuple must be present) and required keys per entry of
+# FILES/RUNS
+COMMANDS = {
+    'nanodsf': {
+        'script': 'DSF/nanoDSF/nanodsf_plotting.py', 'config': 'input.yaml',
+        'help': 'Plot nanoDSF ratio curves and Tm values',
+        'required': [('FILES',)], 'entry_keys': ('FILENAME', 'CAPILLARY_LIST'),
+    },
+    'rotorgene': {
+        'script': 'DSF/Qiagen_RotorGeneQ/preprocess_dsf_data.py', 'config': 'input.yaml',
+        'help': 'Preprocess Rotor-Gene Q DSF exports',
+        'required': [('FILENAME',)],
+    },
+    'dsf-ingest': {
+        'script': 'DSF/Batch/dsf_batch_ingest.py', 'config': 'input.yaml',
+        'help': 'Ingest nanoDSF/Rotor-Gene Q runs into a Parquet dataset',
+        'required': [('RUNS',)], 'entry_keys': ('PATTERN', 'TYPE'), 'output_folder': 'dsf_dataset',
+    },
+    'akta': {
+        'script': 'HPLC/Aekta/pure/plot_run.py', 'config': 'input.yaml',
+        'help': 'Plot ÄKTA pure chromatography runs',
+        'required': [('FILES',)], 'entry_keys': ('FILENAME', 'TYPE'),
+    },
+    'itc-figure': {
+        'script': 'ITC/itc200/itc_final_figure.py', 'config': 'input.yaml',
+        'help': 'ITC final figure (thermogram, isotherm, residuals)',
+        'required': [('FILENAME',)],
+    },
+    'itc-batch': {
+        'script': 'ITC/itc200/itc_batch.py', 'config': 'batch_input.yaml',
+        'help': 'ITC final figures of many CSVs (cached 600-dpi exports)',
+        'required': [('FILES',)],
+    },
+    'itc-integrate': {
+        'script': 'ITC/itc200/itc_integrate.py', 'config': 'integrate_input.yaml',
+        'help': 'Integrate raw ITC thermograms into heats per injection',
+        'required': [('FILES',), ('CELL_CONC',), ('SYRINGE_CONC',), ('INJECTION_VOLUME',)],
+    },
+    'itc-fit': {
+        'script': 'ITC/itc200/itc_fit.py', 'config': 'fit_input.yaml',
+        'help': 'Fit binding models to integrated ITC heats',
+        'required': [('FILES',), ('CELL_CONC',), ('SYRINGE_CONC',)],
+    },
+    'nmr1d': {
+        'script': 'NMR/Bruker/1D/plot1d_nmr.py', 'config': 'input.yaml',
+        'help': 'Plot Bruker 1D NMR spectra',
+        'required': [('FILES',)], 'entry_keys': ('FILENAME',),
+    },
+    'nmr2d': {
+        'script': 'NMR/Bruker/2D/plot2d_nmr.py', 'config': 'input.yaml',
+        'help': 'Plot Bruker 2D NMR spectra (HSQC overlays)',
+        'required': [('FILES',)], 'entry_keys': ('FILENAME',),
+    },
+    'fp-preprocess': {
+        'script': 'Optical_Assays/CLARIOstar/FP_Assay_preprocessing.py', 'config': 'input.yaml',
+        'help': 'Preprocess CLARIOstar fluorescence polarization plates',
+        'required': [('FILES', 'FILENAME')],
+    },
+    'fp-fit': {
+        'script': 'Optical_Assays/CLARIOstar/FP_binding_fit.py', 'config': 'fit_input.yaml',
+        'help': 'Fit Kd values to fluorescence polarization binding curves',
+        'required': [('FILES',), ('CONCENTRATIONS', 'CONCENTRATION_SERIES')],
+    },
+    'fp-qc': {
+        'script': 'Optical_Assays/CLARIOstar/FP_plate_qc.py', 'config': 'qc_input.yaml',
+        'help': "Plate QC for CLARIOstar plates (Z', CV, edge effects, drift)",
+        'required': [('FILES',), ('POSITIVE_CONTROL',)],
+    },
+}
+
+# Keys holding input paths (or globs); entries may be strings or dicts
+PATH_KEYS = ('FILENAME', 'FILE', 'PATTERN')
+
+def _input_paths(cfg):
+    """All input paths (or glob patterns) named in a config."""
+    paths = [cfg['FILENAME']] if isinstance(cfg.get('FILENAME'), str) else []
+    for key in ('FILES', 'RUNS'):
+        entries = cfg.get(key) or []
+        if isinstance(entries, (str, dict)):
+            entries = [entries]
+        for entry in entries:
+            if isinstance(entry, dict):
+                paths.extend(str(entry[k]) for k in PATH_KEYS if k in entry)
+            else:
+                paths.append(str(entry))
+    return paths
+
+def load_config(command, config_path):
+    """
+    Read and check a config without running the script; returns the config
+    (None if it could not be read) and a list of problems.
+
+    Parses the YAML, checks the required keys (and the required keys of every
+    FILES/RUNS entry) and that every input path or glob exists relative to the
+    working directory, like the scripts resolve them.
+    """
+    import yaml
+
+    spec = COMMANDS[command]
+    config_path = Path(config_path)
+    if not config_path.is_file():
+        return None, [f"Config file '{config_path}' not found."]
+    try:
+        with open(config_path, 'r') as f:
+            cfg = yaml.safe_load(f)
+    except yaml.YAMLError as exc:
+        return None, [f"Config file '{config_path}' is not valid YAML: {exc}"]
+    if not isinstance(cfg, dict):
+        return None, [f"Config file '{config_path}' must contain a mapping of settings."]
+
+    problems = []
+    for keys in spec['required']:
+        if not any(cfg.get(key) not in (None, [], '') for key in keys):
+            problems.append(f"Missing required key {' or '.join(repr(k) for k in keys)}.")
+    entries = cfg.get('RUNS', cfg.get('FILES')) or []
+    for i, entry in enumerate(entries if isinstance(entries, list) else [], start=1):
+        missing = [key for key in spec.get('entry_keys', ()) if not isinstance(entry, dict) or key not in entry]
+        if missing:
+            problems.append(f"Entry {i} is missing {', '.join(repr(k) for k in missing)}.")
+    for path in _input_paths(cfg):
+        if glob.has_magic(path):
+            if not glob.glob(path, recursive=True):
+                problems.append(f"No files match '{path}'.")
+        elif not Path(path).exists():
+            problems.append(f"Input '{path}' not found.")
+    return cfg, problems
+
+def load_script(command):
+    """Import the script of a command as a module (its folder goes on sys.path for sibling imports)."""
+    script = ROOT / COMMANDS[command]['script']
+    if not script.is_file():
+        raise FileNotFoundError(f"Script '{script}' not found; set LABSCRIPTHUB_ROOT to the repository folder.")
+    # Headless by default; pyplot picks the backend up when it is first imported
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    if str(script.parent) not in sys.path:
+        sys.path.insert(0, str(script.parent))
+    return importlib.import_module(script.stem)
+
+def code_files(command):
+    """
+    Python files that make up a command: every module under its instrument's
+    top-level folder (e.g. DSF/, which dsf-ingest imports the nanoDSF and
+    Rotor-Gene Q readers from) and the labscripthub package (figure style, stages).
+    """
+    top = ROOT / Path(COMMANDS[command]['script']).parts[0]
+    return sorted(set(top.rglob('*.py')) | set((ROOT / 'labscripthub').glob('*.py')))
+
+def run_command(command, yaml_config, cfg, force=False):
+    """Run a command through the output cache; returns True when it was served from the cache."""
+    from labscripthub.cache import OutputCache, expand_inputs, snapshot_outputs
+    from labscripthub.instrument import job, stage
+    from labscripthub.jobs import predict_outputs
+
+    with job(command, yaml_config) as record:
+        with stage('cache'):
+            cache = OutputCache()
+            inputs = expand_inputs(_input_paths(cfg))
+            key = cache.key(command, cfg, inputs, code_files(command))
+            outputs = None if force else cache.lookup(key)
+            if outputs is not None:
+                unchanged, copied = cache.restore(outputs)
+                cache.save_index()
+        if outputs is not None:
+            record['status'] = 'cached'
+            logging.info(f"{yaml_config}: inputs, config and code unchanged; skipped "
+                         f"({unchanged} output(s) up to date, {copied} restored from the cache).")
+            return True
+
+        # Only files this command names can be its outputs: other jobs may write
+        # to the same folder at the same time
+        patterns = predict_outputs(command, cfg, os.getcwd())
+        before = snapshot_outputs(patterns, exclude=[cache.root])
+        with stage('import'):
+            script = load_script(command)
+        script.main(yaml_config)
+
+        with stage('cache'):
+            after = snapshot_outputs(patterns, exclude=[cache.root])
+            inputs = {path.resolve() for path in inputs}
+            written = {path for path, stat in after.items() if before.get(path) != stat and path.resolve() not in inputs}
+            if written:
+                cache.store(key, sorted(written))
+            else:
+                logging.info(f"No new outputs of {command} found; the run is not cached.")
+            cache.save_index()
+        return False
+
+def startup_check(budget, command=None, config=None, repeat=3):
+    """
+    Time `--help` of every command (or a dry-run of one config) in fresh
+    interpreters and list heavy modules that were imported. Returns 0 when
+    every run is within `budget` seconds and imports none of them.
+    """
+    import subprocess
+    import time
+
+    heavy = ('matplotlib', 'pandas', 'numpy', 'scipy', 'nmrglue', 'seaborn', 'PySide6')
+    if command is not None:
+        runs = [[command, str(config), '--dry-run'] if config else [command, '--help']]
+    else:
+        runs = [['--help']] + [[name, '--help'] for name in COMMANDS]
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [str(ROOT), os.environ.get('PYTHONPATH')]))}
+
+    status = 0
+    for args in runs:
+        cmd = [sys.executable, '-X', 'importtime', '-m', 'labscripthub', *args]
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            proc = subprocess.run(cmd, capture_output=True, text=True, env=env)
+            times.append(time.perf_counter() - start)
+        imported = {line.rsplit('|', 1)[-1].strip().split('.')[0]
+                    for line in proc.stderr.splitlines() if line.startswith('import time:')}
+        loaded = sorted(imported.intersection(heavy))
+        best = min(times)
+        ok = best <= budget and not loaded
+        status |= not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {best * 1000:7.1f} ms  labscripthub {' '.join(args)}"
+              + (f"  (imports {', '.join(loaded)})" if loaded else ''))
+    print(f"Budget: {budget * 1000:.0f} ms per call.")
+    return status
+
+def _add_profile_argument(parser):
+    parser.add_argument('--profile',
+                        nargs='?',
+                        const='stages',
+                        choices=['stages', 'cprofile'],
+                        help='Print wall time, CPU time and peak memory per stage as a JSON line '
+                             '(to $LABSCRIPTHUB_PROFILE_LOG if set); cprofile also writes a cProfile dump')
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='labscripthub',
+        description='Plotting and analysis scripts for laboratory instruments.')
+    sub = parser.add_subparsers(dest='command', metavar='<command>')
+    for name, spec in COMMANDS.items():
+        cmd = sub.add_parser(name, help=spec['help'], description=spec['help'])
+        cmd.add_argument('yaml_config',
+                         nargs='?',
+                         default=None,
+                         help=f"Path to the YAML configuration file (default: ./{spec['config']})")
+        cmd.add_argument('--dry-run',
+                         action='store_true',
+                         help='Only check the config and its input files, do not run')
+        cmd.add_argument('--force',
+                         action='store_true',
+                         help='Run even if the outputs for these inputs and config are cached')
+        _add_profile_argument(cmd)
+
+    check = sub.add_parser('startup-check', help='Measure the start-up time of the command line')
+    check.add_argument('check_command', nargs='?', choices=list(COMMANDS), metavar='command',
+                       help='Only check this command (default: --help of all commands)')
+    check.add_argument('config', nargs='?', help='Config for a dry-run of the command')
+    check.add_argument('--budget', type=float, default=0.3, help='Seconds per call (default: 0.3)')
+
+    run = sub.add_parser('run', help='Run the jobs of a manifest in dependency order, in parallel')
+    run.add_argument('manifest', help='YAML manifest with a JOBS list')
+    run.add_argument('--workers', type=int, default=None, help='Parallel jobs (default: WORKERS or all cores)')
+    run.add_argument('--up-to-date', choices=['hash', 'timestamp'], default=None,
+                     help='Skip jobs whose outputs are cached (hash) or newer than their inputs (timestamp)')
+    run.add_argument('--force', action='store_true', help='Run every job')
+    run.add_argument('--dry-run', action='store_true', help='Only print the jobs and their dependencies')
+    _add_profile_argument(run)
+
+    watch = sub.add_parser('watch', help='Process new files in export folders as they arrive')
+    watch.add_argument('watch_config', help='YAML config with a WATCH list')
+    watch.add_argument('--poll', action='store_true', help='Scan the folders instead of using inotify (network shares)')
+    watch.add_argument('--once', action='store_true', help='Process the files present now and exit')
+
+    serve = sub.add_parser('serve', help='Start a local render server that keeps the libraries loaded')
+    serve.add_argument('--stop', action='store_true', help='Stop the running server')
+    serve.add_argument('--status', action='store_true', help='Show whether a server is running')
+
+    submit = sub.add_parser('submit', help='Run a config on the render server (see serve)')
+    submit.add_argument('submit_command', choices=list(COMMANDS), metavar='command', help='Command to run')
+    submit.add_argument('yaml_config', nargs='?', default=None,
+                        help='Path to the YAML configuration file (default: the default of the command)')
+    submit.add_argument('--force', action='store_true', help='Run even if the outputs are cached')
+    _add_profile_argument(submit)
+
+    cache = sub.add_parser('cache', help='Show the size of the output cache or clear it')
+    cache.add_argument('--clear', action='store_true', help='Delete all cached outputs')
+    return parser
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    if getattr(args, 'profile', None):
+        from labscripthub import instrument
+        instrument.enable(args.profile)
+    if args.command == 'startup-check':
+        return startup_check(args.budget, args.check_command, args.config)
+    if args.command == 'run':
+        from labscripthub.jobs import run_manifest
+        try:
+            failed = run_manifest(args.manifest, workers=args.workers, force=args.force,
+                                  up_to_date=args.up_to_date, dry_run=args.dry_run)
+        except (OSError, ValueError) as exc:
+            logging.error(exc)
+            return 1
+        return 1 if failed else 0
+    if args.command == 'watch':
+        from labscripthub.watch import watch
+        try:
+            watch(args.watch_config, poll=args.poll, once=args.once)
+        except (OSError, ValueError) as exc:
+            logging.error(exc)
+            return 1
+        return 0
+    if args.command == 'serve':
+        from labscripthub import server
+        if args.stop:
+            if not server.stop():
+                logging.info(f"No render server running on {server.SOCKET_PATH}.")
+            return 0
+        if args.status:
+            status = server.ping()
+            if status is None:
+                logging.info(f"No render server running on {server.SOCKET_PATH}.")
+                return 1
+            logging.info(f"Render server on {server.SOCKET_PATH}: pid {status['pid']}, up {status['uptime']:.0f} s, "
+                         f"{len(status['commands'])} command(s) preloaded in {status['preload']:.2f} s.")
+            return 0
+        try:
+            server.serve()
+        except (OSError, ValueError) as exc:
+            logging.error(exc)
+            return 1
+        return 0
+    if args.command == 'submit':
+        from labscripthub import server
+        yaml_config = args.yaml_config or f"./{COMMANDS[args.submit_command]['config']}"
+        try:
+            reply = server.submit(args.submit_command, yaml_config, force=args.force, profile=args.profile)
+        except OSError:
+            logging.error(f"No render server on {server.SOCKET_PATH}; start one with `labscripthub serve`.")
+            return 1
+        sys.stderr.write(reply.get('output', ''))
+        if 'seconds' in reply:
+            logging.info(f"{reply['status']} in {reply['seconds'] * 1000:.0f} ms on the render server.")
+        return 0 if reply['status'] in ('done', 'cached') else 1
+    if args.command == 'cache':
+        from labscripthub.cache import OutputCache
+        cache = OutputCache()
+        if args.clear:
+            cache.clear()
+            logging.info(f"Cleared {cache.root}.")
+        else:
+            entries, objects, size = cache.info()
+            logging.info(f"{cache.root}: {entries} run(s), {objects} file(s), "
+                         f"{size / 1024 ** 2:.1f} of {cache.size_cap / 1024 ** 2:.0f} MB.")
+        return 0
+
+    spec = COMMANDS[args.command]
+    if args.yaml_config is None:
+        logging.info(f"No YAML config provided, using default: ./{spec['config']}")
+        args.yaml_config = f"./{spec['config']}"
+
+    cfg, problems = load_config(args.command, args.yaml_config)
+    for problem in problems:
+        logging.error(problem)
+    if problems:
+        return 1
+    if args.dry_run:
+        logging.info(f"{args.yaml_config}: OK for {args.command}.")
+        return 0
+
+    run_command(args.command, args.yaml_config, cfg, force=args.force)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""
+Wall time, CPU time and peak memory per stage of a run.
+
+    from labscripthub.instrument import stage
+
+    with stage('read'):
+        df = pd.read_csv(path)
+
+    @stage('fit')
+    def fit_group(...):
+        ...
+
+Stages are off by default: entering a stage or calling a decorated function
+then only checks a flag, so the scripts cost the same as without them. They
+are switched on with `--profile` on the command line (or
+LABSCRIPTHUB_PROFILE=1 when a script is run directly; LABSCRIPTHUB_PROFILE=cprofile
+also writes a cProfile dump).
+
+Every job then ends with one JSON line: the totals and, per stage (nested
+stages as 'render/save'), the number of calls, wall and CPU seconds and the
+peak RSS. The line goes to stderr, or is appended to $LABSCRIPTHUB_PROFILE_LOG.
+CPU time counts all threads of the process and the child processes (worker
+pools) that finished during the stage; the peak RSS is that of the process
+alone. It is exact on Linux, where the high-water mark is reset at the start
+of every stage; while stages run in several threads at once, or on other
+systems, it is the peak of the process so far.
+"""
+from contextlib import contextmanager
+from pathlib import Path
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+PROFILE_DIR = Path(os.environ.get('LABSCRIPTHUB_PROFILE_DIR',
+                                  Path(os.environ.get('LABSCRIPTHUB_CACHE', Path.home() / '.cache' / 'labscripthub'))
+                                  / 'profiles'))
+MODES = ('stages', 'cprofile')
+
+_mode = None
+_local = threading.local()
+_lock = threading.Lock()
+_active = 0          # stages running in any thread
+_stages = {}         # path -> [calls, wall, cpu, peak_rss]
+
+# Memory ----------------------------------------------------------------------
+
+def _read_hwm():
+    """Peak RSS in bytes: VmHWM on Linux (resettable), else ru_maxrss."""
+    try:
+        with open('/proc/self/status', 'rb') as f:
+            for line in f:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _reset_hwm():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _cpu():
+    """CPU seconds of this process and of its finished children."""
+    import resource
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+# Stages ----------------------------------------------------------------------
+
+def enabled():
+    return _mode is not None
+
+def enable(mode='stages'):
+    """Record stages from now on (also in worker processes started later)."""
+    global _mode
+    if mode not in MODES:
+        raise ValueError(f"Profile mode must be one of {MODES}.")
+    _mode = mode
+    os.environ['LABSCRIPTHUB_PROFILE'] = mode
+
+
+class _Timer:
+    __slots__ = ('path', 'wall', 'cpu', 'child_peak')
+
+    def __init__(self, name):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.path = f"{stack[-1].path}/{name}" if stack else name
+
+    def start(self):
+        global _active
+        stack = _local.stack
+        with _lock:
+            _active += 1
+            # The high-water mark is per process: only reset it while no other thread is in a stage
+            reset = _active == len(stack) + 1
+        if reset:
+            if stack:
+                # The enclosing stage keeps the peak it had reached so far
+                stack[-1].child_peak = max(stack[-1].child_peak, _read_hwm())
+            _reset_hwm()
+        self.child_peak = 0
+        stack.append(self)
+        self.cpu = _cpu()
+        self.wall = time.perf_counter()
+
+    def stop(self):
+        global _active
+        wall = time.perf_counter() - self.wall
+        cpu = _cpu() - self.cpu
+        peak = max(_read_hwm(), self.child_peak)
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            stack[-1].child_peak = max(stack[-1].child_peak, peak)
+        with _lock:
+            _active -= 1
+            record = _stages.setdefault(self.path, [0, 0.0, 0.0, 0])
+            record[0] += 1
+            record[1] += wall
+            record[2] += cpu
+            record[3] = max(record[3], peak)
+
+
+class stage:
+    """Time a block (`with stage('read'):`) or every call of a function (`@stage('fit')`)."""
+    __slots__ = ('name', '_timer')
+
+    def __init__(self, name):
+        self.name = name
+        self._timer = None
+
+    def __enter__(self):
+        if _mode is not None:
+            self._timer = _Timer(self.name)
+            self._timer.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+        return False
+
+    def __call__(self, func):
+        name = self.name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _mode is None:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+# Jobs ------------------------------------------------------------------------
+
+def _mb(value):
+    return round(value / 1024 ** 2, 1)
+
+def _emit(record):
+    line = json.dumps(record)
+    log = os.environ.get('LABSCRIPTHUB_PROFILE_LOG')
+    if log:
+        with open(log, 'a') as f:
+            f.write(line + '\n')
+    else:
+        print(line, file=sys.stderr, flush=True)
+
+def _take_stages():
+    with _lock:
+        stages = {path: {'calls': calls, 'wall': round(wall, 4), 'cpu': round(cpu, 4), 'peak_rss_mb': _mb(peak)}
+                  for path, (calls, wall, cpu, peak) in _stages.items()}
+        _stages.clear()
+    return stages
+
+@contextmanager
+def job(command, config):
+    """
+    One run of a command: collects its stages and emits the JSON line
+    (with a cProfile dump in 'cprofile' mode), also when the run fails. The
+    yielded dict takes extra fields, e.g. the status. A no-op while disabled.
+    """
+    if _mode is None:
+        yield {}
+        return
+    _take_stages()
+    extra = {'status': 'done'}
+    profiler = None
+    if _mode == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+    started = time.time()
+    try:
+        with stage('total'):
+            if profiler is not None:
+                profiler.enable()
+            try:
+                yield extra
+            except BaseException as exc:
+                extra['status'] = 'failed'
+                extra['error'] = f"{type(exc).__name__}: {exc}"
+                raise
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+    finally:
+        # Failed runs are reported too
+        stages = _take_stages()
+        totals = stages.pop('total', {})
+        record = {'command': command, 'config': str(config), 'pid': os.getpid(),
+                  'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+                  **extra, 'wall': totals.get('wall'), 'cpu': totals.get('cpu'),
+                  'peak_rss_mb': totals.get('peak_rss_mb'),
+                  'stages': {path[len('total/'):]: values for path, values in stages.items()}}
+        if profiler is not None:
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            dump = PROFILE_DIR / f"{command}-{Path(str(config)).stem}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof"
+            profiler.dump_stats(dump)
+            record['cprofile'] = str(dump)
+        _emit(record)
+
+def _emit_at_exit(started, start):
+    """Scripts run directly: the stages of the whole run (since this module was imported) as one job."""
+    stages = _take_stages()
+    if stages:
+        _emit({'command': Path(sys.argv[0]).stem, 'config': ' '.join(sys.argv[1:]), 'pid': os.getpid(),
+               'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)), 'status': 'done',
+               'wall': round(time.perf_counter() - start, 4), 'cpu': round(_cpu(), 4),
+               'peak_rss_mb': max(values['peak_rss_mb'] for values in stages.values()),
+               'stages': stages})
+
+
+if os.environ.get('LABSCRIPTHUB_PROFILE') in MODES + ('1',):
+    _mode = 'stages' if os.environ['LABSCRIPTHUB_PROFILE'] == '1' else os.environ['LABSCRIPTHUB_PROFILE']
+    import multiprocessing
+    if multiprocessing.parent_process() is None:
+        atexit.register(_emit_at_exit, time.time(), time.perf_counter())
@@ -0,0 +1,308 @@
+"""
+Run many configs as one build: a manifest lists the jobs, the dependencies
+follow from the files one job writes and another reads, and independent jobs
+run in parallel.
+
+    JOBS:
+      - COMMAND: fp-preprocess
+        CONFIG: plates/input.yaml
+      - COMMAND: fp-fit                # reads preprocessed_batch.csv -> runs after fp-preprocess
+        CONFIG: plates/fit_input.yaml
+    WORKERS: 8
+    UP_TO_DATE: hash                   # hash (output cache) or timestamp
+
+Per job: NAME (default: the config path), WORKDIR (folder the job runs in,
+default: the folder of the manifest), AFTER (names of jobs to wait for) and
+OUTPUTS (paths or globs, when the outputs cannot be predicted from the config).
+
+The outputs of a job are predicted from OUTPUT_FOLDER/OUTPUT_NAME and the
+naming rules of its script (OUTPUT_RULES); a job depends on every job whose
+predicted outputs overlap its inputs. A job is up to date when the output
+cache has its inputs, config and code (hash), or when all its outputs are
+newer than its inputs and config (timestamp). When a job fails, the jobs
+that depend on it are not run.
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache
+from pathlib import Path
+import glob
+import logging
+import os
+import sys
+import time
+
+from labscripthub.cli import COMMANDS, _input_paths, load_config
+
+# Command -> default OUTPUT_NAME and the files the script writes to OUTPUT_FOLDER:
+# {name} is the OUTPUT_NAME without suffix, {stem} expands to every input,
+# {report} is REPORT: NAME (default: {name}_report); an empty template is
+# OUTPUT_FOLDER itself (a dataset)
+OUTPUT_RULES = {
+    'nanodsf':       ('nanodsf_plot', ('{name}.png', '{name}_tm.csv', '{report}.pdf', '{report}_page*.png')),
+    'rotorgene':     ('preprocessed_{stem}', ('{name}.*', '{name}_tm.csv', '{report}.pdf', '{report}_page*.png')),
+    'dsf-ingest':    (None, ('',)),
+    'akta':          ('{stem}', ('{name}.png',)),
+    'itc-figure':    ('{stem}', ('{name}.png',)),
+    'itc-batch':     (None, ('{stem}.png',)),
+    'itc-integrate': (None, ('{stem}_integrated.csv', '{stem}_integrated.png')),
+    'itc-fit':       ('itc_fits', ('{name}.xlsx', '{stem}_fit.csv')),
+    'nmr1d':         ('output_plot', ('{name}.png',)),
+    'nmr2d':         ('output_plot', ('{name}.png',)),
+    'fp-preprocess': ('preprocessed_batch', ('{name}.*', '{name}_manifest.csv', '{name}_kinetic.xlsx')),
+    'fp-fit':        ('kd_fits', ('{name}.xlsx', 'fit_plots/*.png')),
+    'fp-qc':         ('plate_qc', ('{name}.xlsx', 'qc_heatmaps/*_qc.png')),
+}
+STATUS_ORDER = ('done', 'cached', 'up to date', 'failed', 'blocked')
+
+def _absolute(path, workdir):
+    path = os.path.expanduser(str(path))
+    return os.path.normpath(path if os.path.isabs(path) else os.path.join(workdir, path))
+
+def predict_outputs(command, cfg, workdir):
+    """Absolute output paths (or globs, for glob inputs) a job will write."""
+    folder = cfg.get('OUTPUT_FOLDER', COMMANDS[command].get('output_folder', '.'))
+    default_name, templates = OUTPUT_RULES[command]
+    inputs = _input_paths(cfg) or ['*']
+    stems = [Path(p).stem for p in inputs]
+    if command == 'fp-preprocess' and 'FILES' not in cfg:
+        default_name = 'preprocessed_{stem}'
+    name = os.path.splitext(str(cfg.get('OUTPUT_NAME') or default_name or ''))[0].format(stem=stems[0])
+    report_cfg = cfg.get('REPORT')
+    report = (report_cfg.get('NAME') if isinstance(report_cfg, dict) else None) or f"{name}_report"
+    # Without OUTPUT_FOLDER, itc-batch writes every figure next to its CSV
+    folders = [os.path.dirname(p) or '.' for p in inputs] if command == 'itc-batch' and 'OUTPUT_FOLDER' not in cfg \
+        else [folder] * len(inputs)
+    outputs = []
+    for template in templates:
+        pairs = list(zip(stems, folders)) if '{stem}' in template else [(stems[0], folder)]
+        for stem, out_folder in pairs:
+            path = _absolute(os.path.join(out_folder, template.format(name=name, stem=stem, report=report)), workdir)
+            if path not in outputs:
+                outputs.append(path)
+    return outputs
+
+@lru_cache(maxsize=None)
+def globs_intersect(a, b):
+    """
+    Whether two glob patterns can match the same string ('*' and '?'; a
+    [...] class counts as '?', so the answer may be a false yes, never a false no).
+    """
+    @lru_cache(maxsize=None)
+    def match(i, j):
+        if i == len(a) and j == len(b):
+            return True
+        if i < len(a) and a[i] == '*':
+            return match(i + 1, j) or (j < len(b) and match(i, j + 1))
+        if j < len(b) and b[j] == '*':
+            return match(i, j + 1) or (i < len(a) and match(i + 1, j))
+        if i < len(a) and j < len(b) and (a[i] == b[j] or a[i] == '?' or b[j] == '?'):
+            return match(i + 1, j + 1)
+        return False
+
+    def simplify(pattern):
+        # [...] -> ?
+        out, i = [], 0
+        while i < len(pattern):
+            end = pattern.find(']', i + 1) if pattern[i] == '[' else -1
+            out.append('?' if end > 0 else pattern[i])
+            i = end + 1 if end > 0 else i + 1
+        return ''.join(out)
+
+    a, b = simplify(a), simplify(b)
+    return match(0, 0)
+
+def patterns_overlap(output, input_path):
+    """Whether an output path/glob and an input path/glob can name the same file (or folder)."""
+    if globs_intersect(output, input_path):
+        return True
+    # An input folder that contains the output, or an input inside an output folder
+    for outer, inner in ((input_path, output), (output, input_path)):
+        if not glob.has_magic(outer) and inner.startswith(outer.rstrip(os.sep) + os.sep):
+            return True
+    return False
+
+def load_manifest(manifest_path):
+    """Jobs of a manifest with their config, workdir, inputs and predicted outputs."""
+    import yaml
+
+    manifest_path = Path(manifest_path).resolve()
+    with open(manifest_path, 'r') as f:
+        manifest = yaml.safe_load(f) or {}
+    entries = manifest.get('JOBS', [])
+    if not entries:
+        raise ValueError("Manifest must contain a 'JOBS' list with at least one entry.")
+
+    jobs = {}
+    for i, entry in enumerate(entries, start=1):
+        if not isinstance(entry, dict) or 'COMMAND' not in entry or 'CONFIG' not in entry:
+            raise ValueError(f"Job {i} needs COMMAND and CONFIG.")
+        command = entry['COMMAND']
+        if command not in COMMANDS:
+            raise ValueError(f"Job {i}: unknown command '{command}' (one of {', '.join(COMMANDS)}).")
+        workdir = _absolute(entry.get('WORKDIR', '.'), str(manifest_path.parent))
+        config = _absolute(entry['CONFIG'], str(manifest_path.parent))
+        name = str(entry.get('NAME', entry['CONFIG']))
+        if name in jobs:
+            raise ValueError(f"Job name '{name}' is used twice; set NAME.")
+        try:
+            with open(config, 'r') as f:
+                cfg = yaml.safe_load(f) or {}
+        except (OSError, yaml.YAMLError) as exc:
+            raise ValueError(f"Job '{name}': cannot read {config}: {exc}") from exc
+        outputs = [_absolute(p, workdir) for p in entry['OUTPUTS']] if 'OUTPUTS' in entry \
+            else predict_outputs(command, cfg, workdir)
+        jobs[name] = {
+            'name': name, 'command': command, 'config': config, 'workdir': workdir,
+            'inputs': [_absolute(p, workdir) for p in _input_paths(cfg)],
+            'outputs': outputs,
+            'after': set(map(str, entry.get('AFTER', []))),
+        }
+    options = {'workers': manifest.get('WORKERS'), 'up_to_date': manifest.get('UP_TO_DATE', 'hash')}
+    return jobs, options
+
+def dependencies(jobs):
+    """Job -> set of jobs it waits for: explicit AFTER plus overlapping outputs -> inputs."""
+    deps = {}
+    for name, job in jobs.items():
+        unknown = job['after'] - jobs.keys()
+        if unknown:
+            raise ValueError(f"Job '{name}': AFTER names unknown job(s) {sorted(unknown)}.")
+        deps[name] = set(job['after'])
+        for other, upstream in jobs.items():
+            if other != name and any(patterns_overlap(out, inp)
+                                     for out in upstream['outputs'] for inp in job['inputs']):
+                deps[name].add(other)
+    return deps
+
+def topological_order(deps):
+    """Jobs in an order that respects the dependencies; raises on a cycle."""
+    order, state = [], {}
+
+    def visit(name, path):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            cycle = path[path.index(name):] + [name]
+            raise ValueError(f"Dependency cycle: {' -> '.join(cycle)}; set OUTPUTS or AFTER to break it.")
+        state[name] = 'visiting'
+        for dep in sorted(deps[name]):
+            visit(dep, path + [name])
+        state[name] = 'done'
+        order.append(name)
+
+    for name in deps:
+        visit(name, [])
+    return order
+
+def is_up_to_date(job):
+    """Timestamp check: every output exists and is newer than the config and all inputs."""
+    from labscripthub.cache import expand_inputs
+
+    outputs = expand_inputs(job['outputs'])
+    if not outputs:
+        return False
+    inputs = expand_inputs(job['inputs']) + [Path(job['config'])]
+    newest_input = max(p.stat().st_mtime_ns for p in inputs)
+    return min(p.stat().st_mtime_ns for p in outputs) >= newest_input
+
+def init_worker():
+    # One job per core: keep numerical libraries from starting a thread per core each
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ.setdefault(var, '1')
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+def run_job(job, force=False, use_cache=True):
+    """Run one job in a worker process; returns (status, seconds, message, start time since the epoch)."""
+    from labscripthub.cli import run_command, load_script
+    from labscripthub.instrument import job as job_timer
+
+    started = time.time()
+    start = time.perf_counter()
+    os.chdir(job['workdir'])
+    try:
+        cfg, problems = load_config(job['command'], job['config'])
+        if problems:
+            return 'failed', time.perf_counter() - start, '; '.join(problems), started
+        if use_cache:
+            cached = run_command(job['command'], job['config'], cfg, force=force)
+        else:
+            with job_timer(job['command'], job['config']):
+                load_script(job['command']).main(job['config'])
+            cached = False
+        return ('cached' if cached else 'done'), time.perf_counter() - start, '', started
+    except (Exception, SystemExit) as exc:
+        return 'failed', time.perf_counter() - start, f"{type(exc).__name__}: {exc}", started
+    finally:
+        # Workers are reused: leave no styles or open figures to the next job
+        if 'matplotlib' in sys.modules:
+            import matplotlib
+            matplotlib.rcdefaults()
+            if 'matplotlib.pyplot' in sys.modules:
+                sys.modules['matplotlib.pyplot'].close('all')
+
+def run_manifest(manifest_path, workers=None, force=False, up_to_date=None, dry_run=False):
+    """Run all jobs of a manifest; returns the number of failed (or blocked) jobs."""
+    jobs, options = load_manifest(manifest_path)
+    deps = dependencies(jobs)
+    order = topological_order(deps)
+    workers = workers or options['workers'] or os.cpu_count() or 1
+    mode = up_to_date or options['up_to_date']
+    if mode not in ('hash', 'timestamp'):
+        raise ValueError("UP_TO_DATE must be 'hash' or 'timestamp'.")
+
+    if dry_run:
+        for name in order:
+            after = ', '.join(sorted(deps[name])) or '-'
+            print(f"{name}  [{jobs[name]['command']}]  after: {after}")
+        return 0
+
+    results = {}
+    waiting = set(order)
+    running = {}
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        while waiting or running:
+            for name in [n for n in order if n in waiting]:
+                if any(results.get(dep, ('',))[0] in ('failed', 'blocked') for dep in deps[name]):
+                    waiting.discard(name)
+                    results[name] = ('blocked', 0.0, 'a job it depends on failed', time.time() - t0)
+                    continue
+                if not all(dep in results for dep in deps[name]):
+                    continue
+                waiting.discard(name)
+                # Timestamps are checked when the job is due, after its inputs were rebuilt
+                if mode == 'timestamp' and not force and is_up_to_date(jobs[name]):
+                    results[name] = ('up to date', 0.0, '', time.time() - t0)
+                    continue
+                running[pool.submit(run_job, jobs[name], force, mode == 'hash')] = name
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                try:
+                    status, seconds, message, started = fut.result()
+                except Exception as exc:
+                    # The worker died (BrokenProcessPool) or the result could not be unpickled
+                    status, seconds, message, started = 'failed', 0.0, repr(exc), time.time()
+                results[name] = (status, seconds, message, started - t0)
+                level = logging.ERROR if status == 'failed' else logging.INFO
+                logging.log(level, f"{name}: {status} ({seconds:.2f} s){' - ' + message if message else ''}")
+
+    wall = time.time() - t0
+    print_summary(order, jobs, results, wall, workers)
+    return sum(results[name][0] in ('failed', 'blocked') for name in order)
+
+def print_summary(order, jobs, results, wall, workers):
+    """Table of the jobs with their start time, duration and status."""
+    width = max(len(name) for name in order)
+    print(f"\n{'job':<{width}}  {'command':<13}  {'start':>7}  {'time':>7}  status")
+    for name in sorted(order, key=lambda n: results[n][3]):
+        status, seconds, message, started = results[name]
+        print(f"{name:<{width}}  {jobs[name]['command']:<13}  {started:6.2f}s  {seconds:6.2f}s  {status}"
+              + (f": {message}" if message and status != 'failed' else ''))
+    busy = sum(results[name][1] for name in order)
+    counts = ', '.join(f"{sum(results[n][0] == s for n in order)} {s}" for s in STATUS_ORDER
+                       if any(results[n][0] == s for n in order))
+    print(f"\n{len(order)} jobs ({counts}) in {wall:.2f} s on {workers} worker(s); "
+          f"{busy:.2f} s of job time, {busy / wall if wall else 0:.1f}x parallel.")
@@ -0,0 +1,112 @@
+"""
+Figures on private Agg canvases, with the style applied per figure.
+
+pyplot keeps a current figure, and seaborn themes and rcParams are global,
+so two renders in one process get in each other's way: a figure that is not
+closed stays alive, and a theme set for one plot is still set for the next.
+The scripts therefore draw like this instead:
+
+    style = plot_style(seaborn=cfg.get('SEABORN_PARAMS') if cfg.get('USE_SEABORN') else None)
+    with styled(style):
+        fig = new_figure(figsize=(4, 3))
+        ax = fig.add_subplot(111)
+        ...
+        fig.savefig(output, dpi=600)
+
+new_figure() is not registered with pyplot, so nothing has to be closed; it
+is freed with its last reference. matplotlib reads rcParams both when
+artists are created and when they are drawn, so a style is active for the
+whole block: threads rendering with the same style run side by side, and a
+thread with a different style waits until they are done. The rcParams of the
+process are restored when the last block exits.
+"""
+from contextlib import contextmanager
+from functools import lru_cache
+import json
+import threading
+
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+# Never switched by a style: they belong to the process, not to a figure
+_PROCESS_KEYS = ('backend', 'backend_fallback', 'interactive')
+
+@lru_cache(maxsize=32)
+def _seaborn_rc(params):
+    """rcParams of sns.set_theme(**params), computed without touching the global ones."""
+    import seaborn as sns
+    from cycler import cycler
+
+    params = json.loads(params)
+    rc = {}
+    rc.update(sns.axes_style(params.get('style', 'darkgrid')))
+    rc.update(sns.plotting_context(params.get('context', 'notebook'), params.get('font_scale', 1)))
+    rc['font.family'] = params.get('font', 'sans-serif')
+    rc['axes.prop_cycle'] = cycler('color', sns.color_palette(params.get('palette', 'deep')))
+    rc.update(params.get('rc') or {})
+    return rc
+
+def plot_style(seaborn=None, rc=None):
+    """
+    A style: matplotlib's defaults, then the seaborn theme (parameters of
+    sns.set_theme; None for no theme), then `rc`.
+    """
+    style = {}
+    if seaborn is not None:
+        style.update(_seaborn_rc(json.dumps(seaborn, sort_keys=True)))
+    style.update(rc or {})
+    return style
+
+def new_figure(**kwargs):
+    """A Figure on its own Agg canvas, outside pyplot; kwargs as for Figure()."""
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+class _StyleLock:
+    """Shared by the renders of one style; exclusive between styles."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._key = None
+        self._users = 0
+        self._waiting = {}
+        self._saved = None
+
+    def _may_enter(self, key):
+        if self._users == 0:
+            return True
+        # Join the running style only if no other style is queued, so no style starves
+        return key == self._key and not any(k != key for k, n in self._waiting.items() if n)
+
+    @contextmanager
+    def hold(self, style):
+        key = json.dumps(style, sort_keys=True, default=repr)
+        with self._cond:
+            self._waiting[key] = self._waiting.get(key, 0) + 1
+            self._cond.wait_for(lambda: self._may_enter(key))
+            self._waiting[key] -= 1
+            if self._users == 0:
+                self._saved = {k: v for k, v in matplotlib.rcParams.items() if k not in _PROCESS_KEYS}
+                base = {k: v for k, v in matplotlib.rcParamsOrig.items() if k not in _PROCESS_KEYS}
+                matplotlib.rcParams.update({**base, **style})
+                self._key = key
+            self._users += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._users -= 1
+                if self._users == 0:
+                    matplotlib.rcParams.update(self._saved)
+                    self._key = self._saved = None
+                    self._cond.notify_all()
+
+
+_lock = _StyleLock()
+
+def styled(style=None):
+    """Context in which figures are created and drawn with `style` (see plot_style)."""
+    return _lock.hold(style or {})
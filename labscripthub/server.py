@@ -0,0 +1,225 @@
+"""
+Local render server that keeps the libraries imported and warm.
+
+    labscripthub serve                          # start it (Ctrl+C or `serve --stop` ends it)
+    labscripthub submit itc-figure input.yaml   # run a config on it
+
+Every script run pays for starting Python and importing matplotlib, pandas,
+scipy, seaborn and nmrglue, which takes longer than drawing a small figure.
+The server imports the script of every command once, draws a throw-away
+figure (fonts, Agg renderer, seaborn theme) and then forks one child per
+job. The child starts with all of that loaded, runs the command in the
+client's working folder through the output cache and exits, so jobs run
+side by side and cannot leave styles, rcParams or open figures behind for
+the next one. When a script or the labscripthub modules it uses were edited
+after the server started, the child imports them again, so results never
+come from stale code.
+
+Requests and replies are one JSON line each over a Unix socket
+($LABSCRIPTHUB_SOCKET, default ~/.cache/labscripthub/server.sock) that only
+the user can open. The client side (submit, ping, stop) imports only the
+standard library.
+"""
+from pathlib import Path
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import time
+
+from labscripthub import instrument
+from labscripthub.cache import CACHE_DIR
+from labscripthub.cli import COMMANDS, code_files, load_config, load_script, run_command
+
+SOCKET_PATH = Path(os.environ.get('LABSCRIPTHUB_SOCKET', CACHE_DIR / 'server.sock'))
+
+def _code_state(command):
+    """mtimes of the files a command is made of, to notice edits after preloading."""
+    return tuple((str(p), p.stat().st_mtime_ns) for p in code_files(command))
+
+def preload(commands=COMMANDS):
+    """Import the scripts and warm up matplotlib; returns command -> code state of the loaded ones."""
+    from labscripthub.jobs import init_worker
+
+    init_worker()
+    loaded = {}
+    for command in commands:
+        try:
+            load_script(command)
+        except Exception as exc:
+            # e.g. nmrglue not installed: the job reports the error when it is run
+            logging.warning(f"{command}: not preloaded ({type(exc).__name__}: {exc}).")
+            continue
+        loaded[command] = _code_state(command)
+
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    with matplotlib.rc_context():
+        try:
+            import seaborn as sns
+            sns.set_theme(style='ticks', context='paper')
+        except ImportError:
+            pass
+        fig = plt.figure(figsize=(1, 1))
+        fig.text(0.5, 0.5, '0 µ°')
+        fig.savefig(io.BytesIO(), format='png')
+        plt.close(fig)
+    return loaded
+
+def _reload(command):
+    """
+    Forget the modules a command is made of (every module of its instrument
+    folder and the labscripthub package too) and import the script again.
+    """
+    files = {str(p) for p in code_files(command)}
+    for name, module in list(sys.modules.items()):
+        if getattr(module, '__file__', None) in files:
+            del sys.modules[name]
+    return load_script(command)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError as exc:
+            reply = {'status': 'failed', 'output': f"Bad request: {exc}\n"}
+        else:
+            reply = self.server.execute(request)
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class RenderServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Forks a child per request; the children inherit the preloaded modules."""
+
+    max_children = max(os.cpu_count() or 1, 2)
+
+    def __init__(self, path=SOCKET_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.started = time.time()
+        start = time.perf_counter()
+        self.loaded = preload()
+        self.preload_seconds = time.perf_counter() - start
+        # Bind with a umask so the socket is never accessible to other users
+        umask = os.umask(0o177)
+        try:
+            super().__init__(str(self.path), _Handler)
+        finally:
+            os.umask(umask)
+
+    def execute(self, request):
+        """Run one request in the forked child; returns the reply."""
+        if request.get('ping'):
+            return {'status': 'ok', 'pid': os.getppid(), 'uptime': time.time() - self.started,
+                    'preload': self.preload_seconds, 'commands': sorted(self.loaded)}
+        command = request.get('command')
+        if command not in COMMANDS:
+            return {'status': 'failed', 'output': f"Unknown command '{command}'.\n"}
+
+        # Everything the job logs or prints goes back to the client
+        buffer = io.StringIO()
+        handler = logging.StreamHandler(buffer)
+        handler.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+        root = logging.getLogger()
+        root.handlers = [handler]
+        root.setLevel(logging.INFO)
+        sys.stdout = sys.stderr = buffer
+
+        start = time.perf_counter()
+        status = 'failed'
+        try:
+            os.chdir(request['cwd'])
+            if request.get('profile'):
+                # The child is forked per request, so this only profiles this job
+                if request.get('profile_log'):
+                    os.environ['LABSCRIPTHUB_PROFILE_LOG'] = request['profile_log']
+                instrument.enable(request['profile'])
+            if command in self.loaded and _code_state(command) != self.loaded[command]:
+                logging.info(f"The code of {command} changed since the server started; reloading it "
+                             f"(restart the server to preload it again).")
+                _reload(command)
+            config = request['config']
+            cfg, problems = load_config(command, config)
+            if problems:
+                for problem in problems:
+                    logging.error(f"{config}: {problem}")
+            else:
+                cached = run_command(command, config, cfg, force=request.get('force', False))
+                status = 'cached' if cached else 'done'
+        except (Exception, SystemExit) as exc:
+            logging.error(f"{type(exc).__name__}: {exc}")
+        finally:
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        return {'status': status, 'seconds': time.perf_counter() - start, 'output': buffer.getvalue()}
+
+    def server_close(self):
+        super().server_close()
+        self.path.unlink(missing_ok=True)
+
+
+def _request(request, path=SOCKET_PATH, timeout=None):
+    """Send one request and wait for the reply; OSError when no server is listening."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(1 << 16)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
+
+def ping(path=SOCKET_PATH):
+    """Status of the running server, or None."""
+    try:
+        return _request({'ping': True}, path, timeout=5)
+    except (OSError, ValueError):
+        return None
+
+def submit(command, yaml_config, force=False, profile=None, path=SOCKET_PATH):
+    """Run a config on the server from the current folder; returns the reply (status, seconds, output)."""
+    return _request({'command': command, 'config': str(yaml_config), 'cwd': os.getcwd(), 'force': force,
+                     'profile': profile, 'profile_log': os.environ.get('LABSCRIPTHUB_PROFILE_LOG')}, path)
+
+def serve(path=SOCKET_PATH):
+    """Start the server in the foreground; returns when it is stopped."""
+    path = Path(path)
+    if ping(path) is not None:
+        raise ValueError(f"A render server is already running on {path}.")
+    # A socket left behind by a server that did not exit cleanly
+    path.unlink(missing_ok=True)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+
+    server = RenderServer(path)
+    logging.info(f"Render server on {path} (pid {os.getpid()}); {len(server.loaded)} command(s) "
+                 f"preloaded in {server.preload_seconds:.2f} s.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Render server stopped.")
+    finally:
+        server.server_close()
+
+def stop(path=SOCKET_PATH):
+    """Stop the server running on `path`; returns False if none was running."""
+    path = Path(path)
+    status = ping(path)
+    if status is None:
+        return False
+    os.kill(status['pid'], signal.SIGTERM)
+    for _ in range(50):
+        if not path.exists():
+            break
+        time.sleep(0.1)
+    return True
@@ -0,0 +1,359 @@
+"""
+Watch export folders and process new files as they arrive.
+
+    WATCH:
+      - FOLDER: /shared/akta               # folder the instrument exports to
+        PATTERN: "*.csv"
+        COMMAND: akta
+        TEMPLATE: templates/akta.yaml      # config of the command with {FILE}, {STEM} and {FOLDER}
+        #OUTPUT_FOLDER: processed          # default: <FOLDER>/processed
+        #RECURSIVE: False
+    #WORKERS: 2                            # files processed at the same time
+    #SETTLE: 2.0                           # seconds a file must stay unchanged before it is processed
+    #POLL_INTERVAL: 1.0                    # seconds between scans without inotify
+    #LOG: processing_log.csv               # default: next to this config
+
+For every new or changed file, the template is filled in (the placeholders
+are replaced as plain text, so LaTeX braces in labels are safe), the file's
+OUTPUT_FOLDER is set to <OUTPUT_FOLDER>/<name> unless the template has one,
+and the config is saved as <OUTPUT_FOLDER>/configs/<name>.yaml before the
+command runs on a worker pool; <name> is the file's path relative to FOLDER
+without the extension (the stem, for files directly in FOLDER). One folder
+per file keeps the outputs of jobs running at the same time apart, also for
+files of the same name in different subfolders. Every file gets a line in the processing log, which is also how files
+that were processed before a restart are skipped.
+
+On Linux the folders are watched with inotify (through ctypes); elsewhere,
+on network shares, or with --poll they are scanned every POLL_INTERVAL. A
+file counts as complete once its size and mtime have not changed for SETTLE
+seconds, so half-written exports are never picked up.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+from pathlib import Path
+import csv
+import logging
+import os
+import struct
+import sys
+import time
+
+from labscripthub.cli import COMMANDS
+from labscripthub.jobs import init_worker, run_job
+
+LOG_FIELDS = ['Time', 'File', 'Size', 'Mtime', 'Command', 'Status', 'Seconds', 'Config', 'Message']
+PLACEHOLDERS = ('{FILE}', '{STEM}', '{FOLDER}')
+
+
+class Inotify:
+    """Minimal inotify binding (Linux): add_watch() and events() -> folder, name, is_dir."""
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    _HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._folders = {}
+
+    def add_watch(self, folder):
+        import ctypes
+
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(str(folder)), self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(folder))
+        self._folders[wd] = Path(folder)
+
+    def events(self, timeout):
+        """Events that arrive within `timeout` seconds."""
+        import select
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = self._HEADER.unpack_from(data, offset)
+            offset += self._HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd in self._folders and name:
+                events.append((self._folders[wd], os.fsdecode(name), bool(mask & self.IN_ISDIR)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def fill_template(value, replacements):
+    """Replace the placeholders in every string of a (nested) config."""
+    if isinstance(value, str):
+        for placeholder, text in replacements.items():
+            value = value.replace(placeholder, text)
+        return value
+    if isinstance(value, list):
+        return [fill_template(v, replacements) for v in value]
+    if isinstance(value, dict):
+        return {k: fill_template(v, replacements) for k, v in value.items()}
+    return value
+
+def load_rules(config_path):
+    """Watch rules and options from the watch config; paths relative to the config."""
+    import yaml
+
+    config_path = Path(config_path).resolve()
+    with open(config_path, 'r') as f:
+        cfg = yaml.safe_load(f) or {}
+    entries = cfg.get('WATCH', [])
+    if not entries:
+        raise ValueError("Config YAML must contain a 'WATCH' list with at least one entry.")
+
+    base = config_path.parent
+    rules = []
+    for i, entry in enumerate(entries, start=1):
+        missing = [key for key in ('FOLDER', 'COMMAND', 'TEMPLATE') if key not in entry]
+        if missing:
+            raise ValueError(f"WATCH entry {i} is missing {', '.join(missing)}.")
+        if entry['COMMAND'] not in COMMANDS:
+            raise ValueError(f"WATCH entry {i}: unknown command '{entry['COMMAND']}'.")
+        folder = (base / Path(entry['FOLDER']).expanduser()).resolve()
+        if not folder.is_dir():
+            raise ValueError(f"WATCH entry {i}: folder '{folder}' does not exist.")
+        with open(base / entry['TEMPLATE'], 'r') as f:
+            template = yaml.safe_load(f) or {}
+        output_folder = folder / entry.get('OUTPUT_FOLDER', 'processed')
+        rules.append({
+            'folder': folder,
+            'pattern': entry.get('PATTERN', '*'),
+            'command': entry['COMMAND'],
+            'template': template,
+            'output_folder': output_folder.resolve(),
+            'recursive': entry.get('RECURSIVE', False),
+        })
+    options = {
+        'workers': cfg.get('WORKERS', 2),
+        'settle': float(cfg.get('SETTLE', 2.0)),
+        'poll_interval': float(cfg.get('POLL_INTERVAL', 1.0)),
+        'log': base / cfg.get('LOG', 'processing_log.csv'),
+    }
+    return rules, options
+
+def match_rule(rules, path):
+    """First rule whose folder (and pattern) covers `path`, or None."""
+    for rule in rules:
+        folder = rule['folder']
+        if path.parent != folder and not (rule['recursive'] and folder in path.parents):
+            continue
+        if rule['output_folder'] == path.parent or rule['output_folder'] in path.parents:
+            continue
+        if fnmatch(path.name, rule['pattern']):
+            return rule
+    return None
+
+def make_job(rule, path):
+    """Write the config of one file from the rule's template; returns the job for run_job()."""
+    import yaml
+
+    replacements = dict(zip(PLACEHOLDERS, (str(path), path.stem, str(path.parent))))
+    cfg = fill_template(rule['template'], replacements)
+    # Keyed by the path below FOLDER, so a/run.csv and b/run.csv do not share a folder
+    name = path.parent.relative_to(rule['folder']) / path.stem
+    cfg.setdefault('OUTPUT_FOLDER', str(Path(rule['output_folder']) / name))
+    config = Path(rule['output_folder']) / 'configs' / f"{name}.yaml"
+    config.parent.mkdir(parents=True, exist_ok=True)
+    with open(config, 'w') as f:
+        yaml.safe_dump(cfg, f, sort_keys=False, allow_unicode=True)
+    return {'name': str(path), 'command': rule['command'], 'config': str(config), 'workdir': str(rule['folder'])}
+
+
+class Watcher:
+    """Tracks candidate files until they settle and hands them to a bounded pool."""
+
+    def __init__(self, rules, options, use_inotify=True):
+        self.rules = rules
+        self.options = options
+        self.pending = {}                 # path -> (size, mtime_ns, last change)
+        self.known = self._read_log()     # path -> (size, mtime_ns) already processed
+        self.queue = deque()
+        self.active = {}                  # path -> (size, mtime_ns) queued or running
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+                for rule in rules:
+                    self._watch_tree(rule['folder'], rule['recursive'])
+                logging.info("Watching with inotify.")
+            except OSError as exc:
+                logging.info(f"inotify not available ({exc}); polling every {options['poll_interval']} s.")
+                self.inotify = None
+        else:
+            logging.info(f"Polling every {options['poll_interval']} s.")
+
+    def _watch_tree(self, folder, recursive):
+        self.inotify.add_watch(folder)
+        if recursive:
+            for sub in (p for p in Path(folder).rglob('*') if p.is_dir()):
+                self.inotify.add_watch(sub)
+
+    def _read_log(self):
+        known = {}
+        try:
+            with open(self.options['log'], newline='') as f:
+                for row in csv.DictReader(f):
+                    if row['Status'] in ('done', 'cached'):
+                        known[row['File']] = (int(row['Size']), int(row['Mtime']))
+        except (OSError, KeyError, ValueError):
+            pass
+        return known
+
+    def write_log(self, path, size, mtime, command, status, seconds, config, message):
+        log = self.options['log']
+        new = not log.exists()
+        with open(log, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(LOG_FIELDS)
+            writer.writerow([time.strftime('%Y-%m-%d %H:%M:%S'), str(path), size, mtime, command, status,
+                             f"{seconds:.2f}", config, message])
+
+    def scan(self):
+        """Every file the rules cover (used at start-up and for polling)."""
+        for rule in self.rules:
+            files = rule['folder'].rglob(rule['pattern']) if rule['recursive'] else rule['folder'].glob(rule['pattern'])
+            for path in files:
+                if path.is_file():
+                    self.touch(path)
+
+    def touch(self, path):
+        """Note that `path` may have changed; it is processed once it has settled."""
+        path = Path(path)
+        if match_rule(self.rules, path) is None:
+            return
+        try:
+            st = path.stat()
+        except OSError:
+            self.pending.pop(path, None)
+            return
+        state = (st.st_size, st.st_mtime_ns)
+        if self.known.get(str(path)) == state or self.active.get(path) == state:
+            return
+        previous = self.pending.get(path)
+        if previous is None or previous[:2] != state:
+            self.pending[path] = (*state, time.monotonic())
+
+    def settled(self):
+        """Pending files that have not changed for SETTLE seconds; re-checks them on disk."""
+        now = time.monotonic()
+        ready = []
+        for path, (size, mtime, changed) in list(self.pending.items()):
+            self.touch(path)
+            if path not in self.pending:
+                continue
+            size, mtime, changed = self.pending[path]
+            if now - changed >= self.options['settle']:
+                del self.pending[path]
+                self.active[path] = (size, mtime)
+                ready.append((path, size, mtime))
+        return ready
+
+    def wait_for_changes(self, timeout):
+        if self.inotify is None:
+            time.sleep(timeout)
+            self.scan()
+            return
+        for folder, name, is_dir in self.inotify.events(timeout):
+            path = folder / name
+            if is_dir:
+                if any(rule['recursive'] and (rule['folder'] == folder or rule['folder'] in folder.parents)
+                       for rule in self.rules):
+                    self._watch_tree(path, True)
+                    for child in path.rglob('*'):
+                        self.touch(child)
+            else:
+                self.touch(path)
+
+    def run(self, once=False):
+        """Process files until interrupted (or, with once, until the files present are done)."""
+        workers = self.options['workers']
+        running = {}
+        self.scan()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            try:
+                while True:
+                    self.queue.extend(self.settled())
+                    # Bounded: never more jobs in the pool than workers, the rest wait here
+                    while self.queue and len(running) < workers:
+                        path, size, mtime = self.queue.popleft()
+                        rule = match_rule(self.rules, path)
+                        try:
+                            job = make_job(rule, path)
+                        except (OSError, ValueError) as exc:
+                            self.active.pop(path, None)
+                            self.write_log(path, size, mtime, rule['command'], 'failed', 0.0, '', str(exc))
+                            continue
+                        running[pool.submit(run_job, job)] = (path, size, mtime, rule['command'], job['config'])
+                        logging.info(f"{path.name}: {rule['command']} started.")
+                    for fut in [f for f in running if f.done()]:
+                        self._finish(running.pop(fut), fut)
+                    if once and not (self.pending or self.queue or running):
+                        return
+                    # Short ticks while files settle or jobs run; otherwise wait for events
+                    if self.pending:
+                        tick = min(self.options['poll_interval'], self.options['settle'] / 4)
+                    elif running:
+                        tick = 0.1
+                    else:
+                        tick = self.options['poll_interval']
+                    self.wait_for_changes(tick)
+            except KeyboardInterrupt:
+                logging.info("Stopping; waiting for the running jobs.")
+                for fut in list(running):
+                    self._finish(running.pop(fut), fut)
+            finally:
+                if self.inotify is not None:
+                    self.inotify.close()
+
+    def _finish(self, item, fut):
+        path, size, mtime, command, config = item
+        try:
+            status, seconds, message, _ = fut.result()
+        except Exception as exc:
+            status, seconds, message = 'failed', 0.0, repr(exc)
+        self.write_log(path, size, mtime, command, status, seconds, config, message)
+        # Failed files are retried when they change (or after a restart), not on every scan
+        self.known[str(path)] = (size, mtime)
+        self.active.pop(path, None)
+        level = logging.ERROR if status == 'failed' else logging.INFO
+        logging.log(level, f"{path.name}: {status} ({seconds:.2f} s){' - ' + message if message else ''}")
+
+def _init_worker():
+    # Ctrl+C stops the watcher, which lets the running jobs finish
+    import signal
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_worker()
+
+def watch(config_path, poll=False, once=False):
+    rules, options = load_rules(config_path)
+    Watcher(rules, options, use_inotify=not poll).run(once=once)